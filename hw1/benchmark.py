@@ -0,0 +1,124 @@
+# -*- coding:utf-8 -*-
+
+"""
+@author: Yiyun Yang
+
+Offline benchmark of dns_resolver and sec_resolver against an in-process fake root/TLD/authoritative hierarchy
+(see fake_dns.py), so resolver changes can be measured without the live root servers.
+
+    python benchmark.py --names 200 --latency 0.01 --loss 0.02
+"""
+import argparse
+import random
+import time
+
+import dns.rdatatype
+from prettytable import PrettyTable
+
+import dns_transport
+import dnssec_resolver
+import mydig
+from dns_cache import resolution_cache
+from fake_dns import FakeHierarchy
+
+
+def percentile(sorted_list, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if len(sorted_list) == 0:
+        return float('nan')
+    return sorted_list[min(len(sorted_list) - 1, int(p / 100 * len(sorted_list)))]
+
+
+def clear_caches():
+    """Start from nothing learnt: answers, validated keys, DS digests, server SRTTs and TCP connections."""
+    resolution_cache.clear()
+    dnssec_resolver.validated_cache.clear()
+    dnssec_resolver.make_ds.cache_clear()
+    dns_transport.reset_server_state()
+
+
+def run_dns_resolver(name):
+    mydig.dns_resolver(name, dns.rdatatype.A, [])
+
+
+def run_sec_resolver(name):
+    dnssec_resolver.sec_resolver(name, dns.rdatatype.A, [])
+
+
+def run_scenario(hierarchy, func, names, warm):
+    """Resolve every name once, cold scenarios clear every cache before each resolution."""
+    clear_caches()
+    if warm:
+        for name in names:  # prime the caches
+            try:
+                func(name)
+            except Exception:
+                pass
+    latencies = []
+    failures = 0
+    queries_before = hierarchy.queries
+    start_time = time.perf_counter()
+    for name in names:
+        if not warm:
+            clear_caches()
+        t = time.perf_counter()
+        try:
+            func(name)
+            latencies.append(time.perf_counter() - t)
+        except Exception:
+            failures += 1
+    elapsed = time.perf_counter() - start_time
+    latencies.sort()
+    return {'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'queries': (hierarchy.queries - queries_before) / len(names),
+            'throughput': len(names) / elapsed,
+            'failures': failures}
+
+
+def benchmark(args):
+    hierarchy = FakeHierarchy(n_tld=args.tld, n_domain=args.domains, n_host=args.hosts, ns_per_zone=args.ns,
+                              cname_ratio=args.cname_ratio, glueless_ratio=args.glueless_ratio,
+                              latency=args.latency, jitter=args.jitter, loss=args.loss, dead_ratio=args.dead_ratio,
+                              udp_limit=args.udp_limit, port=args.port, seed=args.seed).start()
+    # point both resolvers at the fake hierarchy
+    dns_transport.DNS_PORT = hierarchy.port
+    mydig.root_server_list[:] = hierarchy.root_ip_list
+    dnssec_resolver.root_server_list[:] = hierarchy.root_ip_list
+    dnssec_resolver.root_anchors[:] = hierarchy.root_anchors
+
+    names = random.Random(args.seed).choices(hierarchy.names, k=args.names)
+    table = PrettyTable(['resolver', 'cache', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'queries/resolution',
+                         'resolutions/s', 'failures'])
+    for label, func in [('dns_resolver', run_dns_resolver), ('sec_resolver', run_sec_resolver)]:
+        for warm in [False, True]:
+            result = run_scenario(hierarchy, func, names, warm)
+            table.add_row([label, 'warm' if warm else 'cold', f'{result["p50"]:.2f}', f'{result["p95"]:.2f}',
+                           f'{result["p99"]:.2f}', f'{result["queries"]:.2f}', f'{result["throughput"]:.1f}',
+                           result['failures']])
+    hierarchy.stop()
+    print(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the resolvers against a local fake DNS hierarchy')
+    parser.add_argument('--names', type=int, default=100, help='resolutions per scenario')
+    parser.add_argument('--tld', type=int, default=3)
+    parser.add_argument('--domains', type=int, default=10, help='domains per TLD')
+    parser.add_argument('--hosts', type=int, default=5, help='hosts per domain')
+    parser.add_argument('--ns', type=int, default=2, help='nameservers per zone')
+    parser.add_argument('--cname-ratio', type=float, default=0.2)
+    parser.add_argument('--glueless-ratio', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.005, help='server latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.002)
+    parser.add_argument('--loss', type=float, default=0.0, help='probability a UDP query is dropped')
+    parser.add_argument('--dead-ratio', type=float, default=0.0, help='share of non-root servers that never answer')
+    parser.add_argument('--udp-limit', type=int, default=4096, help='UDP answers larger than this are truncated')
+    parser.add_argument('--port', type=int, default=5300)
+    parser.add_argument('--seed', type=int, default=534)
+    benchmark(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# -*- coding:utf-8 -*-
+
+"""
+@author: Yiyun Yang
+"""
+import time
+from collections import OrderedDict
+
+import dns.name
+import dns.rcode
+import dns.rdatatype
+
+NEGATIVE = object()  # marker stored for NXDOMAIN / NODATA answers
+
+
+def is_negative(resp):
+    """NXDOMAIN, or NODATA: NOERROR with an SOA in the authority section (RFC 2308). SERVFAIL and the like are not."""
+    if resp.rcode() == dns.rcode.NXDOMAIN:
+        return True
+    return resp.rcode() == dns.rcode.NOERROR and any(rr_set.rdtype == dns.rdatatype.SOA for rr_set in resp.authority)
+
+
+def to_name(domain):
+    if isinstance(domain, dns.name.Name):
+        return domain
+    return dns.name.from_text(domain)
+
+
+class Referral(object):
+    """NS names and glue addresses of a zone cut, as learnt from a referral response."""
+
+    def __init__(self, zone, ns_names, ipv4_list):
+        self.zone = zone
+        self.ns_names = ns_names
+        self.ipv4_list = ipv4_list
+
+
+class DNSCache(object):
+    """
+    A bounded LRU cache keyed by (name, rdtype) whose entries expire with the TTL of the cached records.
+
+    Three kinds of values are stored under the same key space:
+        (name, rdtype) -> answer section (a list of RRsets) or NEGATIVE
+        (name, CNAME)  -> the CNAME RRset of an alias
+        (zone, NS)     -> Referral of the zone cut
+    """
+
+    def __init__(self, max_entries=10000, max_ttl=86400, neg_ttl=300):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl  # upper bound for any record TTL
+        self.neg_ttl = neg_ttl  # used when a negative answer carries no SOA
+        self._entries = OrderedDict()  # {(name, rdtype): (expire_time, value)}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name, rdtype):
+        key = (to_name(name), rdtype)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expire_time, value = entry
+        if expire_time <= time.time():  # expired, drop it
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)  # mark as recently used
+        self.hits += 1
+        return value
+
+    def put(self, name, rdtype, value, ttl):
+        ttl = min(ttl, self.max_ttl)
+        if ttl <= 0:
+            return
+        key = (to_name(name), rdtype)
+        self._entries[key] = (time.time() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:  # evict the least recently used entry
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def put_answer(self, name, rdtype, answer):
+        """Cache an answer section, CNAME RRsets in it are also cached on their own names."""
+        if len(answer) == 0:
+            return
+        for rr_set in answer:
+            if rr_set.rdtype == dns.rdatatype.CNAME:
+                self.put(rr_set.name, dns.rdatatype.CNAME, rr_set, rr_set.ttl)
+        if any(rr_set.rdtype == rdtype for rr_set in answer):
+            self.put(name, rdtype, answer, min(rr_set.ttl for rr_set in answer))
+
+    def put_negative(self, name, rdtype, resp):
+        ttl = self.neg_ttl
+        for rr_set in resp.authority:
+            if rr_set.rdtype == dns.rdatatype.SOA:  # RFC 2308: min of SOA TTL and SOA MINIMUM
+                for soa in rr_set.items:
+                    ttl = min(rr_set.ttl, soa.minimum)
+        self.put(name, rdtype, NEGATIVE, ttl)
+
+    def put_referral(self, resp, ipv4_list=None):
+        """Cache the NS RRset in the authority section along with its glue (or the given addresses)."""
+        for rr_set in resp.authority:
+            if rr_set.rdtype != dns.rdatatype.NS:
+                continue
+            ns_names = [item.target for item in rr_set.items]
+            ttl = rr_set.ttl
+            if ipv4_list is None:
+                ipv4_list = []
+                for glue in resp.additional:
+                    if glue.rdtype == dns.rdatatype.A and glue.name in ns_names:
+                        ipv4_list.extend(item.to_text() for item in glue.items)
+                        ttl = min(ttl, glue.ttl)
+            if len(ipv4_list) > 0:
+                self.put(rr_set.name, dns.rdatatype.NS, Referral(rr_set.name, ns_names, ipv4_list), ttl)
+            return
+
+    def closest_referral(self, name):
+        """Return the Referral of the deepest cached zone cut enclosing name, or None."""
+        name = to_name(name)
+        while True:
+            referral = self.get(name, dns.rdatatype.NS)
+            if referral is not None:
+                return referral
+            if name == dns.name.root:
+                return None
+            name = name.parent()
+
+
+# process-wide cache shared by every dns_resolver call
+resolution_cache = DNSCache()
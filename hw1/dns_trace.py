@@ -0,0 +1,70 @@
+# -*- coding:utf-8 -*-
+
+"""
+@author: Yiyun Yang
+"""
+import contextvars
+import json
+import time
+
+import dns.rdatatype
+
+# trace of the resolution running in the current thread / asyncio task, None when tracing is off
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class QueryTrace(object):
+    """
+    Every upstream query, cache lookup and DNSSEC verification step of a resolution, in the order they happened.
+    Each event is a dict with a "type" of "query", "cache" or "verify" and "t_ms", its offset from the trace start.
+    """
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.events = []
+
+    def _add(self, event_type, **fields):
+        event = {'type': event_type, 't_ms': round((time.monotonic() - self.start_time) * 1000, 3)}
+        event.update(fields)
+        self.events.append(event)
+
+    def add_query(self, server, req, transport, rtt, retry, size=None, error=None):
+        question = req.question[0]
+        self._add('query', server=server, qname=question.name.to_text(),
+                  rdtype=dns.rdatatype.to_text(question.rdtype), transport=transport,
+                  rtt_ms=round(rtt * 1000, 3), size=size, retry=retry,
+                  error=None if error is None else (repr(error) if str(error) == '' else str(error)))
+
+    def add_cache(self, name, rdtype, hit, cache='resolution'):
+        self._add('cache', cache=cache, name=str(name), rdtype=dns.rdatatype.to_text(rdtype), hit=hit)
+
+    def add_verify(self, zone, step, seconds):
+        self._add('verify', zone=str(zone), step=step, time_ms=round(seconds * 1000, 3))
+
+    def queries(self):
+        return [event for event in self.events if event['type'] == 'query']
+
+    def to_json(self, indent=None):
+        return json.dumps(self.events, indent=indent)
+
+    def write(self, path):
+        """Write the trace as JSON to path, "-" for stdout."""
+        if path == '-':
+            print(self.to_json(indent=2))
+        else:
+            with open(path, 'w') as f:
+                f.write(self.to_json(indent=2))
+
+
+def trace_cache(name, rdtype, value, cache='resolution'):
+    """Record a cache lookup on the current trace, return value so lookups can be wrapped in place."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_cache(name, rdtype, value is not None, cache)
+    return value
+
+
+def trace_verify(zone, step, start_time):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_verify(zone, step, time.perf_counter() - start_time)
@@ -0,0 +1,323 @@
+# -*- coding:utf-8 -*-
+
+"""
+@author: Yiyun Yang
+"""
+import asyncio
+import random
+import threading
+import time
+import weakref
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.query
+
+from dns_trace import current_trace
+from server_rtt import server_rtt
+
+DNS_PORT = 53
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, pool):
+        self.pool = pool
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 2:
+            return
+        txid = int.from_bytes(data[:2], 'big')  # demultiplex by (server ip, port, transaction id)
+        fut = self.pool._pending.get((addr[0], addr[1], txid))
+        if fut is not None and not fut.done():
+            fut.set_result(data)
+
+    def error_received(self, exc):
+        pass  # ICMP errors are not bound to a query, the query just times out
+
+
+class UDPQueryPool(object):
+    """
+    A fixed set of UDP sockets shared by every query issued on one event loop.
+    In-flight queries are told apart by server address and transaction ID, so a socket carries many queries at once.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self._protocols = []
+        self._pending = {}  # {(ip, port, txid): future}
+        self._next = 0
+        self._open_lock = None
+
+    async def _open(self):
+        if len(self._protocols) == self.size:
+            return
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+        async with self._open_lock:
+            loop = asyncio.get_running_loop()
+            while len(self._protocols) < self.size:
+                _, protocol = await loop.create_datagram_endpoint(lambda: _UDPProtocol(self),
+                                                                  local_addr=('0.0.0.0', 0))
+                self._protocols.append(protocol)
+
+    def _new_key(self, req, ip, port):
+        key = (ip, port, req.id)
+        while key in self._pending:  # transaction id already in flight to this server, pick another one
+            req.id = random.getrandbits(16)
+            key = (ip, port, req.id)
+        return key
+
+    async def query(self, req: dns.message.Message, ip, timeout=1, port=None):
+        await self._open()
+        port = port or DNS_PORT
+        loop = asyncio.get_running_loop()
+        key = self._new_key(req, ip, port)
+        self._pending[key] = loop.create_future()
+        protocol = self._protocols[self._next % self.size]
+        self._next += 1
+        start_time = time.monotonic()
+        deadline = start_time + timeout
+        try:
+            protocol.transport.sendto(req.to_wire(), (ip, port))
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    server_rtt.timeout(ip, timeout)
+                    raise dns.exception.Timeout(timeout=timeout)
+                try:
+                    data = await asyncio.wait_for(self._pending[key], remaining)
+                except asyncio.TimeoutError:
+                    server_rtt.timeout(ip, timeout)
+                    raise dns.exception.Timeout(timeout=timeout)
+                try:
+                    resp = dns.message.from_wire(data)
+                    if req.is_response(resp):
+                        server_rtt.update(ip, time.monotonic() - start_time)
+                        return resp
+                except dns.exception.DNSException:
+                    pass
+                self._pending[key] = loop.create_future()  # malformed or mismatched reply, keep waiting
+        finally:
+            self._pending.pop(key, None)
+
+    def close(self):
+        for protocol in self._protocols:
+            protocol.transport.close()
+        self._protocols = []
+
+
+_udp_pools = weakref.WeakKeyDictionary()  # {event loop: UDPQueryPool}
+
+
+def get_udp_pool():
+    loop = asyncio.get_running_loop()
+    pool = _udp_pools.get(loop)
+    if pool is None:
+        pool = _udp_pools[loop] = UDPQueryPool()
+    return pool
+
+
+class _TCPConnection(object):
+    """One TCP connection to a nameserver carrying pipelined queries, answers may come back in any order."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._pending = {}  # {txid: future}
+        self.closed = False
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            while True:
+                length = int.from_bytes(await self.reader.readexactly(2), 'big')
+                data = await self.reader.readexactly(length)
+                fut = self._pending.get(int.from_bytes(data[:2], 'big'))
+                if fut is not None and not fut.done():
+                    fut.set_result(data)
+        except Exception as e:  # EOF or reset, every query in flight fails and the connection is dropped
+            self.close()
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError(f'connection closed: {e!r}'))
+
+    async def query(self, req: dns.message.Message, timeout):
+        while req.id in self._pending:
+            req.id = random.getrandbits(16)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[req.id] = fut
+        try:
+            wire = req.to_wire()
+            self.writer.write(len(wire).to_bytes(2, 'big') + wire)
+            try:
+                data = await asyncio.wait_for(fut, timeout)
+            except asyncio.TimeoutError:
+                raise dns.exception.Timeout(timeout=timeout)
+            resp = dns.message.from_wire(data)
+            if not req.is_response(resp):
+                raise dns.query.BadResponse
+            return resp
+        finally:
+            self._pending.pop(req.id, None)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+            self._read_task.cancel()
+
+
+class TCPConnectionPool(object):
+    """Persistent TCP connections, one per nameserver, reused by every query sent to that server over TCP."""
+
+    def __init__(self):
+        self._connections = {}  # {(ip, port): _TCPConnection}
+        self._connect_locks = {}
+
+    async def _connection(self, ip, port, timeout):
+        key = (ip, port)
+        lock = self._connect_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            conn = self._connections.get(key)
+            if conn is None or conn.closed:
+                try:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+                except asyncio.TimeoutError:
+                    raise dns.exception.Timeout(timeout=timeout)
+                conn = self._connections[key] = _TCPConnection(reader, writer)
+            return conn
+
+    async def query(self, req: dns.message.Message, ip, timeout=1, port=None):
+        port = port or DNS_PORT
+        conn = await self._connection(ip, port, timeout)
+        try:
+            return await conn.query(req, timeout)
+        except ConnectionError:
+            if conn.closed:  # the server closed an idle connection under us, retry once on a fresh one
+                conn = await self._connection(ip, port, timeout)
+                return await conn.query(req, timeout)
+            raise
+
+    def close(self):
+        for conn in self._connections.values():
+            conn.close()
+        self._connections = {}
+
+
+_tcp_pools = weakref.WeakKeyDictionary()  # {event loop: TCPConnectionPool}
+
+
+def get_tcp_pool():
+    loop = asyncio.get_running_loop()
+    pool = _tcp_pools.get(loop)
+    if pool is None:
+        pool = _tcp_pools[loop] = TCPConnectionPool()
+    return pool
+
+
+_truncating = set()  # {(ip, rdtype)} answered truncated over UDP before, asked over TCP right away next time
+
+
+async def query(req: dns.message.Message, ip, timeout=1, port=None, retry=0):
+    """Send req over UDP, falling back to the pooled TCP connection of the server if the answer is truncated."""
+    key = (ip, req.question[0].rdtype)
+    if key in _truncating:
+        return await _traced_query(get_tcp_pool(), 'tcp', req, ip, timeout, port, retry)
+    resp = await _traced_query(get_udp_pool(), 'udp', req, ip, timeout, port, retry)
+    if resp.flags & dns.flags.TC:
+        _truncating.add(key)
+        resp = await _traced_query(get_tcp_pool(), 'tcp', req, ip, timeout, port, retry)
+    return resp
+
+
+def reset_server_state():
+    """Forget what was learnt about the servers: SRTTs, truncating servers and pooled TCP connections."""
+    server_rtt.clear()
+    _truncating.clear()
+    for loop, pool in list(_tcp_pools.items()):
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(pool.close)  # on its own loop, before any query submitted after this call
+    _tcp_pools.clear()
+
+
+async def _traced_query(pool, transport, req, ip, timeout, port, retry):
+    trace = current_trace.get()
+    if trace is None:
+        return await pool.query(req, ip, timeout=timeout, port=port)
+    start_time = time.monotonic()
+    try:
+        resp = await pool.query(req, ip, timeout=timeout, port=port)
+    except BaseException as e:  # also record the queries cancelled by race_query
+        trace.add_query(ip, req, transport, time.monotonic() - start_time, retry, error=e)
+        raise
+    trace.add_query(ip, req, transport, time.monotonic() - start_time, retry, size=len(resp.to_wire()))
+    return resp
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+async def _with_trace(coro, trace):
+    current_trace.set(trace)
+    return await coro
+
+
+def run_sync(coro):
+    """
+    Run coro on the background resolver loop and wait for its result, for the synchronous entry points.
+    The trace of the calling thread is carried over to the loop.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='dns-transport', daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(_with_trace(coro, current_trace.get()), _loop).result()
+
+
+async def race_query(ipv4_list, make_request, timeout, race_delay=0.2, condition=lambda x: True, on_error=None):
+    """
+    Happy-eyeballs style racing over ipv4_list, ordered by SRTT: the fastest server is queried at once and the next one is started
+    every race_delay seconds (or as soon as a query fails) while no valid answer has arrived.
+    Return (ip, resp) of the first response accepted by condition, the queries still in flight are cancelled.
+    race_delay=None queries the servers one after another.
+    """
+    ip_iter = enumerate(server_rtt.order(ipv4_list))  # (number of servers tried before, ip)
+    in_flight = {}  # {task: ip}
+
+    def launch_next():
+        for retry, ip in ip_iter:
+            task = asyncio.ensure_future(query(make_request(), ip, timeout=timeout, retry=retry))
+            in_flight[task] = ip
+            return True
+        return False
+
+    try:
+        launch_next()
+        while len(in_flight) > 0:
+            done, _ = await asyncio.wait(in_flight.keys(), timeout=race_delay, return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 0:  # nobody answered within race_delay, start racing the next server
+                launch_next()
+                continue
+            for task in done:
+                ip = in_flight.pop(task)
+                try:
+                    resp = task.result()
+                    if condition(resp):
+                        return ip, resp
+                    error = Exception('response rejected')
+                except Exception as e:
+                    error = e
+                if on_error is not None:
+                    on_error(ip, error)
+            launch_next()  # a query failed, start the next server without waiting
+    finally:
+        for task in in_flight:
+            task.cancel()
+    return None
@@ -4,18 +4,24 @@
 @author: Yiyun Yang
 @time: 2021/9/21 20:01
 """
+import argparse
+import concurrent.futures
+import functools
+import os
 import sys
 import time
 
 import dns.name
 import dns.message
-import dns.query
 import dns.rdataclass
 import dns.rdatatype
 import dns.dnssec
-import random
 from dns.rrset import RRset
 
+from dns_cache import DNSCache
+from dns_trace import QueryTrace, current_trace, trace_cache, trace_verify
+from dns_transport import race_query, run_sync
+
 
 class DNSSec_Exception(Exception):
     def __init__(self, message="Salary is not in (5000, 15000) range"):
@@ -27,6 +33,8 @@ root_server_list = ['198.41.0.4', '199.9.14.201', '192.33.4.12', '199.7.91.13',
                     '192.112.36.4', '198.97.190.53', '192.36.148.17', '192.58.128.30', '193.0.14.129',
                     '199.7.83.42', '202.12.27.33']
 
+RACE_DELAY = 0.4  # seconds to wait for a server before racing the next one
+
 # keys are copied from https://data.iana.org/root-anchors/root-anchors.xml
 root_algorithm = dns.dnssec.DSDigest.SHA256
 root_anchors = []  # every item is a DS record
@@ -34,22 +42,49 @@ for anchor in ["19036 8 2 49AAC11D7B6F6446702E54A1607371607A1A41855200FD2CE1CDDE
                "20326 8 2 E06D44B80B8F1D39A95C0B0D7C65D08458E880409BBC683457104237C7F8EC8D"]:
     root_anchors.append(dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.DS, anchor))
 
+# validated DNSKEY and DS RRsets of every zone cut, {(zone, DNSKEY/DS): RRset}, bounded by TTL and RRSIG expiration
+validated_cache = DNSCache()
+# batches smaller than this are verified inline
+VERIFY_POOL_MIN_BATCH = 16
 
-def sec_resolver(cur_domain, cur_type: dns.rdatatype, result_list, key_dict):
-    random.shuffle(root_server_list)  # shuffle root_server list, so that it can be visited randomly
 
-    # 0. query for root server's KSK and verify itself
-    root_ip, root_dnskey_resp = issue_dnssec_request(root_server_list, dns.rdatatype.DNSKEY, ".",
-                                                     lambda x: len(x.answer) > 0)
-    verify_zone(root_dnskey_resp.answer, root_anchors, key_dict)
-    verify_record(root_dnskey_resp.answer, key_dict)
+def sec_resolver(cur_domain, cur_type: dns.rdatatype, result_list, key_dict=None, batch=None,
+                 trace: QueryTrace = None):
+    if batch is None:   # top-level call, every signature met along the resolution is verified at the end at once
+        if key_dict is None:    # keys of earlier resolutions come from validated_cache, and expire with it
+            key_dict = {}
+        token = current_trace.set(trace) if trace is not None else None
+        try:
+            batch = VerifyBatch()
+            working_keys = dict(key_dict)   # keys are only trusted by key_dict once the whole batch is verified
+            answer_list = []
+            sec_resolver(cur_domain, cur_type, answer_list, working_keys, batch)
+            batch.verify()
+            key_dict.update(working_keys)
+            result_list.extend(answer_list)
+        finally:
+            if token is not None:
+                current_trace.reset(token)
+        return trace
+
+    # 0. query for root server's KSK and verify itself, root servers are tried in SRTT order
+    root_ip_list = root_server_list
+    if not load_validated_keys(dns.name.root, key_dict):   # root KSK is not cached or expired
+        root_ip, root_dnskey_resp = issue_dnssec_request(root_server_list, dns.rdatatype.DNSKEY, ".",
+                                                         lambda x: len(x.answer) > 0)
+        start_time = time.perf_counter()
+        verify_zone(root_dnskey_resp.answer, root_anchors, key_dict)
+        trace_verify(dns.name.root, 'DS digest', start_time)
+        verify_record(root_dnskey_resp.answer, key_dict, batch)
+        on_verified(batch, cache_validated, dns.name.root, root_dnskey_resp.answer, dns.rdatatype.DNSKEY)
+        root_ip_list = [root_ip]
 
     # 1. issue request to root server
     #   1.1 query root server for non-secured referrals, DS, and their related RRSIG.
-    _, root_resp = issue_dnssec_request([root_ip], cur_type, cur_domain)
+    _, root_resp = issue_dnssec_request(root_ip_list, cur_type, cur_domain)
     #   1.2 start the dnssec verification
     tld_ip_list = to_ipv4_list(root_resp.additional)
-    authenticate(root_resp, tld_ip_list, key_dict)
+    authenticate(root_resp, tld_ip_list, key_dict, batch)
 
     # 2. issue request to TLD
     tld_ip, tld_resp = issue_dnssec_request(tld_ip_list, cur_type, cur_domain)
@@ -60,52 +95,88 @@ def sec_resolver(cur_domain, cur_type: dns.rdatatype, result_list, key_dict):
         if len(prev_resp.answer) != 0:  # answer is returned but contains only CNAME
             result_list.append(prev_resp.answer)  # add current answer to result_list
             if cur_type == dns.rdatatype.A:  # resolve CNAME, only when query_type is A, otherwise return answer.
-                sec_resolver(get_cname(prev_resp.answer), cur_type, result_list, key_dict)
+                sec_resolver(get_cname(prev_resp.answer), cur_type, result_list, key_dict, batch)
             return
 
         if len(prev_resp.additional) > 0:  # answer is empty, query by additional info
             ns_ipv4_list = to_ipv4_list(prev_resp.additional)
-            authenticate(prev_resp, ns_ipv4_list, key_dict)     # dnssec verification
+            authenticate(prev_resp, ns_ipv4_list, key_dict, batch)     # dnssec verification
             _, prev_resp = issue_dnssec_request(ns_ipv4_list, cur_type, cur_domain)
         else:
             ns_result_list = []  # additional is empty, query by authoritative server
             authority_domain = get_authority_domain(prev_resp)
             if authority_domain is None:
                 return
-            sec_resolver(authority_domain, dns.rdatatype.A, ns_result_list, key_dict)
+            sec_resolver(authority_domain, dns.rdatatype.A, ns_result_list, key_dict, batch)
             ns_ipv4_list = to_ipv4_list(ns_result_list[-1])
-            authenticate(prev_resp, ns_ipv4_list, key_dict)  # dnssec verification
+            authenticate(prev_resp, ns_ipv4_list, key_dict, batch)  # dnssec verification
             _, prev_resp = issue_dnssec_request(ns_ipv4_list, cur_type, cur_domain)
     result_list.append(prev_resp.answer)
 
 
-def authenticate(prev_resp, next_ip_list, key_dict):
+def authenticate(prev_resp, next_ip_list, key_dict, batch=None):
     #   0 check if DS record exist
     prev_ds_list = to_ds_list(prev_resp.authority)
     if len(prev_ds_list) == 0:
         raise DNSSec_Exception(f'“DNSSEC not supported')
-    #   1 query for sub zone's DNS key
-    _, dnskey_resp = issue_dnssec_request(next_ip_list, dns.rdatatype.DNSKEY, get_authority_name(prev_resp),
-                                              lambda x: len(x.answer) > 0)
-    #   2 compare sub zone's key's hashing with prev_resp's DS record
+    zone = get_authority_name(prev_resp)
+    #   1 verify prev_resp's DS RRSIG with parent zone's public key, unless the same DS set was validated before
+    if not is_validated(zone, prev_resp.authority, dns.rdatatype.DS):
+        verify_record(prev_resp.authority, key_dict, batch)
+        on_verified(batch, cache_validated, zone, prev_resp.authority, dns.rdatatype.DS)
+    #   2 sub zone's key is already validated against this DS chain (or queued in this batch), nothing more to fetch
+    if load_validated_keys(zone, key_dict) or (batch is not None and zone in batch.zones):
+        return
+    #   3 query for sub zone's DNS key
+    _, dnskey_resp = issue_dnssec_request(next_ip_list, dns.rdatatype.DNSKEY, zone, lambda x: len(x.answer) > 0)
+    #   4 compare sub zone's key's hashing with prev_resp's DS record
+    start_time = time.perf_counter()
     verify_zone(dnskey_resp.answer, prev_ds_list, key_dict)
-    #   3 verify sub zone's RRSIG with its own key
-    verify_record(dnskey_resp.answer, key_dict)
-    #   4 verify prev_resp's DS RRSIG with sub zone's public key
-    verify_record(prev_resp.authority, key_dict)
+    trace_verify(zone, 'DS digest', start_time)
+    #   5 verify sub zone's RRSIG with its own key
+    verify_record(dnskey_resp.answer, key_dict, batch)
+    on_verified(batch, cache_validated, zone, dnskey_resp.answer, dns.rdatatype.DNSKEY)
+    if batch is not None:
+        batch.zones.add(zone)
 
 
-def issue_dnssec_request(ipv4_list, query_type, query_domain, condition=lambda x: True):
-    for ip in ipv4_list:
-        try:
-            # increase payload size so that response will not be truncated
-            req = dns.message.make_query(query_domain, query_type, payload=4096, request_payload=4096, want_dnssec=True)
-            res = dns.query.udp(req, ip, timeout=15)
-            if condition(res):
-                return ip, res
-        except Exception as e:
-            print(f'query ip {ip} domain {query_domain} type {dns.rdatatype.to_text(query_type)} failed: {e}')
-    raise DNSSec_Exception(f'Request {query_domain} for all Servers failed')
+def cache_validated(zone, rr_set_list, rdtype):
+    """Cache the validated rdtype RRset of zone until its TTL or the expiration of its RRSIG, whichever is first."""
+    rr_set = find_rr_set(rr_set_list, rdtype)
+    ttl = rr_set.ttl
+    for rr_sig in rr_set_list:
+        if rr_sig.rdtype == dns.rdatatype.RRSIG and rr_sig.covers == rdtype:
+            ttl = min(ttl, min(sig.expiration for sig in rr_sig.items) - int(time.time()))
+    validated_cache.put(zone, rdtype, rr_set, ttl)
+
+
+def is_validated(zone, rr_set_list, rdtype):
+    cached = trace_cache(zone, rdtype, validated_cache.get(zone, rdtype), 'dnssec')
+    return cached is not None and cached == find_rr_set(rr_set_list, rdtype)
+
+
+def load_validated_keys(zone, key_dict):
+    """Put zone's cached DNSKEY RRset into key_dict, return False if it is not cached or expired."""
+    dnskey_rr_set = trace_cache(zone, dns.rdatatype.DNSKEY, validated_cache.get(zone, dns.rdatatype.DNSKEY), 'dnssec')
+    if dnskey_rr_set is None:
+        return False
+    key_dict[dnskey_rr_set.name] = dnskey_rr_set
+    return True
+
+
+def issue_dnssec_request(ipv4_list, query_type, query_domain, condition=lambda x: True, race_delay=RACE_DELAY):
+    def make_request():
+        # increase payload size so that response will not be truncated
+        return dns.message.make_query(query_domain, query_type, payload=4096, request_payload=4096, want_dnssec=True)
+
+    def on_error(ip, e):
+        print(f'query ip {ip} domain {query_domain} type {dns.rdatatype.to_text(query_type)} failed: {e}')
+
+    result = run_sync(race_query(ipv4_list, make_request, timeout=15, race_delay=race_delay, condition=condition,
+                                 on_error=on_error))
+    if result is None:
+        raise DNSSec_Exception(f'Request {query_domain} for all Servers failed')
+    return result
 
 
 def verify_zone(rr_set_list, previous_ds_list, key_dict):
@@ -113,14 +184,20 @@ def verify_zone(rr_set_list, previous_ds_list, key_dict):
         if rr_set.rdtype == dns.rdatatype.DNSKEY:
             for item in rr_set.items:
                 for prev_ds in previous_ds_list:        # transform DNSKEY to a DS
-                    cur_ds = dns.dnssec.make_ds(rr_set.name, item, prev_ds.digest_type)
-                    if cur_ds.to_text() == prev_ds.to_text():        # compare it with the previous DS
+                    cur_ds = make_ds(rr_set.name, item, prev_ds.digest_type)
+                    if cur_ds == prev_ds:        # compare it with the previous DS, rdata compares in wire format
                         key_dict[rr_set.name] = rr_set  # name key pair is then put to the dict after verification
                         return
     raise DNSSec_Exception("Zone verification failed. ")
 
 
-def verify_record(rr_set_list, key_dict):
+@functools.lru_cache(maxsize=4096)
+def make_ds(name, dnskey, digest_type):
+    """dns.dnssec.make_ds memoized per key, a zone's DNSKEY is hashed once however many DS it is checked against."""
+    return dns.dnssec.make_ds(name, dnskey, digest_type)
+
+
+def verify_record(rr_set_list, key_dict, batch=None):
     rrsigset = None
     for rr_set in rr_set_list:
         if rr_set.rdtype == dns.rdatatype.RRSIG:
@@ -131,7 +208,87 @@ def verify_record(rr_set_list, key_dict):
         if rr_set.rdtype == rrsigset.covers:
             rrset = rr_set
 
-    dns.dnssec.validate(rrset, rrsigset, key_dict)
+    if batch is None:
+        start_time = time.perf_counter()
+        dns.dnssec.validate(rrset, rrsigset, key_dict)
+        trace_verify(rrset.name, f'RRSIG {dns.rdatatype.to_text(rrset.rdtype)}', start_time)
+    else:   # only the signer keys are handed over, the batch may be shipped to other processes
+        signer_keys = {sig.signer: key_dict[sig.signer] for sig in rrsigset.items if sig.signer in key_dict}
+        batch.add(rrset, rrsigset, signer_keys)
+
+
+def validate_task(task):
+    """Verify one (RRset, RRSIG, keys) tuple, return (None or the reason of the failure, seconds spent)."""
+    rrset, rrsigset, keys = task
+    start_time = time.perf_counter()
+    try:
+        dns.dnssec.validate(rrset, rrsigset, keys)
+        return None, time.perf_counter() - start_time
+    except (dns.dnssec.ValidationFailure, dns.dnssec.UnsupportedAlgorithm) as e:
+        return f'{rrset.name} {dns.rdatatype.to_text(rrset.rdtype)}: {e}', time.perf_counter() - start_time
+
+
+class VerifyBatch(object):
+    """
+    The (RRset, RRSIG, keys) tuples met along one resolution, verified together once it is done.
+    Large batches are spread over a process pool, small ones are verified inline as the IPC would cost more.
+    """
+
+    def __init__(self):
+        self.tasks = []
+        self.zones = set()  # zones whose DNSKEY RRset is queued in this batch
+        self._callbacks = []  # run once every signature of the batch is verified
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, rrset, rrsigset, keys):
+        self.tasks.append((rrset, rrsigset, keys))
+
+    def on_success(self, func, *args):
+        self._callbacks.append((func, args))
+
+    def verify(self):
+        if len(self.tasks) >= VERIFY_POOL_MIN_BATCH:
+            pool = get_verify_pool()
+            results = list(pool.map(validate_task, self.tasks, chunksize=max(1, len(self.tasks) // os.cpu_count())))
+        else:
+            results = [validate_task(task) for task in self.tasks]
+        trace = current_trace.get()
+        for (rrset, _, _), (_, seconds) in zip(self.tasks, results):
+            if trace is not None:
+                trace.add_verify(rrset.name, f'RRSIG {dns.rdatatype.to_text(rrset.rdtype)}', seconds)
+        for error, _ in results:
+            if error is not None:
+                raise dns.dnssec.ValidationFailure(error)
+        self.tasks = []
+        for func, args in self._callbacks:
+            func(*args)
+        self._callbacks = []
+
+
+def on_verified(batch, func, *args):
+    """Run func(*args) once batch is verified, or right away when signatures are verified inline."""
+    if batch is None:
+        func(*args)
+    else:
+        batch.on_success(func, *args)
+
+
+_verify_pool = None
+
+
+def get_verify_pool():
+    global _verify_pool
+    if _verify_pool is None:
+        _verify_pool = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _verify_pool
+
+
+def find_rr_set(rr_set_list, rdtype):
+    for rr_set in rr_set_list:
+        if rr_set.rdtype == rdtype:
+            return rr_set
 
 
 def an_item_to_text(rr_set: RRset):
@@ -177,12 +334,19 @@ def check_ans(query_type: dns.rdatatype, resp):
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Iterative DNSSEC resolver')
+    parser.add_argument('domain')
+    parser.add_argument('rdtype')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write the JSON trace of every upstream query and verification to FILE ("-" for stdout)')
+    args = parser.parse_args()
+    trace = QueryTrace() if args.trace is not None else None
     try:
-        query_domain = sys.argv[1]
-        rdtype = sys.argv[2]
+        query_domain = args.domain
+        rdtype = args.rdtype
         start_time = time.time()
         result_list = []
-        sec_resolver(query_domain, dns.rdatatype.from_text(rdtype), result_list, {})
+        sec_resolver(query_domain, dns.rdatatype.from_text(rdtype), result_list, trace=trace)
         end_time = time.time()
 
         output = [f'QUESTION SECTION:\n{query_domain}			IN	{rdtype}\n', "ANSWER SECTION: "]
@@ -207,7 +371,8 @@ def main():
         print(f'DNSSec verification failed')
     except:
         print(f'DNSSEC not supported')
-
+    if trace is not None:
+        trace.write(args.trace)
 
 
 if __name__ == "__main__":
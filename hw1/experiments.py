@@ -45,12 +45,13 @@ def experiments():
                     fun(website)
                     end_time = time.time()
                     time_costs.append(end_time - start_time)
-                except:
-                    continue
-            time_avg_list.append(int(mean(time_costs) * 1000))
+                except Exception as e:
+                    print(f'{label_list[i]} {website} failed: {e}')
+            # websites that failed every time have no average, they are left out of the CDF
+            time_avg_list.append(int(mean(time_costs) * 1000) if len(time_costs) > 0 else None)
         time_avg_all.append(time_avg_list)
-        x = np.sort(time_avg_list)
-        y = 1. * np.arange(len(time_avg_list)) / (len(time_avg_list) - 1)
+        x = np.sort([avg for avg in time_avg_list if avg is not None])
+        y = 1. * np.arange(len(x)) / max(len(x) - 1, 1)
         plt.plot(x, y, label=label_list[i])
     plt.ylabel('Pr[X<x]')
     plt.xlabel('Average time in msec')
@@ -65,7 +66,7 @@ def experiments():
     for i in range(25):
         l = [top_25_list[i]]
         for avgs in time_avg_all:
-            l.append(avgs[i])
+            l.append(avgs[i] if avgs[i] is not None else 'failed')
         table.add_row(l)
     print(table)
 
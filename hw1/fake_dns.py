@@ -0,0 +1,248 @@
+# -*- coding:utf-8 -*-
+
+"""
+@author: Yiyun Yang
+"""
+import asyncio
+import random
+import threading
+
+import dns.dnssec
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+from cryptography.hazmat.primitives.asymmetric import ec
+
+# every zone is signed with one ECDSA P-256 key (KSK and ZSK at once), cheap to generate and sign with
+ALGORITHM = dns.dnssec.Algorithm.ECDSAP256SHA256
+
+
+class FakeZone(object):
+    """An authoritative zone: its own records plus delegations to child zones."""
+
+    def __init__(self, origin, signed=True, ttl=3600):
+        self.origin = dns.name.from_text(origin)
+        self.ttl = ttl
+        self.records = {}  # {(name, rdtype): RRset}
+        self.delegations = {}  # {child origin: (NS RRset, DS RRset, glue A RRsets)}
+        self.signatures = {}  # {(name, rdtype): RRSIG RRset}
+        self.private_key = None
+        self.dnskey = None
+        if signed:
+            self.private_key = ec.generate_private_key(ec.SECP256R1())
+            self.dnskey = dns.dnssec.make_dnskey(self.private_key.public_key(), ALGORITHM, flags=257)
+            self.add(self.origin, dns.rdatatype.DNSKEY, self.dnskey.to_text())
+        soa_text = f'{dns.name.from_text("ns", self.origin)} {dns.name.from_text("admin", self.origin)} 1 7200 900 86400 60'
+        self.add(self.origin, dns.rdatatype.SOA, soa_text)
+
+    def add(self, name, rdtype, *texts, ttl=None):
+        name = dns.name.from_text(name, self.origin) if isinstance(name, str) else name
+        rr_set = dns.rrset.from_text(name, ttl or self.ttl, dns.rdataclass.IN, rdtype, *texts)
+        self.records[(name, rr_set.rdtype)] = rr_set
+        self._sign(rr_set)
+
+    def delegate(self, child, ns_list, glue=True):
+        """Delegate child zone to ns_list [(ns name, ip)], with glue A records in referrals if glue is set."""
+        ns_rr_set = dns.rrset.from_text(child.origin, self.ttl, dns.rdataclass.IN, dns.rdatatype.NS,
+                                        *[ns_name for ns_name, _ in ns_list])
+        glue_list = [dns.rrset.from_text(ns_name, self.ttl, dns.rdataclass.IN, dns.rdatatype.A, ip)
+                     for ns_name, ip in ns_list] if glue else []
+        ds_rr_set = None
+        if child.dnskey is not None:
+            ds = dns.dnssec.make_ds(child.origin, child.dnskey, dns.dnssec.DSDigest.SHA256)
+            ds_rr_set = dns.rrset.from_rdata(child.origin, self.ttl, ds)
+            self._sign(ds_rr_set)
+        self.delegations[child.origin] = (ns_rr_set, ds_rr_set, glue_list)
+
+    def _sign(self, rr_set):
+        if self.private_key is None:
+            return
+        rr_sig = dns.dnssec.sign(rr_set, self.private_key, self.origin, self.dnskey, lifetime=86400 * 30)
+        self.signatures[(rr_set.name, rr_set.rdtype)] = dns.rrset.from_rdata(rr_set.name, rr_set.ttl, rr_sig)
+
+    def _append(self, section, rr_set, want_dnssec):
+        section.append(rr_set)
+        rr_sig = self.signatures.get((rr_set.name, rr_set.rdtype))
+        if want_dnssec and rr_sig is not None:
+            section.append(rr_sig)
+
+    def answer(self, query):
+        resp = dns.message.make_response(query)
+        resp.flags |= dns.flags.AA
+        want_dnssec = bool(query.ednsflags & dns.flags.DO)
+        qname = query.question[0].name
+        qtype = query.question[0].rdtype
+        for child, (ns_rr_set, ds_rr_set, glue_list) in self.delegations.items():
+            if qname.is_subdomain(child):  # referral
+                resp.flags &= ~dns.flags.AA
+                resp.authority.append(ns_rr_set)
+                if ds_rr_set is not None:
+                    self._append(resp.authority, ds_rr_set, want_dnssec)
+                resp.additional.extend(glue_list)
+                return resp
+        if (qname, qtype) in self.records:
+            self._append(resp.answer, self.records[(qname, qtype)], want_dnssec)
+        elif (qname, dns.rdatatype.CNAME) in self.records:
+            self._append(resp.answer, self.records[(qname, dns.rdatatype.CNAME)], want_dnssec)
+        else:
+            if not any(name == qname for name, _ in self.records):
+                resp.set_rcode(dns.rcode.NXDOMAIN)
+            self._append(resp.authority, self.records[(self.origin, dns.rdatatype.SOA)], want_dnssec)
+        return resp
+
+
+class _ServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        server = self.server
+        server.queries += 1
+        if server.dead or random.random() < server.loss:
+            return
+        try:
+            query = dns.message.from_wire(data)
+        except Exception:
+            return
+        resp = server.zone.answer(query)
+        wire = resp.to_wire()
+        udp_limit = min(server.udp_limit, max(512, query.payload) if query.edns >= 0 else 512)
+        if len(wire) > udp_limit:  # does not fit, send an empty truncated answer so the client retries over TCP
+            resp = dns.message.make_response(query)
+            resp.flags |= dns.flags.TC
+            wire = resp.to_wire()
+        asyncio.get_running_loop().call_later(server.delay(), self.transport.sendto, wire, addr)
+
+
+async def _serve_tcp(server, reader, writer):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:  # queries may be pipelined, each one is answered after its own delay
+            length = int.from_bytes(await reader.readexactly(2), 'big')
+            data = await reader.readexactly(length)
+            server.queries += 1
+            if server.dead:
+                continue
+            wire = server.zone.answer(dns.message.from_wire(data)).to_wire()
+            loop.call_later(server.delay(), writer.write, len(wire).to_bytes(2, 'big') + wire)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        writer.close()
+
+
+class FakeServer(object):
+    """One nameserver IP serving one zone over UDP and TCP, with configurable latency, jitter and loss."""
+
+    def __init__(self, ip, zone, latency=0.0, jitter=0.0, loss=0.0, dead=False, udp_limit=4096):
+        self.ip = ip
+        self.zone = zone
+        self.latency = latency  # seconds
+        self.jitter = jitter
+        self.loss = loss  # probability of dropping a UDP query
+        self.dead = dead
+        self.udp_limit = udp_limit  # larger UDP answers are truncated
+        self.queries = 0
+        self.transport = None
+        self.tcp_server = None
+
+    def delay(self):
+        return self.latency + random.uniform(0, self.jitter)
+
+
+class FakeHierarchy(object):
+    """
+    A root -> TLD -> domain hierarchy of fake servers listening on 127.0.0.0/8, run on a background thread.
+
+    shape: n_tld TLDs, n_domain domains per TLD, n_host hosts per domain (host0..), ns_per_zone servers per zone.
+    A cname_ratio share of the domains alias www to host0, a glueless_ratio share are delegated without glue
+    to a nameserver living under another domain.
+    """
+
+    def __init__(self, n_tld=3, n_domain=10, n_host=5, ns_per_zone=2, cname_ratio=0.2, glueless_ratio=0.1,
+                 signed=True, latency=0.005, jitter=0.002, loss=0.0, dead_ratio=0.0, udp_limit=4096, port=5300,
+                 seed=534):
+        self.port = port
+        self.servers = []
+        self.root_ip_list = []
+        self.names = []  # host names that resolve to an A record
+        self._rnd = random.Random(seed)
+        self._next_ip = 1
+        self._server_args = dict(latency=latency, jitter=jitter, loss=loss, udp_limit=udp_limit)
+        self.dead_ratio = dead_ratio
+        self._loop = None
+
+        self.root = FakeZone('.', signed)
+        self.root_ip_list = self._add_servers(self.root, ns_per_zone)
+        for t in range(n_tld):
+            tld = FakeZone(f'tld{t}.', signed)
+            tld_ip_list = self._add_servers(tld, ns_per_zone)
+            self.root.delegate(tld, [(f'ns{i}.nic.tld{t}.', ip) for i, ip in enumerate(tld_ip_list)])
+            domain0 = None
+            for d in range(n_domain):
+                domain = FakeZone(f'domain{d}.tld{t}.', signed)
+                domain_ip_list = self._add_servers(domain, ns_per_zone)
+                for h in range(n_host):
+                    domain.add(f'host{h}', dns.rdatatype.A, f'10.{t}.{d}.{h}')
+                    self.names.append(f'host{h}.domain{d}.tld{t}.')
+                if self._rnd.random() < cname_ratio:
+                    domain.add('www', dns.rdatatype.CNAME, f'host0.domain{d}.tld{t}.')
+                    self.names.append(f'www.domain{d}.tld{t}.')
+
+                if d == 0:
+                    domain0 = domain
+                if d > 0 and self._rnd.random() < glueless_ratio:
+                    # glueless: the nameservers are named under domain0, the resolver has to look them up first
+                    ns_list = [(f'ns-domain{d}-{i}.domain0.tld{t}.', ip) for i, ip in enumerate(domain_ip_list)]
+                    for ns_name, ip in ns_list:
+                        domain0.add(ns_name, dns.rdatatype.A, ip)
+                    tld.delegate(domain, ns_list, glue=False)
+                else:
+                    ns_list = [(f'ns{i}.domain{d}.tld{t}.', ip) for i, ip in enumerate(domain_ip_list)]
+                    for ns_name, ip in ns_list:
+                        domain.add(ns_name, dns.rdatatype.A, ip)
+                    tld.delegate(domain, ns_list)
+
+    def _add_servers(self, zone, n):
+        ip_list = []
+        for _ in range(n):
+            ip = f'127.0.{self._next_ip // 250}.{self._next_ip % 250 + 2}'
+            self._next_ip += 1
+            dead = self._rnd.random() < self.dead_ratio and zone.origin != dns.name.root
+            self.servers.append(FakeServer(ip, zone, dead=dead, **self._server_args))
+            ip_list.append(ip)
+        return ip_list
+
+    @property
+    def root_anchors(self):
+        return [dns.dnssec.make_ds(dns.name.root, self.root.dnskey, dns.dnssec.DSDigest.SHA256)]
+
+    @property
+    def queries(self):
+        return sum(server.queries for server in self.servers)
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name='fake-dns', daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._listen(), self._loop).result()
+        return self
+
+    async def _listen(self):
+        loop = asyncio.get_running_loop()
+        for server in self.servers:
+            server.transport, _ = await loop.create_datagram_endpoint(lambda s=server: _ServerProtocol(s),
+                                                                      local_addr=(server.ip, self.port))
+            server.tcp_server = await asyncio.start_server(lambda r, w, s=server: _serve_tcp(s, r, w),
+                                                           server.ip, self.port)
+
+    def stop(self):
+        for server in self.servers:
+            self._loop.call_soon_threadsafe(server.transport.close)
+            self._loop.call_soon_threadsafe(server.tcp_server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
@@ -4,15 +4,23 @@
 @author: Yiyun Yang
 @time: 2021/9/21 13:21
 """
+import argparse
+import asyncio
+import contextvars
+import json
 import sys
 import time
+import weakref
 
 import dns.name
 import dns.message
-import dns.query
+import dns.rcode
 import dns.rdataclass
 import dns.rdatatype
-import random
+
+from dns_cache import resolution_cache, to_name, is_negative, NEGATIVE
+from dns_trace import QueryTrace, current_trace, trace_cache
+from dns_transport import race_query, run_sync
 
 
 # this list is copied from www.iana.org/domains/root/servers
@@ -20,47 +28,147 @@ root_server_list = ['198.41.0.4', '199.9.14.201', '192.33.4.12', '199.7.91.13',
                     '192.112.36.4', '198.97.190.53', '192.36.148.17', '192.58.128.30', '193.0.14.129',
                     '199.7.83.42', '202.12.27.33']
 
+RACE_DELAY = 0.2  # seconds to wait for a server before racing the next one
+GLUELESS_PARALLEL = 3  # NS names of a glueless referral resolved at once
+SHARED_LOOKUP_TIMEOUT = 10  # seconds a shared NS name lookup may take, nested lookups included
+
+
+def dns_resolver(cur_domain, cur_type: dns.rdatatype, result_list, trace: QueryTrace = None):
+    """Synchronous resolve(), the answer sections are appended to result_list and the given trace is returned."""
+    result_list.extend(run_sync(resolve(cur_domain, cur_type, trace)))
+    return trace
+
+
+async def resolve(cur_domain, cur_type: dns.rdatatype = dns.rdatatype.A, trace: QueryTrace = None):
+    """
+    Resolve cur_domain iteratively from the root, return the answer sections (CNAME hops first).
+    Every upstream query and cache lookup is recorded on trace if one is given.
+    """
+    result_list = []
+    token = current_trace.set(trace) if trace is not None else None
+    try:
+        await _resolve(cur_domain, cur_type, result_list)
+    finally:
+        if token is not None:
+            current_trace.reset(token)
+    return result_list
 
-def dns_resolver(cur_domain, cur_type: dns.rdatatype, result_list):
-    random.shuffle(root_server_list)  # shuffle root_server list, so that it can be visited randomly
 
-    # 1. issue request to root server
-    root_resp = issue_request(root_server_list, cur_type, cur_domain)
-    # 2. issue request to TLD
-    tld_ip_list = to_ipv4_list(root_resp.additional)
-    tld_resp = issue_request(tld_ip_list, cur_type, cur_domain)
+async def _resolve(cur_domain, cur_type: dns.rdatatype, result_list):
+    cur_name = to_name(cur_domain)
 
-    # 3. issue request to Name Server
-    prev_resp = tld_resp
+    # 0. serve the answer from cache if it is still alive
+    cached = trace_cache(cur_name, cur_type, resolution_cache.get(cur_name, cur_type))
+    if cached is not None:
+        if cached is not NEGATIVE:
+            result_list.append(cached)
+        return
+    cname_rr_set = trace_cache(cur_name, dns.rdatatype.CNAME, resolution_cache.get(cur_name, dns.rdatatype.CNAME))
+    if cname_rr_set is not None and cur_type != dns.rdatatype.CNAME:
+        result_list.append([cname_rr_set])
+        await _resolve(an_item_to_text(cname_rr_set), cur_type, result_list)
+        return
+
+    # 1. issue request to the closest cached zone cut, or to root server if nothing is cached (fastest first)
+    referral = trace_cache(cur_name, dns.rdatatype.NS, resolution_cache.closest_referral(cur_name), 'referral')
+    if referral is not None:
+        prev_resp = await issue_request(referral.ipv4_list, cur_type, cur_domain)
+    else:
+        prev_resp = await issue_request(root_server_list, cur_type, cur_domain)
+
+    # 2. follow referrals (TLD, then Name Servers) until the answer is found
     while not check_ans(cur_type, prev_resp):
         if len(prev_resp.answer) != 0:      # answer is returned but contains only CNAME
+            resolution_cache.put_answer(cur_name, cur_type, prev_resp.answer)
             result_list.append(prev_resp.answer)    # add current answer to result_list
-            dns_resolver(get_cname(prev_resp.answer), cur_type, result_list)
+            await _resolve(get_cname(prev_resp.answer), cur_type, result_list)
             return
 
-        if len(prev_resp.additional) > 0:   # answer is empty, query by additional info
+        if len(to_ipv4_list(prev_resp.additional)) > 0:   # answer is empty, query by additional info
+            resolution_cache.put_referral(prev_resp)
             ns_ipv4_list = to_ipv4_list(prev_resp.additional)
-            prev_resp = issue_request(ns_ipv4_list, cur_type, cur_domain)
-        else:
-            ns_result_list = []              # additional is empty, query by authoritative server
-            authority_domain = get_authority_domain(prev_resp)
-            if authority_domain is None:
+            prev_resp = await issue_request(ns_ipv4_list, cur_type, cur_domain)
+        else:                                # additional is empty, query by authoritative server
+            authority_domains = get_authority_domains(prev_resp)
+            if len(authority_domains) == 0:
+                if not is_negative(prev_resp):
+                    raise Exception(f'{cur_domain}: response with no answer, referral nor SOA')
+                resolution_cache.put_negative(cur_name, cur_type, prev_resp)  # NXDOMAIN or NODATA
+                return
+            ns_ipv4_list = await resolve_first_address(authority_domains)
+            if len(ns_ipv4_list) == 0:
                 return
-            dns_resolver(authority_domain, dns.rdatatype.A, ns_result_list)
-            ns_ipv4_list = to_ipv4_list(ns_result_list[-1])
-            prev_resp = issue_request(ns_ipv4_list, cur_type, cur_domain)
+            resolution_cache.put_referral(prev_resp, ns_ipv4_list)
+            prev_resp = await issue_request(ns_ipv4_list, cur_type, cur_domain)
 
+    resolution_cache.put_answer(cur_name, cur_type, prev_resp.answer)
     result_list.append(prev_resp.answer)
 
 
-def issue_request(ipv4_list, query_type, query_domain):
-    for ip in ipv4_list:
-        try:
-            req = dns.message.make_query(query_domain, query_type)
-            return dns.query.udp(req, ip, timeout=1)
-        except Exception as e:
-            print(f'query ip {ip} domain {query_domain} type {dns.rdatatype.to_text(query_type)} failed: {e}')
-    raise Exception(f'Request {query_domain} for all Servers failed')
+async def resolve_first_address(ns_domains):
+    """
+    Resolve the A records of up to GLUELESS_PARALLEL NS names at once, return the addresses of the first one
+    that resolves. The lookups are shared, the ones still running go on for whoever else awaits them.
+    """
+    pending = [asyncio.ensure_future(resolve_shared(ns_domain, dns.rdatatype.A))
+               for ns_domain in ns_domains[:GLUELESS_PARALLEL]]
+    try:
+        for next_done in asyncio.as_completed(pending):
+            try:
+                ns_result_list = await next_done
+            except Exception:
+                continue
+            if len(ns_result_list) > 0 and len(to_ipv4_list(ns_result_list[-1])) > 0:
+                return to_ipv4_list(ns_result_list[-1])
+        return []
+    finally:
+        for task in pending:
+            task.cancel()   # only drops our interest, the shielded lookup itself keeps running
+
+
+_in_flight = weakref.WeakKeyDictionary()  # {event loop: {(name, rdtype): task}}
+# (name, rdtype) of the shared lookups the current resolution is nested in, inherited by the tasks it starts
+_lookup_chain = contextvars.ContextVar('lookup_chain', default=frozenset())
+
+
+async def resolve_shared(cur_domain, cur_type: dns.rdatatype):
+    """
+    resolve(), but concurrent callers asking for the same (name, rdtype) share one resolution.
+    A lookup needed by itself (a glueless NS named inside the zone it serves) fails at once instead of awaiting its
+    own task, and every shared lookup gives up after SHARED_LOOKUP_TIMEOUT, so lookups of different resolutions
+    waiting on each other cannot hang either.
+    """
+    in_flight = _in_flight.setdefault(asyncio.get_running_loop(), {})
+    key = (to_name(cur_domain), cur_type)
+    chain = _lookup_chain.get()
+    if key in chain:
+        raise Exception(f'{cur_domain} is needed to resolve itself (glueless delegation loop)')
+    task = in_flight.get(key)
+    if task is None:
+        token = _lookup_chain.set(chain | {key})
+        try:  # the task copies the context, chain included
+            task = in_flight[key] = asyncio.ensure_future(
+                asyncio.wait_for(resolve(cur_domain, cur_type), SHARED_LOOKUP_TIMEOUT))
+        finally:
+            _lookup_chain.reset(token)
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+_answer_rcodes = (dns.rcode.NOERROR, dns.rcode.NXDOMAIN)
+
+
+async def issue_request(ipv4_list, query_type, query_domain, race_delay=RACE_DELAY):
+    def on_error(ip, e):
+        print(f'query ip {ip} domain {query_domain} type {dns.rdatatype.to_text(query_type)} failed: {e}', file=sys.stderr)
+
+    # SERVFAIL, REFUSED...: a failure of that server, try the next one
+    result = await race_query(ipv4_list, lambda: dns.message.make_query(query_domain, query_type), timeout=1,
+                              race_delay=race_delay, condition=lambda resp: resp.rcode() in _answer_rcodes,
+                              on_error=on_error)
+    if result is None:
+        raise Exception(f'Request {query_domain} for all Servers failed')
+    return result[1]
 
 
 def an_item_to_text(rr_set: dns.rrset.RRset):
@@ -74,10 +182,11 @@ def get_cname(rr_set_list):
             return an_item_to_text(rr_set)
 
 
-def get_authority_domain(resp: dns.message.Message):
+def get_authority_domains(resp: dns.message.Message):
     for rr_set in resp.authority:
         if rr_set.rdtype == dns.rdatatype.NS or rr_set.rdtype == dns.rdatatype.CNAME:
-            return an_item_to_text(rr_set)
+            return [item.to_text() for item in rr_set.items]
+    return []
 
 
 def to_ipv4_list(rr_set_list):
@@ -91,32 +200,113 @@ def check_ans(query_type: dns.rdatatype, resp):
     return False
 
 
-def main():
-    query_domain = sys.argv[1]
-    rdtype = sys.argv[2]
-    start_time = time.time()
-    result_list = []
-    dns_resolver(query_domain, dns.rdatatype.from_text(rdtype), result_list)
-    end_time = time.time()
-
-    output = [f'QUESTION SECTION:\n{query_domain}			IN	{rdtype}\n', "ANSWER SECTION: "]
+def answer_lines(result_list):
+    lines = []
     for result in result_list:
         for rr_set in result:
             cur_name = rr_set.name
             cur_class = dns.rdataclass.to_text(rr_set.rdclass)
             cur_type = dns.rdatatype.to_text(rr_set.rdtype)
             for ans in rr_set.items.keys():
-                output.append(
+                lines.append(
                     f"{cur_name} {cur_class} {cur_type} {ans.to_text()}")
+    return lines
+
 
+def dig_output(query_domain, rdtype, result_list, start_time, end_time):
+    output = [f'QUESTION SECTION:\n{query_domain}			IN	{rdtype}\n', "ANSWER SECTION: "]
+    output.extend(answer_lines(result_list))
     output.append(f'\nQuery time: {int((end_time - start_time) * 1000)} msec')
     output.append(f'WHEN: {time.asctime(time.localtime(end_time))}\n')
+    return output
+
+
+async def bulk_resolve(in_file, out_file, concurrency=100, with_trace=False):
+    """
+    Resolve "domain [type]" lines of in_file with at most concurrency in flight, one JSON line per result.
+    The query trace of each resolution is added to its line if with_trace is set.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def resolve_one(query_domain, rdtype):
+        start_time = time.time()
+        error = None
+        trace = QueryTrace() if with_trace else None
+        try:
+            result_list = await resolve(query_domain, dns.rdatatype.from_text(rdtype), trace)
+        except Exception as e:
+            result_list = []
+            error = str(e)
+        end_time = time.time()
+        record = {'question': f'{query_domain} IN {rdtype}',
+                  'answer': answer_lines(result_list),
+                  'query_time_msec': int((end_time - start_time) * 1000),
+                  'when': time.asctime(time.localtime(end_time)),
+                  'msg_size': sum(len(o) for o in dig_output(query_domain, rdtype, result_list, start_time, end_time))}
+        if error is not None:
+            record['error'] = error
+        if trace is not None:
+            record['trace'] = trace.events
+        out_file.write(json.dumps(record) + '\n')
+        out_file.flush()
+
+    def on_done(task):
+        tasks.discard(task)
+        semaphore.release()
+
+    loop = asyncio.get_running_loop()
+    while True:
+        # read off the loop: waiting on a slow pipe must not stall the resolutions in flight
+        line = await loop.run_in_executor(None, in_file.readline)
+        if line == '':
+            break
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith('#'):
+            continue
+        await semaphore.acquire()   # input is read only as fast as resolutions finish
+        task = asyncio.ensure_future(resolve_one(fields[0], fields[1].upper() if len(fields) > 1 else 'A'))
+        task.add_done_callback(on_done)
+        tasks.add(task)
+    await asyncio.gather(*list(tasks))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Iterative DNS resolver')
+    parser.add_argument('domain', nargs='?')
+    parser.add_argument('rdtype', nargs='?', default='A')
+    parser.add_argument('--bulk', metavar='FILE',
+                        help='resolve "domain [type]" lines of FILE ("-" for stdin) and stream JSON lines')
+    parser.add_argument('--concurrency', type=int, default=100, help='max resolutions in flight in bulk mode')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write the JSON trace of every upstream query to FILE ("-" for stdout), '
+                             'in bulk mode any value adds the trace to each JSON line')
+    args = parser.parse_args()
+
+    if args.bulk is not None:
+        in_file = sys.stdin if args.bulk == '-' else open(args.bulk)
+        with in_file:
+            asyncio.run(bulk_resolve(in_file, sys.stdout, args.concurrency, args.trace is not None))
+        return
+    if args.domain is None:
+        parser.error('domain is required unless --bulk is given')
+
+    query_domain = args.domain
+    rdtype = args.rdtype
+    start_time = time.time()
+    result_list = []
+    trace = QueryTrace() if args.trace is not None else None
+    dns_resolver(query_domain, dns.rdatatype.from_text(rdtype), result_list, trace)
+    end_time = time.time()
 
+    output = dig_output(query_domain, rdtype, result_list, start_time, end_time)
     rcvd = 0
     for o in output:
         rcvd += len(o)
         print(o)
     print(f'MSG SIZE rcvd: {rcvd}')
+    if trace is not None:
+        trace.write(args.trace)
 
 
 if __name__ == "__main__":
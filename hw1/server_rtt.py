@@ -0,0 +1,55 @@
+# -*- coding:utf-8 -*-
+
+"""
+@author: Yiyun Yang
+"""
+import random
+
+
+class ServerRTT(object):
+    """
+    Smoothed round trip time of every nameserver IP, in the style of BIND and Unbound.
+
+    - a reply moves the SRTT towards the measured RTT: srtt = (1 - alpha) * srtt + alpha * rtt
+    - a timeout backs the SRTT off exponentially, up to max_srtt
+    - a server never measured starts with a random SRTT of a few msec, so every server gets tried once
+    - servers passed over by order() slowly decay, so a penalized server is eventually retried
+    """
+
+    def __init__(self, alpha=0.3, max_srtt=10.0, decay=0.98, explore=0.05):
+        self.alpha = alpha
+        self.max_srtt = max_srtt  # seconds
+        self.decay = decay
+        self.explore = explore  # probability of trying a random server first
+        self._srtt = {}  # {ip: srtt in seconds}
+
+    def get(self, ip):
+        if ip not in self._srtt:
+            self._srtt[ip] = random.uniform(0.001, 0.032)
+        return self._srtt[ip]
+
+    def update(self, ip, rtt):
+        if ip not in self._srtt:
+            self._srtt[ip] = rtt
+        else:
+            self._srtt[ip] = (1 - self.alpha) * self._srtt[ip] + self.alpha * rtt
+
+    def timeout(self, ip, timeout):
+        self._srtt[ip] = min(self.max_srtt, max(self.get(ip) * 2, timeout))
+
+    def order(self, ip_list):
+        """Return ip_list sorted by SRTT, the fastest first, with a random one promoted now and then."""
+        ip_list = sorted(ip_list, key=self.get)
+        if len(ip_list) > 1 and random.random() < self.explore:
+            i = random.randrange(1, len(ip_list))
+            ip_list.insert(0, ip_list.pop(i))
+        for ip in ip_list[1:]:
+            self._srtt[ip] *= self.decay
+        return ip_list
+
+    def clear(self):
+        self._srtt.clear()
+
+
+# shared by every resolver in the process, kept across calls
+server_rtt = ServerRTT()
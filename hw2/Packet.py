@@ -1,43 +1,112 @@
 # -*- coding:utf-8 -*-
 
 
+import mmap
 import struct
 import socket
+from bisect import bisect_left
+
+
+def compile_header(_header):
+    return struct.Struct('>' + ''.join([x[1] for x in _header]))  # '>' means the binary data is big-endian
 
 
 class Packet(object):
-    def __init__(self, _header, buf):
-        hdr_fmt = '>' + ''.join([x[1] for x in _header])  # '>' means the binary data is big-endian
-        hdr_fields = [x[0] for x in _header]
-        self.__hdr_len__ = struct.calcsize(hdr_fmt)
-        i = 0
-        for hdr_val in struct.unpack(hdr_fmt, buf[:self.__hdr_len__]):
-            setattr(self, hdr_fields[i], hdr_val)  # add header's field-keys to class's attributes
-            i += 1
+    """
+    Base of the header views. A view keeps a memoryview of the captured frame and unpacks its fixed header fields
+    with a struct compiled once per class; payload, addresses and options are only decoded when accessed.
+    """
+    __slots__ = ('_buf',)
+    __hdr_len__ = 0
+
+    def __init__(self, buf):
+        self._buf = buf if isinstance(buf, memoryview) else memoryview(buf)
 
-        self.data = buf[self.__hdr_len__:]
+    @property
+    def data(self):
+        return self._buf[self.__hdr_len__:]
 
 
+# link types of pcap / pcapng files
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101  # raw IPv4 or IPv6, told apart by the version field
+LINKTYPE_LINUX_SLL = 113  # Linux cooked capture ('any' interface), 16 bytes header
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276  # Linux cooked capture v2, 20 bytes header
+SUPPORTED_LINKTYPES = (LINKTYPE_ETHERNET, LINKTYPE_RAW, LINKTYPE_LINUX_SLL, LINKTYPE_IPV4, LINKTYPE_IPV6,
+                       LINKTYPE_LINUX_SLL2)
+SLL_HDR_LEN = 16
+SLL2_HDR_LEN = 20
+
 # class of Ethernet
 # some Ethernet_II payload types
 ETH_TYPE_IP = 0x0800  # IP protocol
 ETH_TYPE_IP6 = 0x86DD  # IPv6 protocol
+ETH_TYPE_8021Q = 0x8100  # VLAN tag
+ETH_TYPE_8021AD = 0x88A8  # outer VLAN tag of QinQ
+ETH_TYPE_QINQ = 0x9100  # outer VLAN tag of QinQ, pre-standard
+_vlan_types = (ETH_TYPE_8021Q, ETH_TYPE_8021AD, ETH_TYPE_QINQ)
 _eth_header = (
     ('dst', '6s'),
     ('src', '6s'),
     ('type', 'H')
 )
+_eth_struct = compile_header(_eth_header)
 
 
 class Ethernet(Packet):
+    __slots__ = ('dst', 'src', 'type')
+    __hdr_len__ = _eth_struct.size
+
     def __init__(self, buf):
-        super(Ethernet, self).__init__(_eth_header, buf)
+        super(Ethernet, self).__init__(buf)
+        self.dst, self.src, self.type = _eth_struct.unpack_from(self._buf)
+
+
+def link_payload(buf, linktype=LINKTYPE_ETHERNET):
+    """
+    (EtherType, offset) of the network layer of a frame, VLAN tags skipped, None if the link type is not supported
+    or the frame is cut short. Raw IP frames report the EtherType of their version.
+    """
+    n = len(buf)
+    if linktype == LINKTYPE_ETHERNET:
+        if n < 14: return None
+        eth_type, off = (buf[12] << 8) | buf[13], 14
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if n < SLL_HDR_LEN: return None
+        eth_type, off = (buf[14] << 8) | buf[15], SLL_HDR_LEN
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if n < SLL2_HDR_LEN: return None
+        eth_type, off = (buf[0] << 8) | buf[1], SLL2_HDR_LEN
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        if n < 1: return None
+        version = buf[0] >> 4
+        if version == 4: return ETH_TYPE_IP, 0
+        if version == 6: return ETH_TYPE_IP6, 0
+        return None
+    else:
+        return None
+    while eth_type in _vlan_types:  # 802.1Q, QinQ: 2 bytes of tag control, then the next type
+        if off + 4 > n: return None
+        eth_type, off = (buf[off + 2] << 8) | buf[off + 3], off + 4
+    return eth_type, off
 
 
 # class of IP
 # some IP protocol
+IP_PROTO_HOPOPTS = 0  # IPv6 hop-by-hop options
 IP_PROTO_TCP = 6  # TCP
 IP_PROTO_UDP = 17  # UDP
+IP_PROTO_ROUTING = 43  # IPv6 routing header
+IP_PROTO_FRAGMENT = 44  # IPv6 fragment header
+IP_PROTO_ESP = 50
+IP_PROTO_AH = 51
+IP_PROTO_NONE = 59  # IPv6 no next header
+IP_PROTO_DSTOPTS = 60  # IPv6 destination options
+IP_PROTO_MH = 135  # IPv6 mobility header
+_ip6_ext_headers = (IP_PROTO_HOPOPTS, IP_PROTO_ROUTING, IP_PROTO_DSTOPTS, IP_PROTO_MH)  # length in 8 bytes - 1
+MAX_IP6_EXT_HEADERS = 8  # RFC 8200 allows each at most once (destination options twice)
 _ip_header = (
     ('_v_hl', 'B'),  # ip header length(unit: 4 bytes)
     ('type_of_service', 'B'),
@@ -50,18 +119,112 @@ _ip_header = (
     ('_src', '4s'),
     ('_dst', '4s')
 )
+_ip_struct = compile_header(_ip_header)
 
 
 class IP(Packet):
+    __slots__ = ('_v_hl', 'type_of_service', 'len', 'id', 'flags_offset', 'ttl', 'protocol', 'checksum',
+                 '_src', '_dst')
+    __hdr_len__ = _ip_struct.size
+
     def __init__(self, buf):
-        super(IP, self).__init__(_ip_header, buf)
-        offload = ((self._v_hl & 0xf) << 2) - self.__hdr_len__
+        super(IP, self).__init__(buf)
+        (self._v_hl, self.type_of_service, self.len, self.id, self.flags_offset, self.ttl, self.protocol,
+         self.checksum, self._src, self._dst) = _ip_struct.unpack_from(self._buf)
+
+    @property
+    def data(self):
+        hdr_len = (self._v_hl & 0xf) << 2  # including options
         if self.len:
-            self.data = buf[self.__hdr_len__ + offload: self.len]
-        else:  # might be TCP segmentation offload
-            self.data = buf[self.__hdr_len__ + offload:]
-        self.src = socket.inet_ntoa(self._src)
-        self.dst = socket.inet_ntoa(self._dst)
+            return self._buf[hdr_len: self.len]
+        return self._buf[hdr_len:]  # might be TCP segmentation offload
+
+    @property
+    def version(self):
+        return self._v_hl >> 4
+
+    @property
+    def frag_offset(self):  # in bytes, only the first fragment holds the transport header
+        return (self.flags_offset & 0x1fff) << 3
+
+    @property
+    def src(self):
+        return socket.inet_ntoa(self._src)
+
+    @property
+    def dst(self):
+        return socket.inet_ntoa(self._dst)
+
+
+# class of IPv6
+_ip6_header = (
+    ('_v_tc_fl', 'I'),  # version, traffic class, flow label
+    ('payload_len', 'H'),
+    ('next_header', 'B'),
+    ('hop_limit', 'B'),
+    ('_src', '16s'),
+    ('_dst', '16s')
+)
+_ip6_struct = compile_header(_ip6_header)
+
+
+def ip6_upper_layer(buf, end, start=0):
+    """
+    Walk the extension headers of the IPv6 packet at offset start of buf (up to end): (protocol, offset of its
+    header, fragment offset in bytes). The walk stops at ESP, no next header, or a header running past end, which
+    is then the protocol reported.
+    """
+    nh = buf[start + 6]
+    off = start + _ip6_struct.size
+    frag_offset = 0
+    for _ in range(MAX_IP6_EXT_HEADERS):
+        if nh in _ip6_ext_headers:
+            next_off = off + ((buf[off + 1] + 1) << 3) if off + 2 <= end else end + 1
+        elif nh == IP_PROTO_AH:
+            next_off = off + ((buf[off + 1] + 2) << 2) if off + 2 <= end else end + 1
+        elif nh == IP_PROTO_FRAGMENT:
+            next_off = off + 8
+            if next_off <= end:
+                frag_offset = ((buf[off + 2] << 8) | buf[off + 3]) & 0xfff8
+        else:
+            break
+        if next_off > end:
+            break
+        nh, off = buf[off], next_off
+    return nh, off, frag_offset
+
+
+class IP6(Packet):
+    """IPv6 header, protocol and data are those of the upper layer, after the extension headers."""
+    __slots__ = ('_v_tc_fl', 'payload_len', 'next_header', 'hop_limit', '_src', '_dst', 'protocol', 'frag_offset',
+                 '_start', '_end')
+    __hdr_len__ = _ip6_struct.size
+
+    def __init__(self, buf):
+        super(IP6, self).__init__(buf)
+        (self._v_tc_fl, self.payload_len, self.next_header, self.hop_limit, self._src,
+         self._dst) = _ip6_struct.unpack_from(self._buf)
+        end = len(self._buf)
+        if self.payload_len:  # 0: jumbogram or TCP segmentation offload
+            end = min(end, self.__hdr_len__ + self.payload_len)
+        self._end = end
+        self.protocol, self._start, self.frag_offset = ip6_upper_layer(self._buf, end)
+
+    @property
+    def data(self):
+        return self._buf[self._start:self._end]
+
+    @property
+    def version(self):
+        return self._v_tc_fl >> 28
+
+    @property
+    def src(self):
+        return socket.inet_ntop(socket.AF_INET6, self._src)
+
+    @property
+    def dst(self):
+        return socket.inet_ntop(socket.AF_INET6, self._dst)
 
 
 # class of TCP
@@ -71,8 +234,11 @@ TH_SYN = 0x02  # synchronize sequence numbers
 TH_ACK = 0x10  # acknowledgment number set
 TH_PSH = 0X08
 # some TCP options
+TCP_OPT_EOL = 0  # end of option list
+TCP_OPT_NOP = 1  # padding, 1 byte
 TCP_OPT_MSS = 2  # maximum segment size, len 4
 TCP_OPT_WSCALE = 3  # window scale factor, len 3
+TCP_OPT_SACK = 5  # selective acknowledgment blocks, len 2 + 8 * blocks
 TCP_OPT_TIMESTAMP = 8  # timestamp, len 10
 _tcp_header = (
     ('src_port', 'H'),
@@ -85,60 +251,482 @@ _tcp_header = (
     ('checksum', 'H'),
     ('urgent_ptr', 'H')
 )
+_tcp_struct = compile_header(_tcp_header)
+_u16 = struct.Struct('>H')
+_u32_pair = struct.Struct('>II')
 
 
 def parse_opts(buf):
+    """
+    {kind: value} of the TCP options in buf. Stops at EOL, and at an option whose length is below 2 or runs past
+    the end (malformed), so every step moves forward within buf.
+    """
     opts = {}
-    while buf:
-        o = buf[0]
-        if o <= 1:      # EOL or NOP: only has 1 byte of type field and no len/val field
-            buf = buf[1:]
-        else:
-            len = buf[1]    # includes type, len and info
-            d, buf = buf[2:len], buf[len:]
-            opts[o] = d
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        o = buf[pos]
+        if o == TCP_OPT_EOL:
+            break
+        if o == TCP_OPT_NOP:    # only has 1 byte of type field and no len/val field
+            pos += 1
+            continue
+        if pos + 1 >= end:
+            break
+        length = buf[pos + 1]    # includes type, len and info
+        if length < 2 or pos + length > end:
+            break
+        opts[o] = buf[pos + 2:pos + length]
+        pos += length
     return opts
 
 
 class TCP(Packet):
+    __slots__ = ('src_port', 'dst_port', 'seq', 'ack', '_offset', 'flags', 'win_size', 'checksum', 'urgent_ptr',
+                 '_opts', '_ip', 'time')
+    __hdr_len__ = _tcp_struct.size
+
     def __init__(self, buf):
-        super(TCP, self).__init__(_tcp_header, buf)
-        offload = ((self._offset >> 4) << 2) - self.__hdr_len__
-        self.data = buf[self.__hdr_len__ + offload:]
-
-        self.opts = parse_opts(buf[self.__hdr_len__:self.__hdr_len__ + offload])
-        self.win_scale = None   # range 0-14
-        self.tsval = None   # Timestamp Value
-        self.tsecr = None   # Timestamp Echo Reply
-        self.MSS = None     # Maximum Segment Size
-        self.src_ip = None
-        self.dst_ip = None
+        super(TCP, self).__init__(buf)
+        (self.src_port, self.dst_port, self.seq, self.ack, self._offset, self.flags, self.win_size, self.checksum,
+         self.urgent_ptr) = _tcp_struct.unpack_from(self._buf)
+        self._opts = None
+        self._ip = None
         self.time = None
 
-        if TCP_OPT_WSCALE in self.opts.keys():
-            self.win_scale = int.from_bytes(self.opts[TCP_OPT_WSCALE], "big")
-        if TCP_OPT_TIMESTAMP in self.opts.keys():
-            ts_buf = self.opts[TCP_OPT_TIMESTAMP]
-            self.tsval = int.from_bytes(ts_buf[0:4], "big")
-            self.tsecr = int.from_bytes(ts_buf[4:8], "big")
-        if TCP_OPT_MSS in self.opts.keys():
-            self.MSS = int.from_bytes(self.opts[TCP_OPT_MSS], "big")
+    @property
+    def data(self):
+        return self._buf[(self._offset >> 4) << 2:]
+
+    @property
+    def opts(self):
+        if self._opts is None:
+            self._opts = parse_opts(self._buf[self.__hdr_len__:(self._offset >> 4) << 2])
+        return self._opts
+
+    def _opt(self, kind, size):
+        """Value of option kind if present with the expected size, None otherwise."""
+        d = self.opts.get(kind)
+        return d if d is not None and len(d) == size else None
+
+    @property
+    def win_scale(self):    # range 0-14
+        d = self._opt(TCP_OPT_WSCALE, 1)
+        return None if d is None else d[0]
+
+    @property
+    def tsval(self):    # Timestamp Value
+        d = self._opt(TCP_OPT_TIMESTAMP, 8)
+        return None if d is None else int.from_bytes(d[0:4], "big")
+
+    @property
+    def tsecr(self):    # Timestamp Echo Reply
+        d = self._opt(TCP_OPT_TIMESTAMP, 8)
+        return None if d is None else int.from_bytes(d[4:8], "big")
+
+    @property
+    def MSS(self):     # Maximum Segment Size
+        d = self._opt(TCP_OPT_MSS, 2)
+        return None if d is None else int.from_bytes(d, "big")
+
+    @property
+    def sack(self):    # [(left edge, right edge)] of the SACK blocks
+        d = self.opts.get(TCP_OPT_SACK)
+        if d is not None and len(d) >= 8 and len(d) % 8 == 0:
+            return [(int.from_bytes(d[i:i + 4], "big"), int.from_bytes(d[i + 4:i + 8], "big"))
+                    for i in range(0, len(d), 8)]
+        return None
 
     def set_ip(self, ip):
-        self.src_ip = ip.src
-        self.dst_ip = ip.dst
+        self._ip = ip
+
+    @property
+    def src_ip(self):
+        return None if self._ip is None else self._ip.src
+
+    @property
+    def dst_ip(self):
+        return None if self._ip is None else self._ip.dst
 
 
-def ip_pkg(buf):
-    eth = Ethernet(buf)
-    if eth.type == ETH_TYPE_IP or eth.type == ETH_TYPE_IP6:
-        return IP(eth.data)
+def ip_pkg(buf, linktype=LINKTYPE_ETHERNET):
+    """IP or IP6 view of the network layer of a frame, None if it is not IP or its header is cut short."""
+    buf = buf if isinstance(buf, memoryview) else memoryview(buf)
+    link = link_payload(buf, linktype)
+    if link is None:
+        return None
+    eth_type, off = link
+    if eth_type == ETH_TYPE_IP:
+        if len(buf) < off + 20 or buf[off] >> 4 != 4 or buf[off] & 0xf < 5:
+            return None
+        return IP(buf[off:])
+    if eth_type == ETH_TYPE_IP6:
+        if len(buf) < off + 40 or buf[off] >> 4 != 6:
+            return None
+        return IP6(buf[off:])
     return None
 
 
 def tcp_pkg(ip):
-    if ip.protocol == IP_PROTO_TCP:
-        tcp = TCP(ip.data)
-        tcp.set_ip(ip)
-        return tcp
-    return None
\ No newline at end of file
+    """TCP view of the data of ip, None if it is not TCP, not the first fragment, or its header is cut short."""
+    if ip.protocol != IP_PROTO_TCP or ip.frag_offset:
+        return None
+    data = ip.data
+    if len(data) < 20 or not 20 <= (data[12] >> 4) << 2 <= len(data):
+        return None
+    tcp = TCP(data)
+    tcp.set_ip(ip)
+    return tcp
+
+
+class FrameDecoder(object):
+    """
+    Decoder of the link, IP and TCP headers of frames into the slots of this one object, reused from frame to
+    frame: no header views, option dicts or address strings are created per packet, addresses are only formatted
+    when src / dst are read. Once decode() returned True the fields carry the names of TCP, so the decoder can be
+    handed where a TCP is expected, as long as it is not kept past the next decode().
+    """
+    __slots__ = ('buf', 'version', 'protocol', 'frag_offset', 'ip_offset', 'l4_offset', 'l4_end', 'hdr_len',
+                 'src_port', 'dst_port', 'seq', 'ack', 'flags', 'win_size', 'MSS', 'win_scale', 'tsval', 'tsecr',
+                 '_sack_offset', '_sack_blocks')
+
+    def __init__(self):
+        self.buf = None
+        self.version = None
+        self.protocol = None  # upper layer protocol of the last IP packet, None if the frame was not IP
+        self.frag_offset = 0
+        self.ip_offset = 0
+        self.l4_offset = 0  # transport header
+        self.l4_end = 0  # end of the IP payload in buf
+        self.hdr_len = 0  # TCP header length, options included
+        self.src_port = self.dst_port = self.seq = self.ack = self.flags = self.win_size = None
+        self.MSS = self.win_scale = self.tsval = self.tsecr = None
+        self._sack_offset = 0
+        self._sack_blocks = 0
+
+    def decode(self, buf, linktype=LINKTYPE_ETHERNET):
+        """Decode a frame, True if it holds a TCP segment (version, protocol and addresses are set for any IP)."""
+        self.protocol = None
+        link = link_payload(buf, linktype)
+        if link is None:
+            return False
+        eth_type, off = link
+        n = len(buf)
+        if eth_type == ETH_TYPE_IP:
+            if off + 20 > n:
+                return False
+            hdr_len = (buf[off] & 0xf) << 2
+            if buf[off] >> 4 != 4 or hdr_len < 20 or off + hdr_len > n:
+                return False
+            total = (buf[off + 2] << 8) | buf[off + 3]
+            end = min(n, off + total) if total else n  # 0: TCP segmentation offload
+            self.version = 4
+            self.protocol = buf[off + 9]
+            self.frag_offset = (((buf[off + 6] << 8) | buf[off + 7]) & 0x1fff) << 3
+            self.l4_offset = off + hdr_len
+        elif eth_type == ETH_TYPE_IP6:
+            if off + 40 > n or buf[off] >> 4 != 6:
+                return False
+            payload_len = (buf[off + 4] << 8) | buf[off + 5]
+            end = min(n, off + 40 + payload_len) if payload_len else n
+            self.version = 6
+            self.protocol, self.l4_offset, self.frag_offset = ip6_upper_layer(buf, end, off)
+        else:
+            return False
+        self.buf = buf
+        self.ip_offset = off
+        self.l4_end = end
+        off = self.l4_offset
+        if self.protocol != IP_PROTO_TCP or self.frag_offset or off + 20 > end:
+            return False
+        (self.src_port, self.dst_port, self.seq, self.ack, offset, self.flags, self.win_size, _,
+         _) = _tcp_struct.unpack_from(buf, off)
+        hdr_len = (offset >> 4) << 2
+        if hdr_len < 20 or off + hdr_len > end:
+            return False
+        self.hdr_len = hdr_len
+        self._options(buf, off + 20, off + hdr_len)
+        return True
+
+    def _options(self, buf, pos, end):
+        """Same walk as parse_opts, keeping only the options the analyses use."""
+        self.MSS = self.win_scale = self.tsval = self.tsecr = None
+        self._sack_blocks = 0
+        while pos < end:
+            o = buf[pos]
+            if o == TCP_OPT_EOL:
+                break
+            if o == TCP_OPT_NOP:
+                pos += 1
+                continue
+            if pos + 1 >= end:
+                break
+            length = buf[pos + 1]
+            if length < 2 or pos + length > end:
+                break
+            if o == TCP_OPT_TIMESTAMP and length == 10:
+                self.tsval, self.tsecr = _u32_pair.unpack_from(buf, pos + 2)
+            elif o == TCP_OPT_SACK and length >= 10 and (length - 2) % 8 == 0:
+                self._sack_offset = pos + 2
+                self._sack_blocks = (length - 2) >> 3
+            elif o == TCP_OPT_MSS and length == 4:
+                self.MSS = _u16.unpack_from(buf, pos + 2)[0]
+            elif o == TCP_OPT_WSCALE and length == 3:
+                self.win_scale = buf[pos + 2]
+            pos += length
+
+    @property
+    def data(self):
+        return self.buf[self.l4_offset + self.hdr_len:self.l4_end]
+
+    @property
+    def payload_len(self):
+        return self.l4_end - self.l4_offset - self.hdr_len
+
+    @property
+    def sack(self):    # [(left edge, right edge)] of the SACK blocks
+        if not self._sack_blocks:
+            return None
+        return [_u32_pair.unpack_from(self.buf, self._sack_offset + 8 * i) for i in range(self._sack_blocks)]
+
+    @property
+    def src(self):
+        off = self.ip_offset
+        if self.version == 4:
+            return socket.inet_ntoa(self.buf[off + 12:off + 16])
+        return socket.inet_ntop(socket.AF_INET6, self.buf[off + 8:off + 24])
+
+    @property
+    def dst(self):
+        off = self.ip_offset
+        if self.version == 4:
+            return socket.inet_ntoa(self.buf[off + 16:off + 20])
+        return socket.inet_ntop(socket.AF_INET6, self.buf[off + 24:off + 40])
+
+
+# pcap / pcapng files
+PCAP_MAGIC = 0xa1b2c3d4  # microsecond timestamps
+PCAP_MAGIC_NS = 0xa1b23c4d  # nanosecond timestamps
+PCAPNG_SHB = 0x0a0d0d0a  # section header block, same value in both byte orders
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_IDB = 1  # interface description block
+PCAPNG_OPB = 2  # obsolete packet block
+PCAPNG_SPB = 3  # simple packet block
+PCAPNG_EPB = 6  # enhanced packet block
+PCAPNG_OPT_TSRESOL = 9
+
+
+class PcapReader(object):
+    """
+    Reader of pcap and pcapng files (both byte orders, micro or nanosecond timestamps) over a read-only mmap.
+    Iterating yields (ts, memoryview of the frame) without copying, like dpkt.pcap.Reader but allocation free;
+    the views stay valid after close(), the mapping is only released once the last one is gone.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file cannot be mapped
+            self._file.close()
+            raise ValueError(f'{path}: not a pcap or pcapng file')
+        self.buf = memoryview(self._mm)
+        self._contexts = None  # pcapng: ([block offset], [(byte order, interfaces)]) after each SHB / IDB
+        self.is_pcapng = len(self.buf) >= 12 and struct.unpack_from('<I', self.buf)[0] == PCAPNG_SHB
+        if self.is_pcapng:
+            self.linktype = next((interfaces[0][0] for interfaces in self._sections() if interfaces), None)
+            return
+        magic = struct.unpack_from('<I', self.buf)[0] if len(self.buf) >= 24 else None
+        if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+            endian = '<'
+        elif magic is not None and struct.unpack_from('>I', self.buf)[0] in (PCAP_MAGIC, PCAP_MAGIC_NS):
+            endian = '>'
+            magic = struct.unpack_from('>I', self.buf)[0]
+        else:
+            self.close()
+            raise ValueError(f'{path}: not a pcap or pcapng file')
+        self._rec_struct = struct.Struct(endian + 'IIII')
+        self._ts_unit = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+        self._frac_limit = 1000000000 if magic == PCAP_MAGIC_NS else 1000000
+        self.snaplen = struct.unpack_from(endian + 'I', self.buf, 16)[0]
+        self.linktype = struct.unpack_from(endian + 'I', self.buf, 20)[0] & 0xffff  # upper bits: FCS info
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        try:
+            self.buf.release()
+            self._mm.close()
+        except BufferError:  # frames still referenced, the mapping goes away with them
+            pass
+        self._file.close()
+
+    def __iter__(self):
+        buf = self.buf
+        for _, data_offset, caplen, _, ts, _ in self.records():
+            yield ts, buf[data_offset:data_offset + caplen]
+
+    def records(self, start=None, end=None, context=None):
+        """
+        Yield (record offset, frame offset, captured length, wire length, ts, link type) for every record, from the
+        record (pcapng: block) at offset start if given, up to the ones starting before end. Only headers are read.
+        pcapng blocks are decoded from start directly, with the section state of context (see boundaries) or of
+        section_context.
+        """
+        if self.is_pcapng:
+            yield from self._pcapng_records(start, end, context)
+            return
+        buf, rec_struct, ts_unit, linktype = self.buf, self._rec_struct, self._ts_unit, self.linktype
+        pos = 24 if start is None else start
+        stop = len(buf) if end is None else min(end, len(buf))
+        end = len(buf)
+        while pos + 16 <= end and pos < stop:
+            sec, frac, caplen, wire_len = rec_struct.unpack_from(buf, pos)
+            data_offset = pos + 16
+            if data_offset + caplen > end:  # truncated capture
+                return
+            yield pos, data_offset, caplen, wire_len, sec + frac * ts_unit, linktype
+            pos = data_offset + caplen
+
+    def index(self):
+        """Offsets of every record, to come back to them with read_at."""
+        return [record[0] for record in self.records()]
+
+    def read_at(self, offset):
+        """(ts, frame) of the record at offset."""
+        _, data_offset, caplen, _, ts, _ = next(self.records(offset))
+        return ts, self.buf[data_offset:data_offset + caplen]
+
+    def section_context(self, offset):
+        """
+        pcapng: (byte order, interfaces) in force at the block at offset, from a table of the section header and
+        interface description blocks built by one walk on first use, so that seeking to a block is direct.
+        """
+        if self._contexts is None:
+            offsets, contexts = self._contexts = [], []
+            for pos, endian, block_type, _, interfaces in self._blocks():
+                if block_type in (PCAPNG_SHB, PCAPNG_IDB):
+                    offsets.append(pos)
+                    contexts.append((endian, tuple(interfaces)))
+        offsets, contexts = self._contexts
+        i = bisect_left(offsets, offset) - 1  # last change before the block
+        return contexts[i] if i >= 0 else ('<', ())
+
+    def boundaries(self, positions):
+        """
+        [(sync(pos), context to pass to records() from there)] for each of the ascending positions, in a single walk
+        of the blocks for pcapng (the context is None for classic pcap).
+        """
+        if not self.is_pcapng:
+            return [(self.sync(pos), None) for pos in positions]
+        result = []
+        context = ('<', ())
+        i = 0
+        for offset, endian, block_type, _, interfaces in self._blocks():
+            while i < len(positions) and positions[i] <= offset:
+                result.append((offset, context))
+                i += 1
+            if i == len(positions):
+                break
+            if block_type in (PCAPNG_SHB, PCAPNG_IDB):
+                context = (endian, tuple(interfaces))
+        return result + [(None, None)] * (len(positions) - len(result))
+
+    def sync(self, pos):
+        """
+        Offset of the first record (pcapng: block) starting at or after byte pos, None if there is none, so a
+        capture can be split in byte ranges on record boundaries. Classic pcap has no markers: a position is taken
+        when the next few record headers are plausible and chain into each other.
+        """
+        if self.is_pcapng:
+            return self.boundaries([pos])[0][0]
+        pos = max(pos, 24)
+        while pos + 16 <= len(self.buf):
+            if self._chains(pos):
+                return pos
+            pos += 1
+        return None
+
+    def _chains(self, pos, depth=8):
+        end = len(self.buf)
+        for _ in range(depth):
+            if pos == end:
+                return True
+            if pos + 16 > end:
+                return False
+            _, frac, caplen, wire_len = self._rec_struct.unpack_from(self.buf, pos)
+            if frac >= self._frac_limit or caplen > wire_len or (self.snaplen and caplen > self.snaplen) \
+                    or pos + 16 + caplen > end:
+                return False
+            pos += 16 + caplen
+        return True
+
+    def _blocks(self, start=0, context=('<', ())):
+        """
+        Walk the pcapng blocks from the block at offset start, context being the (byte order, interfaces) in force
+        there; yield (offset, endian, type, length, interfaces of the current section).
+        """
+        buf = self.buf
+        pos = start
+        end = len(buf)
+        endian = context[0]
+        interfaces = list(context[1])  # [(link type, snaplen, ts unit)], in interface id order
+        while pos + 12 <= end:
+            if struct.unpack_from('<I', buf, pos)[0] == PCAPNG_SHB:  # new section, may switch byte order
+                endian = '<' if struct.unpack_from('<I', buf, pos + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                interfaces = []
+            block_type, block_len = struct.unpack_from(endian + 'II', buf, pos)
+            if block_len < 12 or pos + block_len > end:  # corrupt or truncated
+                return
+            if block_type == PCAPNG_IDB:
+                linktype, _, snaplen = struct.unpack_from(endian + 'HHI', buf, pos + 8)
+                interfaces.append((linktype, snaplen, self._ts_resolution(endian, pos + 16, pos + block_len - 4)))
+            yield pos, endian, block_type, block_len, interfaces
+            pos += block_len
+
+    def _sections(self):
+        for _, _, block_type, _, interfaces in self._blocks():
+            if block_type == PCAPNG_IDB:
+                yield interfaces
+
+    def _ts_resolution(self, endian, pos, end):
+        """Timestamp unit from the if_tsresol option of an interface description block, microseconds by default."""
+        while pos + 4 <= end:
+            code, length = struct.unpack_from(endian + 'HH', self.buf, pos)
+            if code == 0:  # end of options
+                break
+            if code == PCAPNG_OPT_TSRESOL and length >= 1:
+                resol = self.buf[pos + 4]
+                return 2.0 ** -(resol & 0x7f) if resol & 0x80 else 10.0 ** -resol
+            pos += 4 + ((length + 3) & ~3)  # values are padded to 32 bits
+        return 1e-6
+
+    def _pcapng_records(self, start, end, context):
+        if not start:
+            blocks = self._blocks()
+        else:
+            blocks = self._blocks(start, context if context is not None else self.section_context(start))
+        for pos, endian, block_type, block_len, interfaces in blocks:
+            if end is not None and pos >= end:
+                return
+            if block_type == PCAPNG_EPB:
+                if_id, ts_high, ts_low, caplen, wire_len = struct.unpack_from(endian + 'IIIII', self.buf, pos + 8)
+                data_offset = pos + 28
+            elif block_type == PCAPNG_SPB:  # no timestamp, always interface 0
+                if_id, ts_high, ts_low = 0, 0, 0
+                wire_len = struct.unpack_from(endian + 'I', self.buf, pos + 8)[0]
+                caplen = min(wire_len, block_len - 16)
+                data_offset = pos + 12
+            elif block_type == PCAPNG_OPB:
+                if_id, _, ts_high, ts_low, caplen, wire_len = struct.unpack_from(endian + 'HHIIII', self.buf, pos + 8)
+                data_offset = pos + 28
+            else:
+                continue
+            if if_id >= len(interfaces) or data_offset + caplen > pos + block_len:
+                continue
+            linktype, _, ts_unit = interfaces[if_id]
+            yield pos, data_offset, caplen, wire_len, ((ts_high << 32) | ts_low) * ts_unit, linktype
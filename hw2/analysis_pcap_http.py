@@ -1,85 +1,85 @@
 # -*- coding:utf-8 -*-
 
-import dpkt
 
-from Packet import *
+import argparse
 
-# key index
-REQ_PORT = 0
-RES_PORT = 1
+from http_profile import analyze_capture, analyze_captures, format_table, parse_capture
 
 port_info = {}
 
-def req_res(pcap_path, port):
-    global port_info
-    responses = {}  # key value definition refers to the constant variable above
-    requests = {}
-    pkt_list = []
-    bytes_total = 0
-    packet_total = 0
-    with open(pcap_path, 'rb') as f:
-        pcap = dpkt.pcap.Reader(f)
-        for ts, buf in pcap:
-            packet_total += 1
-            ip = ip_pkg(buf)
-            if ip is None: continue  # skip non-ip packets
-            tcp = tcp_pkg(ip)
-            tcp.time = ts
-            bytes_total += len(buf)
-            if tcp is None: continue  # skip non-TCP packets
-            pkt_list.append(tcp)
 
-    # process response
-    ed_time = None
-    for tcp in pkt_list:
-        payload_len = len(tcp.data)
-        if tcp.src_port == port and payload_len > 0:
-            key = (tcp.dst_port, tcp.src_port)  # distinct key for each TCP flow
-            if key not in responses:
-                responses[key] = {}
-            if tcp.seq not in responses[key]:
-                responses[key][tcp.seq] = []
-            responses[key][tcp.seq].append(f'({tcp.src_port}, {tcp.dst_port}, {tcp.seq}, {tcp.ack})')
-            ed_time = tcp.time
+def format_transaction(txn):
+    if txn.method is not None:
+        request = f'{txn.method} {txn.uri} HTTP/{txn.version} ({txn.req_bytes} bytes)'
+    else:
+        request = f'{txn.req_bytes} bytes'
+    if txn.res_start is None:
+        return f'Request: {request}, Response: none'
+    response = f'{txn.status} ({txn.res_bytes} bytes)' if txn.status is not None else f'{txn.res_bytes} bytes'
+    ttfb = f'{"{:.6f}".format(txn.ttfb)} s' if txn.ttfb is not None else '-'
+    return f'Request: {request}, Response: {response}, TTFB: {ttfb}, ' \
+           f'transfer: {"{:.6f}".format(txn.transfer_time)} s{"" if txn.complete else ", incomplete"}'
+
+
+def connection_start(txns):
+    """Earliest request of a connection: its transactions are in order of completion, not of request."""
+    return min((t.req_start for t in txns if t.req_start is not None), default=0)
 
-    # process request according to ack in responses with payload > 0
-    st_time = None
-    for tcp in pkt_list:
-        payload_len = len(tcp.data)
-        if tcp.dst_port == port and payload_len > 0:
-            key = (tcp.src_port, tcp.dst_port)  # distinct key for each TCP flow
-            if key not in requests:
-                requests[key] = {}
-            requests[key][tcp.ack] = f'({tcp.src_port}, {tcp.dst_port}, {tcp.seq}, {tcp.ack})'
-            if st_time is None:
-                st_time = tcp.time
+
+def req_res(pcap_path, port, capture=None):
+    """
+    Print the HTTP transactions (request/response exchanges for TLS) of the connections to port, from capture: the
+    http_profile.CaptureHTTP of pcap_path, analyzed here if None.
+    """
+    global port_info
+    if capture is None:
+        capture = analyze_capture(pcap_path, port)
+    transactions = capture.transactions  # {(client port, server port): [Transaction]}, in order of completion
+    packet_total = capture.packet_total
+    bytes_total = capture.ip_bytes
 
     print(f'=========== port: {port} ===========')
     http_flow = 0
-    for k, ack_dict in requests.items():
+    st_time = None
+    ed_time = None
+    for k, txns in sorted(transactions.items(), key=lambda item: connection_start(item[1])):
         if port != 1080:
             print(f'For TCP connection on {k}')
-        for req_seq, x in ack_dict.items():
-            if req_seq not in responses[k]:
+        for txn in sorted(txns, key=lambda t: t.req_start or 0):
+            print(format_transaction(txn))
+            if txn.res_start is None:
                 continue
             http_flow += 1
-            for y in set(responses[k][req_seq]):
-                print(f'Request: {x}, Response: {y}')
-            # print()
+            if txn.req_start is not None:
+                st_time = txn.req_start if st_time is None else min(st_time, txn.req_start)
+            ed_time = txn.res_end if ed_time is None else max(ed_time, txn.res_end)
 
     print(f'data flows: {http_flow}')
-    print(f'tcp connections: {len(responses)}')
-    port_info[port] = f'interval: {"{:.3f}".format(ed_time-st_time)} s\n' \
+    print(f'tcp connections: {len(transactions)}')
+    interval = ed_time - st_time if st_time is not None else 0.0
+    port_info[port] = f'interval: {"{:.3f}".format(interval)} s\n' \
                       f'packet_total: {packet_total}\n' \
                       f'payload_total: {bytes_total} bytes'
 
 
 if __name__ == '__main__':
-    req_res("http_1080.pcap", 1080)
-    req_res("tcp_1081.pcap", 1081)
-    req_res("tcp_1082.pcap", 1082)
-    print(f'=========== summary ===========')
-    for p, text in port_info.items():
-        print(f'port: {p}')
-        print(text)
-        print()
+    parser = argparse.ArgumentParser(description='HTTP transactions and server behavior of captures')
+    parser.add_argument('captures', nargs='*', metavar='PCAP[:PORT]',
+                        default=['http_1080.pcap:1080', 'tcp_1081.pcap:1081', 'tcp_1082.pcap:1082'],
+                        help='capture, and the server port to keep (default: the three assignment captures)')
+    parser.add_argument('--workers', type=int, help='processes profiling the captures (default: one per core)')
+    parser.add_argument('--table-only', action='store_true',
+                        help='only the comparison table, without the transactions of every connection')
+    args = parser.parse_args()
+    captures = [parse_capture(c) for c in args.captures]
+
+    results = analyze_captures(captures, args.workers, keep_transactions=not args.table_only)
+    if not args.table_only:
+        for (path, port), result in zip(captures, results):
+            req_res(path, port, result)
+        print(f'=========== summary ===========')
+        for p, text in port_info.items():
+            print(f'port: {p}')
+            print(text)
+            print()
+    print(format_table([profile for result in results for profile in result.profiles]))
@@ -1,223 +1,242 @@
 # -*- coding:utf-8 -*-
+import argparse
+import csv
 import math
 
-import dpkt
-import pandas as pd
-import math
+import numpy as np
 
 from Packet import *
-
-# flow field index
-# key index
-SRC_PORT = 0
-DST_PORT = 1
-IP_DST = 2
-# value index
-FLOW_COUNT = 0
-WIN_SCALE = 1
-START_TIME = 2
-END_TIME = 3
-MSS = 4
-LEN_PKT_SENT = 5
-RTT_FIRST_ACK = 6
-NUM_PKT_SENT = 7
-TOTAL_BYTES = 8
-RTT_INFO = 9
-SENT_TIME_LIST = 10
-
-
-
-def count_tcp_flows(pcap_path, sender):
-    flows = {}  # key-value definition refers to the constant variable above
-    first2_tran: dict[list] = {}  # {key: [(seq, ack, win_bytes, len)]}
-    seq_ack_counter = {}   # {dst_port: {seq/ack, (sent_cnt, rev_cnt)}}
-
-    with open(pcap_path, 'rb') as f:
-        pcap = dpkt.pcap.Reader(f)
-        for ts, buf in pcap:
-            ip = ip_pkg(buf)
-            if ip is None: continue  # skip non-ip packets
-
-            tcp = tcp_pkg(ip)
-            if tcp is None: continue  # skip non-TCP packets
-            payload_len = len(tcp.data)
-
-            # send
-            if ip.src == sender:
-                if payload_len == 0 and not tcp.flags & TH_SYN:     # ignore payload 0 and not SYN packets
-                    continue
-
-                key = (tcp.src_port, tcp.dst_port, ip.dst)  # distinct key for each TCP flow
-                if tcp.src_port not in seq_ack_counter.keys(): seq_ack_counter[tcp.src_port] = {}
-                if tcp.seq not in seq_ack_counter[tcp.src_port]:
-                    seq_ack_counter[tcp.src_port][tcp.seq] = [1, 0]
-                else:
-                    seq_ack_counter[tcp.src_port][tcp.seq][0] += 1
-
-                if tcp.flags & TH_SYN:  # when connection is setup
-                    if key not in flows.keys(): # a new TCP flow
-                        flows[key] = [0,0,0,0,0,[0],None,[1],0,{},{}]
-                    flows[key][FLOW_COUNT] += 1  # increment TCP flow cnt by 1
-                    flows[key][WIN_SCALE] = tcp.win_scale
-                    flows[key][START_TIME] = ts
-                    flows[key][MSS] = tcp.MSS
-                    expected_ack = tcp.seq + 1
-                else:
-                    expected_ack = tcp.seq + payload_len
-
-                if expected_ack in flows[key][SENT_TIME_LIST]:
-                    flows[key][SENT_TIME_LIST][expected_ack].append(ts)
-                else:
-                    flows[key][SENT_TIME_LIST][expected_ack] = [ts]
-
-                flows[key][RTT_INFO][expected_ack] = [ts, ts] # send_time, rev_time
-
-                if tcp.flags & TH_ACK and payload_len > 0:  # ACK and payload size > 0
-                    if key not in first2_tran: first2_tran[key] = []    # process the first2_tran
-                    if len(first2_tran[key]) < 4:
-                        sent_cnt = 0
-                        for tran in first2_tran[key]:
-                            if tran[4]=='SENT': sent_cnt += 1
-                        if sent_cnt < 2: first2_tran[key].append((tcp.seq, tcp.ack, tcp.win_size, len(tcp.data), "SENT"))
-            # receive
-            elif ip.dst == sender:
-                key = (tcp.dst_port, tcp.src_port, ip.src)  # distinct key for each TCP flow
-                if tcp.ack in seq_ack_counter[tcp.dst_port]:
-                    seq_ack_counter[tcp.dst_port][tcp.ack][1] += 1
-
-                if tcp.flags & TH_FIN:  # connection closed ACK received
-                    flows[key][END_TIME] = ts
-
-                if key in first2_tran.keys() and len(first2_tran[key]) < 4:
-                    is_first2 = False
-                    for tran in first2_tran[key]:
-                        if tran[4] == 'SENT' and tcp.seq == tran[1] and tcp.ack == tran[0]+tran[3]:
-                            is_first2 = True
-                            break
-                    if is_first2: first2_tran[key].append((tcp.seq, tcp.ack, tcp.win_size, len(tcp.data), "RECEIVE"))
-
-                if tcp.ack in flows[key][RTT_INFO]:
-                    send_time, rev_time = flows[key][RTT_INFO][tcp.ack]
-                    if send_time == rev_time:
-                        flows[key][RTT_INFO][tcp.ack][1] = ts
-
-            flows[key][TOTAL_BYTES] += len(buf)
+from cwnd_estimator import reconstruct_cwnd
+from flow_engine import flow_key, print_flow, stream_flows
+from pcap_index import load_index
+from pcap_table import CaptureCounters
+from rtt_estimator import RTTEstimator
+from seq_scoreboard import Scoreboard
+from sharded_analysis import analyze_parallel
+
+
+class Flow(object):
+    """State of one TCP conversation, the client being the sender of the SYN."""
+    __slots__ = ('client', 'client_port', 'server', 'server_port', 'syn_count', 'win_scale', 'server_win_scale',
+                 'mss', 'start_time', 'end_time', 'last_time', 'total_bytes', 'rtt', 'sent', 'acks', 'scoreboard',
+                 'first2_tran')
+
+    def __init__(self, client, client_port, server, server_port, keep_series=False):
+        self.client = client
+        self.client_port = client_port
+        self.server = server
+        self.server_port = server_port
+        self.syn_count = 0
+        self.win_scale = None
+        self.server_win_scale = None  # from the SYN-ACK, scales the windows advertised by the server
+        self.mss = None
+        self.start_time = None
+        self.end_time = None  # time of the FIN received by the client
+        self.last_time = None
+        self.total_bytes = 0
+        self.rtt = RTTEstimator(keep_series=keep_series)  # RTT of the segments sent by the client
+        self.sent = []  # [(time, seq, len)] of the data segments sent by the client, retransmissions included
+        self.acks = []  # [(time, ack)] of the ACKs received by the client
+        self.scoreboard = Scoreboard()  # retransmissions of the client
+        self.first2_tran = []  # [(seq, ack, win_size, len, "SENT" / "RECEIVE")]
+
+    @property
+    def interval(self):
+        return (self.end_time if self.end_time is not None else self.last_time) - self.start_time
+
+
+def count_tcp_flows(pcap_path, sender=None, rtt_series=False):
+    """
+    Analyze every TCP conversation of the capture opened with a SYN (from sender only, if given).
+    This is a whole-capture report, not a bounded-memory one: the congestion window reconstruction of Part B needs
+    every data segment and ACK of each flow, so they are kept until the end (with the RTT samples if rtt_series).
+    Day-long captures go through flow_engine instead (--streaming, --parallel), whose per-flow state is fixed size.
+    """
+    flows = {}  # {canonical 5-tuple: Flow}
+    skipped = 0  # packets of conversations whose SYN is not in the capture
+
+    index = load_index(pcap_path)
+    for tcp in index.segments():
+        ts = tcp.time
+        payload_len = tcp.payload_len
+        key = flow_key(tcp.src_ip, tcp.src_port, tcp.dst_ip, tcp.dst_port)
+        flow = flows.get(key)
+        if flow is None:
+            if tcp.flags & (TH_SYN | TH_ACK) != TH_SYN or (sender is not None and tcp.src_ip != sender):
+                skipped += 1
+                continue
+            flow = flows[key] = Flow(tcp.src_ip, tcp.src_port, tcp.dst_ip, tcp.dst_port, rtt_series)
+        flow.last_time = ts
+
+        # send
+        if tcp.src_port == flow.client_port and tcp.src_ip == flow.client:
+            if payload_len == 0 and not tcp.flags & TH_SYN:     # ignore payload 0 and not SYN packets
+                continue
+
+            if tcp.flags & TH_SYN:  # when connection is setup
+                flow.syn_count += 1
+                flow.win_scale = tcp.win_scale
+                flow.start_time = ts
+                flow.mss = tcp.MSS
+            else:
+                flow.sent.append((ts, tcp.seq, payload_len))
+                flow.scoreboard.on_send(ts, tcp.seq, payload_len, tcp.tsval)
+            flow.rtt.on_send(ts, tcp.seq, payload_len + (1 if tcp.flags & TH_SYN else 0), tcp.tsval)
+
+            if tcp.flags & TH_ACK and payload_len > 0 and len(flow.first2_tran) < 4:  # the first 2 transactions
+                sent_cnt = 0
+                for tran in flow.first2_tran:
+                    if tran[4] == 'SENT': sent_cnt += 1
+                if sent_cnt < 2: flow.first2_tran.append((tcp.seq, tcp.ack, tcp.win_size, payload_len, "SENT"))
+        # receive
+        else:
+            if tcp.flags & TH_SYN:
+                flow.server_win_scale = tcp.win_scale
+
+            if tcp.flags & TH_FIN:  # connection closed ACK received
+                flow.end_time = ts
+
+            if 0 < len(flow.first2_tran) < 4:
+                for tran in flow.first2_tran:
+                    if tran[4] == 'SENT' and tcp.seq == tran[1] and tcp.ack == tran[0] + tran[3]:
+                        flow.first2_tran.append((tcp.seq, tcp.ack, tcp.win_size, payload_len, "RECEIVE"))
+                        break
+
+            if tcp.flags & TH_ACK:
+                flow.acks.append((ts, tcp.ack))
+                flow.scoreboard.on_ack(ts, tcp.ack, tcp.sack, tcp.tsecr, payload_len, tcp.win_size,
+                                       tcp.flags & (TH_SYN | TH_FIN))
+                flow.rtt.on_ack(ts, tcp.ack, tcp.tsecr)
+
+        flow.total_bytes += tcp.caplen
 
     print(f'======== Part A. Q1 ========')
     total = 0
-    for k in flows:
-        print(f'src_port: {k[SRC_PORT]}, dst_port: {k[DST_PORT]}, ip_dst: {k[IP_DST]}, count: {flows[k][FLOW_COUNT]}')
-        total += flows[k][FLOW_COUNT]
-    print(f'TCP flows sent from {sender}: {total}')
+    for f in flows.values():
+        print(f'ip_src: {f.client}, src_port: {f.client_port}, dst_port: {f.server_port}, ip_dst: {f.server}, '
+              f'count: {f.syn_count}')
+        total += f.syn_count
+    print(f'TCP flows sent from {sender}: {total}' if sender is not None else f'TCP flows: {total}')
+    if skipped:
+        print(f'packets skipped (flow opened before the capture): {skipped}')
+    if index.skipped:
+        print(f'frames skipped (not decodable): {index.skipped}')
 
     print(f'\n======== Part A. Q2(a) ========')
-    for k in first2_tran:
-        print(f'src_port: {k[SRC_PORT]}, dst_port: {k[DST_PORT]}, ip_dst: {k[IP_DST]}, win_scale: {flows[k][WIN_SCALE]}')
-        win_scale = flows[k][WIN_SCALE]
-        for seq, ack, win_size, length, title in first2_tran[k]:
-            win_bytes = tran[2]<< win_scale
+    for f in flows.values():
+        if not f.first2_tran: continue
+        print(f'src_port: {f.client_port}, dst_port: {f.server_port}, ip_dst: {f.server}, win_scale: {f.win_scale}')
+        for seq, ack, win_size, length, title in f.first2_tran:
+            win_bytes = win_size << ((f.win_scale if title == 'SENT' else f.server_win_scale) or 0)
             print(f'{title} seq: {seq}, ack: {ack}, win_size: {win_size}, win_bytes: {win_bytes}, len: {length}')
         print()
 
     print(f'======== Part A. Q2(b) ========')
-    for k in flows:
-        interval = float(flows[k][END_TIME] - flows[k][START_TIME])
-        print(f'src_port: {k[SRC_PORT]}, dst_port: {k[DST_PORT]}, interval: {"{:.2f}".format(interval)} seconds')
-        throughput = flows[k][TOTAL_BYTES] * 8 / (interval * 1000000)
-        print(f'total: {flows[k][TOTAL_BYTES] * 8} bytes, throughput: {"{:.3f}".format(throughput)} Mbps')
+    for f in flows.values():
+        interval = float(f.interval)
+        print(f'src_port: {f.client_port}, dst_port: {f.server_port}, interval: {"{:.2f}".format(interval)} seconds')
+        throughput = f.total_bytes * 8 / (interval * 1000000) if interval > 0 else 0.0
+        print(f'total: {f.total_bytes * 8} bytes, throughput: {"{:.3f}".format(throughput)} Mbps')
         print()
 
     print(f'======== Part A. Q2(b) ========')
     loss_rates = {}
-    for k in flows:
-        port = k[SRC_PORT]
-        transmitted = 0
-        loss = 0
-        for sent_cnt, rev_cnt in seq_ack_counter[port].values():
-            transmitted += 1
-            if sent_cnt > 1:
-                loss += 1
-            elif rev_cnt > 1:
-                loss += 1
-        cur_loss_rate = loss / transmitted
-        print(f'loss: {loss}, transmitted: {transmitted}, port: {port}, loss rate: {cur_loss_rate}')
-        loss_rates[port] = cur_loss_rate
+    for k, f in flows.items():
+        loss = f.scoreboard.retransmissions - f.scoreboard.spurious
+        transmitted = f.scoreboard.data_segments
+        cur_loss_rate = loss / transmitted if transmitted else 0.0
+        print(f'loss: {loss}, transmitted: {transmitted}, port: {f.client_port}, loss rate: {cur_loss_rate}')
+        loss_rates[k] = cur_loss_rate
 
     print(f'\n======== Part A. Q2(c) ========')
-    rtt_by_port = {}
-    for k in flows:
-        rtt_cnt = 0
-        rtt_sum = 0
-        for [send_time, rev_time] in flows[k][RTT_INFO].values():
-            if rev_time > send_time:
-                rtt_cnt += 1
-                rtt_sum += rev_time - send_time
-        mss = flows[k][MSS]
-        avg_rtt = rtt_sum/rtt_cnt
-        port = k[SRC_PORT]
-        cur_loss_rate = loss_rates[port]
+    for k, f in flows.items():
+        if f.rtt.count == 0:
+            print(f'port: {f.client_port}, avg_rtt: no RTT sample')
+            continue
+        mss = f.mss
+        avg_rtt = f.rtt.mean
+        cur_loss_rate = loss_rates[k]
         theoretical_throughput = float('inf')
-        if cur_loss_rate > 0:
+        if cur_loss_rate > 0 and mss:
             theoretical_throughput = (math.sqrt(3 / 2) * mss * 8) / (avg_rtt * math.sqrt(cur_loss_rate)) / 1000000
-        print(f'port: {port}, avg_rtt: {"{:.6f}".format(avg_rtt)} s, MSS: {mss} bytes, '
+        print(f'port: {f.client_port}, avg_rtt: {"{:.6f}".format(avg_rtt)} s, '
+              f'srtt: {"{:.6f}".format(f.rtt.srtt)} s, rttvar: {"{:.6f}".format(f.rtt.rttvar)} s, '
+              f'samples: {f.rtt.count} ({"timestamps" if f.rtt.uses_ts else "Karn"}), MSS: {mss} bytes, '
               f'theoretical throughput: {"{:.5f}".format(theoretical_throughput)} Mbps')
-        rtt_by_port[port] = 0.08
 
     print(f'\n======== Part B (1) ========')
-    for k in flows:
-        port = k[SRC_PORT]
-        rtt = rtt_by_port[port]
-        pkt_list = list(flows[k][RTT_INFO].values())
-        pkt_list.sort(key=lambda x:x[0])    # sort by start time
-        pkt_list = pkt_list[1:]     # exclude handshake packets
-        st_time = flows[k][START_TIME]
-
-        pkt_df = pd.DataFrame(pkt_list, columns=["send_time", "rev_time"])
-        pkt_df["rtt_no"] = pkt_df.apply(lambda x: math.ceil((x['send_time']-st_time) / rtt), axis='columns')
-        pkt_df = pkt_df[pkt_df["rtt_no"] <= 10]
-        counts_in_rtt_dict = pkt_df.groupby('rtt_no').size().to_dict()
-        for sent_time_list in flows[k][SENT_TIME_LIST].values():
-            for t in sent_time_list[1:]:
-                rtt_no = math.ceil((t-st_time) / rtt)
-                if rtt_no <= 10:
-                    counts_in_rtt_dict[rtt_no] += 1
-        counts_in_rtt = list(counts_in_rtt_dict.values())
-
-        cwnd_increase_rate = []
-        for i, x in enumerate(counts_in_rtt):
-            if i == 0:
-                cwnd_increase_rate.append(1)
-            else:
-                cwnd_increase_rate.append(round(x / counts_in_rtt[i-1], 2))
-
-        cur_mss = flows[k][MSS]
-        print(f'src port: {port}, MSS: {cur_mss} bytes')
-        print(f'packet count of each RTT: {counts_in_rtt}')
-        print(f'congestion window size in each RTT: {[x * cur_mss for x in counts_in_rtt]}')
-        print(f'increase rate: {cwnd_increase_rate}')
+    for k, f in flows.items():
+        rtt = f.rtt.mean  # measured, was a hardcoded 0.08 s
+        cur_mss = f.mss or 0
+        print(f'src port: {f.client_port}, MSS: {f.mss} bytes')
+        if not f.sent or not rtt:
+            print('no data segment or no RTT sample')
+            print()
+            continue
+        send_time, send_seq, send_len = np.array(f.sent, dtype=np.float64).T
+        ack_time, ack = np.array(f.acks, dtype=np.float64).reshape(-1, 2).T
+        trace = reconstruct_cwnd(send_time, send_seq.astype(np.int64), send_len, ack_time, ack.astype(np.int64),
+                                 f.start_time, rtt)
+
+        print(f'RTT rounds with data: {trace.rounds.tolist()}')
+        print(f'packet count of each RTT: {trace.packets.tolist()}')
+        print(f'congestion window size in each RTT: {(trace.packets * cur_mss).tolist()}')
+        print(f'max bytes in flight in each RTT: {trace.max_flight.tolist()}')
+        print(f'increase rate: {[round(x, 2) for x in trace.increase_rate.tolist()]}')
+        if trace.ss_exit_round is None:
+            print('slow start exit: none')
+        else:
+            print(f'slow start exit: RTT {trace.ss_exit_round} ({trace.ss_exit_reason})')
+        for start, end, retransmitted in trace.recoveries:
+            duration = f'{"{:.6f}".format(end - start)} s' if end is not None else 'not over'
+            print(f'loss recovery at {"{:.6f}".format(start - f.start_time)} s: {duration}, '
+                  f'retransmitted: {retransmitted}')
         print()
 
     print(f'\n======== Part B (2) ========')
-    for k in flows:
-        port = k[SRC_PORT]
-        print(f'src port: {port}')
-        retransmission = 0
-        dup_acks = 0
-        for sent_cnt, rev_cnt in seq_ack_counter[port].values():
-            if sent_cnt > 1:
-                retransmission += 1
-            elif rev_cnt > 1:
-                dup_acks += 1
-        print(f'retransmitted by dupACKs: {dup_acks}')
-        print(f'retransmitted by timeout: {retransmission}')
+    for f in flows.values():
+        board = f.scoreboard
+        print(f'src port: {f.client_port}')
+        print(f'retransmitted by dupACKs: {board.fast_retransmits}')
+        print(f'retransmitted by timeout: {board.rto_retransmits}')
+        print(f'spurious retransmissions: {board.spurious}, retransmitted bytes: {board.retransmitted_bytes}, '
+              f'SACKed bytes: {board.sacked_bytes}')
         print()
+    return flows
 
 
-if __name__ == '__main__':
-    sender = "130.245.145.12"
-    receiver = "128.208.2.198"
+def write_rtt_series(flows, path):
+    """Write the RTT samples of every flow, with SRTT / RTTVAR after each one, as CSV."""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['client', 'client_port', 'server', 'server_port', 'time', 'rtt', 'srtt', 'rttvar'])
+        for flow in flows.values():
+            for ts, sample, srtt, rttvar in flow.rtt.series:
+                writer.writerow([flow.client, flow.client_port, flow.server, flow.server_port, ts, sample, srtt,
+                                 rttvar])
 
-    pcap_path = "./assignment2.pcap"
-    if len(sys.argv) > 1: pcap_path = sys.argv[1]
 
-    count_tcp_flows(pcap_path, sender)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyze the TCP flows of a pcap file')
+    parser.add_argument('pcap_path', nargs='?', default="./assignment2.pcap")
+    parser.add_argument('--sender', help='only the flows opened by this IP (default: every flow)')
+    parser.add_argument('--parallel', type=int, metavar='WORKERS',
+                        help='per-flow summary only, computed by WORKERS processes (0: one per core)')
+    parser.add_argument('--streaming', action='store_true',
+                        help='per-flow summary only, in one pass with memory bounded by the concurrent flows')
+    parser.add_argument('--rtt-series', metavar='FILE', help='write the per-flow RTT time series to FILE as CSV')
+    args = parser.parse_args()
+
+    if args.parallel is not None:
+        capture_counters = CaptureCounters()
+        for flow in analyze_parallel(args.pcap_path, args.parallel or None, counters=capture_counters):
+            print_flow(flow)
+        if capture_counters.skipped:
+            print(f'frames skipped (not decodable): {capture_counters.skipped}')
+    elif args.streaming:
+        for flow in stream_flows(args.pcap_path):
+            print_flow(flow)
+    else:
+        tcp_flows = count_tcp_flows(args.pcap_path, args.sender, args.rtt_series is not None)
+        if args.rtt_series:
+            write_rtt_series(tcp_flows, args.rtt_series)
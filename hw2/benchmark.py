@@ -0,0 +1,126 @@
+# -*- coding:utf-8 -*-
+
+"""
+Packets per second of the header decoders on the frames of some captures, every decoder reading the same fields
+(addresses, ports, sequence numbers, flags, window, timestamps, SACK blocks, payload length):
+  - Packet classes: ip_pkg / tcp_pkg views, options parsed into a dict;
+  - FrameDecoder: one object reused for every frame;
+  - dpkt (if installed), the parser these scripts used first;
+  - pcap_table.decode_tcp, the vectorized decoder, for reference.
+Frames are read into memory first, so only decoding is timed.
+
+    python benchmark.py http_1080.pcap tcp_1081.pcap tcp_1082.pcap --repeat 5
+"""
+import argparse
+import socket
+import time
+
+import numpy as np
+
+from Packet import FrameDecoder, LINKTYPE_ETHERNET, PcapReader, ip_pkg, tcp_pkg
+from pcap_table import decode_tcp, record_index
+
+try:
+    import dpkt
+except ImportError:  # optional
+    dpkt = None
+
+
+def load_frames(paths):
+    """[(frame bytes, link type)] of every record of the captures."""
+    frames = []
+    for path in paths:
+        with PcapReader(path) as pcap:
+            buf = pcap.buf
+            frames += [(bytes(buf[data_offset:data_offset + caplen]), linktype)
+                       for _, data_offset, caplen, _, _, linktype in pcap.records()]
+    return frames
+
+
+def run_classes(frames):
+    segments = 0
+    for frame, linktype in frames:
+        ip = ip_pkg(frame, linktype)
+        if ip is None: continue
+        tcp = tcp_pkg(ip)
+        if tcp is None: continue
+        _ = (ip.src, ip.dst, tcp.src_port, tcp.dst_port, tcp.seq, tcp.ack, tcp.flags, tcp.win_size, tcp.tsval,
+             tcp.tsecr, tcp.sack, len(tcp.data))
+        segments += 1
+    return segments
+
+
+def run_decoder(frames):
+    segments = 0
+    decoder = FrameDecoder()
+    for frame, linktype in frames:
+        if not decoder.decode(frame, linktype): continue
+        _ = (decoder.src, decoder.dst, decoder.src_port, decoder.dst_port, decoder.seq, decoder.ack, decoder.flags,
+             decoder.win_size, decoder.tsval, decoder.tsecr, decoder.sack, decoder.payload_len)
+        segments += 1
+    return segments
+
+
+def run_dpkt(frames):
+    segments = 0
+    for frame, linktype in frames:
+        if linktype != LINKTYPE_ETHERNET: continue
+        eth = dpkt.ethernet.Ethernet(frame)
+        ip = eth.data
+        if not isinstance(ip, (dpkt.ip.IP, dpkt.ip6.IP6)) or not isinstance(ip.data, dpkt.tcp.TCP): continue
+        tcp = ip.data
+        family = socket.AF_INET if isinstance(ip, dpkt.ip.IP) else socket.AF_INET6
+        opts = dict(dpkt.tcp.parse_opts(tcp.opts))
+        timestamp = opts.get(dpkt.tcp.TCP_OPT_TIMESTAMP)
+        _ = (socket.inet_ntop(family, ip.src), socket.inet_ntop(family, ip.dst), tcp.sport, tcp.dport, tcp.seq,
+             tcp.ack, tcp.flags, tcp.win, timestamp, opts.get(dpkt.tcp.TCP_OPT_SACK), len(tcp.data))
+        segments += 1
+    return segments
+
+
+def run_table(paths):
+    segments = 0
+    for path in paths:
+        with PcapReader(path) as reader:
+            offsets, frames, ts, caplen, wire_len, linktype, _ = record_index(reader)
+            table = decode_tcp(np.frombuffer(reader.buf, dtype=np.uint8), offsets, frames, ts, caplen, wire_len,
+                               linktype)
+            segments += len(table)
+    return segments
+
+
+def measure(func, arg, repeat):
+    """(segments decoded, best time of repeat runs)."""
+    best = None
+    segments = 0
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        segments = func(arg)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return segments, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Packets per second of the header decoders')
+    parser.add_argument('captures', nargs='*', default=['http_1080.pcap', 'tcp_1081.pcap', 'tcp_1082.pcap'])
+    parser.add_argument('--repeat', type=int, default=5, help='runs per decoder, the best one is kept')
+    args = parser.parse_args()
+
+    frames = load_frames(args.captures)
+    runs = [('Packet classes', run_classes, frames), ('FrameDecoder', run_decoder, frames)]
+    if dpkt is not None:
+        runs.append(('dpkt', run_dpkt, frames))
+    runs.append(('pcap_table (vectorized)', run_table, args.captures))
+    print(f'{len(frames)} frames')
+    print(f'{"decoder":<24}  {"TCP segments":>12}  {"packets/s":>12}  {"speedup":>8}')
+    baseline = None
+    for label, func, arg in runs:
+        segments, elapsed = measure(func, arg, args.repeat)
+        rate = len(frames) / elapsed
+        baseline = baseline or rate
+        print(f'{label:<24}  {segments:>12}  {"{:.0f}".format(rate):>12}  {"{:.2f}".format(rate / baseline):>8}')
+
+
+if __name__ == "__main__":
+    main()
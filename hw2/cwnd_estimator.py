@@ -0,0 +1,100 @@
+# -*- coding:utf-8 -*-
+
+"""
+Congestion window reconstruction of one direction of a TCP connection, from the data segments it sent and the
+ACKs it got back, with array operations over the whole flow:
+  - segments are binned into RTT rounds from the start of the connection (round = ceil((t - start) / rtt));
+  - bytes in flight after each send is snd_nxt - snd_una, snd_una being the highest ACK seen before the send;
+  - a loss recovery episode starts with a retransmission and ends with the first ACK covering everything sent
+    before it (the recovery point of RFC 6582);
+  - slow start ends with the first recovery episode, or with the first round that does not grow the flight
+    by SS_GROWTH over the previous one.
+"""
+import numpy as np
+
+from rtt_estimator import SEQ_MOD
+
+SS_GROWTH = 1.5  # slow start about doubles the flight every round
+
+
+def unwrap_seq(x, base):
+    """32 bit sequence numbers as int64 offsets from base, negative for the ones before it."""
+    rel = (np.asarray(x, dtype=np.int64) - base) % SEQ_MOD
+    return np.where(rel >= SEQ_MOD // 2, rel - SEQ_MOD, rel)
+
+
+class CwndTrace(object):
+    """
+    Per send (arrays aligned with the segments): time, flight (bytes in flight after it), retransmitted.
+    Per round (arrays aligned with rounds, the non-empty ones only): packets, bytes, max_flight.
+    recoveries: [(start time, end time or None if not over at the end of the capture, retransmitted segments)].
+    ss_exit_round / ss_exit_reason ('loss' or 'growth'): end of slow start, None if still in it.
+    """
+    __slots__ = ('time', 'flight', 'retransmitted', 'rounds', 'packets', 'bytes', 'max_flight', 'recoveries',
+                 'ss_exit_round', 'ss_exit_reason')
+
+    @property
+    def increase_rate(self):
+        """Packets of each round over the previous round, 1 for the first."""
+        rate = np.ones(len(self.packets))
+        rate[1:] = self.packets[1:] / self.packets[:-1]
+        return rate
+
+
+def reconstruct_cwnd(send_time, send_seq, send_len, ack_time, ack, start_time, rtt):
+    """
+    send_*: the data segments of one direction in capture order, ack_*: the ACK numbers coming back, in capture
+    order too; start_time: time of the SYN; rtt: length of a round in seconds.
+    """
+    send_time = np.asarray(send_time, dtype=np.float64)
+    send_len = np.asarray(send_len, dtype=np.int64)
+    ack_time = np.asarray(ack_time, dtype=np.float64)
+    trace = CwndTrace()
+    trace.time = send_time
+    trace.recoveries = []
+    trace.ss_exit_round = trace.ss_exit_reason = None
+    if len(send_time) == 0:
+        trace.flight = trace.rounds = trace.packets = trace.bytes = trace.max_flight = np.zeros(0, dtype=np.int64)
+        trace.retransmitted = np.zeros(0, dtype=bool)
+        return trace
+
+    base = int(send_seq[0])
+    end = unwrap_seq(send_seq, base) + send_len
+    prev_nxt = np.maximum.accumulate(np.concatenate(([0], end[:-1])))  # snd_nxt before each send
+    snd_nxt = np.maximum(prev_nxt, end)
+    trace.retransmitted = end <= prev_nxt
+    acked = np.maximum.accumulate(unwrap_seq(ack, base)) if len(ack_time) else np.zeros(0, dtype=np.int64)
+    seen = np.searchsorted(ack_time, send_time, side='right')  # ACKs seen before each send
+    snd_una = np.where(seen > 0, acked[np.maximum(seen - 1, 0)] if len(acked) else 0, 0)
+    trace.flight = np.maximum(snd_nxt - np.maximum(snd_una, 0), 0)
+
+    round_no = np.maximum(np.ceil((send_time - start_time) / rtt), 0).astype(np.int64)
+    packets = np.bincount(round_no)
+    trace.rounds = np.flatnonzero(packets)
+    trace.packets = packets[trace.rounds]
+    trace.bytes = np.bincount(round_no, weights=send_len).astype(np.int64)[trace.rounds]
+    max_flight = np.zeros(len(packets), dtype=np.int64)
+    np.maximum.at(max_flight, round_no, trace.flight)
+    trace.max_flight = max_flight[trace.rounds]
+
+    retransmissions = np.flatnonzero(trace.retransmitted)
+    for i in retransmissions:  # one loop step per retransmission, episodes are sequential
+        if trace.recoveries and (trace.recoveries[-1][1] is None or send_time[i] < trace.recoveries[-1][1]):
+            continue
+        covered = np.searchsorted(acked, prev_nxt[i])  # first ACK at or past the recovery point
+        covered += np.searchsorted(ack_time[covered:], send_time[i], side='right')  # and after the retransmission
+        end_time = float(ack_time[covered]) if covered < len(ack_time) else None
+        in_episode = send_time[retransmissions] >= send_time[i]
+        if end_time is not None:
+            in_episode &= send_time[retransmissions] < end_time
+        trace.recoveries.append((float(send_time[i]), end_time, int(in_episode.sum())))
+
+    loss_round = int(round_no[retransmissions[0]]) if len(retransmissions) else None
+    growth = trace.max_flight[1:] < SS_GROWTH * trace.max_flight[:-1]
+    growth[-1:] = False  # the last round is cut by the end of the data, not by the window
+    growth_round = int(trace.rounds[1:][growth][0]) if growth.any() else None
+    if loss_round is not None and (growth_round is None or loss_round <= growth_round):
+        trace.ss_exit_round, trace.ss_exit_reason = loss_round, 'loss'
+    elif growth_round is not None:
+        trace.ss_exit_round, trace.ss_exit_reason = growth_round, 'growth'
+    return trace
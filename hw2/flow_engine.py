@@ -0,0 +1,272 @@
+# -*- coding:utf-8 -*-
+
+"""
+Single-pass TCP flow engine. Packets are fed in capture order; a flow is created by its SYN, updated in place and
+handed to on_flow (then forgotten) once both FINs are acknowledged, on RST, or after idle_timeout seconds of capture
+time without packets. Per-flow state is constant size (RTTs go to fixed-size sketches, unacknowledged segments are
+capped, retransmission scoreboards are trimmed at snd_una), so memory depends on the number of concurrent flows, not
+on the length of the capture.
+
+    python flow_engine.py capture.pcap [idle_timeout]
+"""
+import math
+import sys
+from collections import OrderedDict
+
+from Packet import *
+from rtt_estimator import SEQ_MOD, RTTEstimator
+from seq_scoreboard import Scoreboard
+
+TH_RST = 0x04
+
+# directions inside a flow
+CLIENT_TO_SERVER = 0  # sender of the SYN
+SERVER_TO_CLIENT = 1
+
+
+def flow_key(src, src_port, dst, dst_port):
+    """Canonical bidirectional 5-tuple: the same for both directions of a TCP conversation."""
+    if (src, src_port) < (dst, dst_port):
+        return IP_PROTO_TCP, src, src_port, dst, dst_port
+    return IP_PROTO_TCP, dst, dst_port, src, src_port
+
+
+class RTTSketch(object):
+    """
+    Fixed-size RTT summary: exact count / mean / min / max plus a log-scale histogram for quantiles,
+    BUCKETS_PER_OCTAVE buckets per doubling from 1 us up, i.e. about 9% relative error.
+    """
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+    BUCKETS_PER_OCTAVE = 8
+    MIN_RTT = 1e-6
+    N_BUCKETS = BUCKETS_PER_OCTAVE * 28  # up to ~268 s
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = [0] * self.N_BUCKETS
+
+    def add(self, rtt):
+        self.count += 1
+        self.total += rtt
+        self.min = min(self.min, rtt)
+        self.max = max(self.max, rtt)
+        i = int(math.log2(max(rtt, self.MIN_RTT) / self.MIN_RTT) * self.BUCKETS_PER_OCTAVE)
+        self.buckets[min(i, self.N_BUCKETS - 1)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.buckets = [x + y for x, y in zip(self.buckets, other.buckets)]
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def quantile(self, q):
+        """Geometric middle of the bucket holding the q-quantile, clamped to [min, max]."""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen > rank:
+                value = self.MIN_RTT * 2 ** ((i + 0.5) / self.BUCKETS_PER_OCTAVE)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+
+class FlowRecord(object):
+    """State of one TCP connection, indexed by direction (CLIENT_TO_SERVER / SERVER_TO_CLIENT) where it matters."""
+    __slots__ = ('client', 'client_port', 'server', 'server_port', 'start_time', 'last_time', 'mss', 'win_scale',
+                 'packets', 'bytes', 'payload_bytes', 'scoreboard', 'rtt', 'rtt_estimator', 'max_in_flight',
+                 'fin_ack', 'fin_acked', 'reset', 'close_reason')
+
+    def __init__(self, client, client_port, server, server_port, ts, max_pending=1024):
+        self.client = client
+        self.client_port = client_port
+        self.server = server
+        self.server_port = server_port
+        self.start_time = ts
+        self.last_time = ts
+        self.mss = [None, None]
+        self.win_scale = [None, None]
+        self.packets = [0, 0]
+        self.bytes = [0, 0]
+        self.payload_bytes = [0, 0]
+        self.scoreboard = [Scoreboard(), Scoreboard()]  # retransmissions of each direction
+        self.rtt = [RTTSketch(), RTTSketch()]  # RTT samples of the segments sent in each direction
+        self.rtt_estimator = [RTTEstimator(max_pending=max_pending), RTTEstimator(max_pending=max_pending)]
+        self.max_in_flight = [0, 0]  # largest flight size seen, the cwnd estimate at the capture point
+        self.fin_ack = [None, None]  # ack number acknowledging the FIN sent in each direction
+        self.fin_acked = [False, False]
+        self.reset = False
+        self.close_reason = None  # 'fin', 'rst', 'idle' or 'eof' once emitted
+
+    @property
+    def done(self):
+        return self.reset or (self.fin_acked[0] and self.fin_acked[1])
+
+    @property
+    def duration(self):
+        return self.last_time - self.start_time
+
+    def loss_rate(self, direction):
+        """Share of the data segments sent in direction that were needed retransmissions."""
+        board = self.scoreboard[direction]
+        return (board.retransmissions - board.spurious) / board.data_segments if board.data_segments else 0.0
+
+    def throughput(self, direction):
+        """Bits per second sent in direction, frame bytes included."""
+        return self.bytes[direction] * 8 / self.duration if self.duration > 0 else 0.0
+
+    def update(self, ts, direction, tcp, payload_len, wire_len):
+        self.last_time = ts
+        self.packets[direction] += 1
+        self.bytes[direction] += wire_len
+        self.payload_bytes[direction] += payload_len
+        flags = tcp.flags
+        if flags & TH_SYN:
+            self.mss[direction] = tcp.MSS
+            self.win_scale[direction] = tcp.win_scale
+        if flags & TH_RST:
+            self.reset = True
+            return
+
+        seq_len = payload_len + (1 if flags & TH_SYN else 0) + (1 if flags & TH_FIN else 0)
+        if seq_len:
+            estimator = self.rtt_estimator[direction]
+            estimator.on_send(ts, tcp.seq, seq_len, tcp.tsval)
+            if payload_len:
+                self.scoreboard[direction].on_send(ts, tcp.seq, payload_len, tcp.tsval)
+            if estimator.snd_una is not None:
+                in_flight = (estimator.snd_nxt - estimator.snd_una) % SEQ_MOD
+                self.max_in_flight[direction] = max(self.max_in_flight[direction], in_flight)
+            if flags & TH_FIN:
+                self.fin_ack[direction] = (tcp.seq + seq_len) % SEQ_MOD
+
+        if flags & TH_ACK:
+            other = 1 - direction
+            sample = self.rtt_estimator[other].on_ack(ts, tcp.ack, tcp.tsecr)
+            self.scoreboard[other].on_ack(ts, tcp.ack, tcp.sack, tcp.tsecr, payload_len, tcp.win_size,
+                                          flags & (TH_SYN | TH_FIN))
+            if sample is not None:
+                self.rtt[other].add(sample)
+            if self.fin_ack[other] is not None and tcp.ack == self.fin_ack[other]:
+                self.fin_acked[other] = True
+
+
+class FlowEngine(object):
+    """
+    Feed frames with feed(ts, buf, linktype, wire_len) (or decoded packets with process), finished flows go to
+    on_flow(FlowRecord). Packets of flows whose SYN was not seen (mid-stream, or late after the flow was emitted)
+    are only counted.
+    """
+
+    def __init__(self, on_flow, idle_timeout=120.0, max_pending=1024):
+        self.on_flow = on_flow
+        self.idle_timeout = idle_timeout
+        self.max_pending = max_pending
+        self.flows = OrderedDict()  # {flow_key: FlowRecord}, least recent first
+        self.skipped = 0
+        self._decoder = FrameDecoder()
+
+    def feed(self, ts, buf, linktype=LINKTYPE_ETHERNET, wire_len=None):
+        """
+        Process a frame of wire_len bytes on the wire (default: as captured), False if it is not a TCP segment over
+        IP (or is cut short).
+        """
+        decoder = self._decoder
+        if not decoder.decode(buf, linktype):
+            return False
+        self.process(ts, decoder.src, decoder.dst, decoder, decoder.payload_len,
+                     len(buf) if wire_len is None else wire_len)
+        return True
+
+    def process(self, ts, src, dst, tcp, payload_len, wire_len):
+        key = flow_key(src, tcp.src_port, dst, tcp.dst_port)
+        flow = self.flows.get(key)
+        if flow is None:
+            if tcp.flags & (TH_SYN | TH_ACK) != TH_SYN:
+                self.skipped += 1
+                self.expire(ts)
+                return
+            flow = self.flows[key] = FlowRecord(src, tcp.src_port, dst, tcp.dst_port, ts, self.max_pending)
+        else:
+            self.flows.move_to_end(key)
+        if tcp.src_port == flow.client_port and src == flow.client:
+            direction = CLIENT_TO_SERVER
+        else:
+            direction = SERVER_TO_CLIENT
+
+        flow.update(ts, direction, tcp, payload_len, wire_len)
+        if flow.done:
+            self._emit(key, 'rst' if flow.reset else 'fin')
+        self.expire(ts)
+
+    def expire(self, now):
+        """Emit the flows idle for more than idle_timeout at capture time now."""
+        while self.flows:
+            key, flow = next(iter(self.flows.items()))
+            if now - flow.last_time <= self.idle_timeout:
+                break
+            self._emit(key, 'idle')
+
+    def flush(self):
+        """End of capture: emit every flow still open."""
+        while self.flows:
+            self._emit(next(iter(self.flows)), 'eof')
+
+    def _emit(self, key, reason):
+        flow = self.flows.pop(key)
+        flow.close_reason = reason
+        self.on_flow(flow)
+
+
+def stream_flows(pcap_path, idle_timeout=120.0):
+    """Yield the FlowRecords of pcap_path as they finish, reading the capture once."""
+    finished = []
+    engine = FlowEngine(finished.append, idle_timeout)
+    with PcapReader(pcap_path) as pcap:
+        buf = pcap.buf
+        for _, data_offset, caplen, wire_len, ts, linktype in pcap.records():
+            engine.feed(ts, buf[data_offset:data_offset + caplen], linktype, wire_len)
+            if finished:
+                yield from finished
+                finished.clear()
+    engine.flush()
+    yield from finished
+
+
+def format_rtt(sketch, estimator):
+    if sketch.count == 0:
+        return 'no samples'
+    return f'avg: {"{:.6f}".format(sketch.mean)} s, p50: {"{:.6f}".format(sketch.quantile(0.5))} s, ' \
+           f'p95: {"{:.6f}".format(sketch.quantile(0.95))} s, srtt: {"{:.6f}".format(estimator.srtt)} s, ' \
+           f'rttvar: {"{:.6f}".format(estimator.rttvar)} s, samples: {sketch.count}'
+
+
+def print_flow(f):
+    print(f'{f.client}:{f.client_port} -> {f.server}:{f.server_port}, closed by: {f.close_reason}, '
+          f'interval: {"{:.2f}".format(f.duration)} s, MSS: {f.mss[CLIENT_TO_SERVER]} bytes')
+    for direction, title in [(CLIENT_TO_SERVER, 'client -> server'), (SERVER_TO_CLIENT, 'server -> client')]:
+        board = f.scoreboard[direction]
+        print(f'  {title}: packets: {f.packets[direction]}, bytes: {f.bytes[direction]}, '
+              f'payload: {f.payload_bytes[direction]}, retransmissions: {board.retransmissions} '
+              f'(fast: {board.fast_retransmits}, rto: {board.rto_retransmits}, spurious: {board.spurious}), '
+              f'SACKed: {board.sacked_bytes} bytes, '
+              f'loss rate: {"{:.4f}".format(f.loss_rate(direction))}, '
+              f'throughput: {"{:.3f}".format(f.throughput(direction) / 1000000)} Mbps, '
+              f'max in flight: {f.max_in_flight[direction]} bytes')
+        print(f'  {title} RTT: {format_rtt(f.rtt[direction], f.rtt_estimator[direction])}')
+
+
+if __name__ == '__main__':
+    timeout = float(sys.argv[2]) if len(sys.argv) > 2 else 120.0
+    for flow in stream_flows(sys.argv[1], timeout):
+        print_flow(flow)
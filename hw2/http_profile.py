@@ -0,0 +1,206 @@
+# -*- coding:utf-8 -*-
+
+"""
+Protocol behavior of the web servers in a set of captures, one process per capture. For each server port:
+  - protocol: HTTP version answered, 'h2c', or the ALPN protocol of the TLS handshake;
+  - connection reuse: connections, requests per connection, connections open at once;
+  - pipelining depth: most requests sent on a connection before the response of the first one started;
+  - multiplexing: HTTP/2 (h2c or ALPN h2) carries concurrent streams on one connection;
+  - packets and bytes on the wire, page load time (first SYN to last response byte) and mean TTFB.
+Requests of non-HTTP/1.x streams are client turns (see http_stream), so their pipelining depth is not known.
+Each capture is read once, from its index (pcap_index), for both the profiles and the transaction listing.
+
+    python http_profile.py capture.pcap[:port] ... [--workers N]
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from http_stream import HTTPTracker
+from pcap_index import iter_payloads, load_index
+
+
+class PortProfile(object):
+    """Totals of the connections to one server port of one capture."""
+    __slots__ = ('capture', 'port', 'protocols', 'connections', 'max_parallel', 'transactions', 'reused',
+                 'max_per_connection', 'max_pipelining', 'packets', 'bytes', 'start_time', 'end_time', 'ttfb_total',
+                 'ttfb_count', '_intervals')
+
+    def __init__(self, capture, port):
+        self.capture = capture
+        self.port = port
+        self.protocols = {}  # {protocol: connections}
+        self.connections = 0
+        self.max_parallel = 0
+        self.transactions = 0
+        self.reused = 0  # connections carrying more than one request
+        self.max_per_connection = 0
+        self.max_pipelining = None  # unknown if every connection is opaque
+        self.packets = 0
+        self.bytes = 0
+        self.start_time = None
+        self.end_time = None
+        self.ttfb_total = 0.0
+        self.ttfb_count = 0
+        self._intervals = []  # (start, end) of every connection, for max_parallel
+
+    @property
+    def protocol(self):
+        """Protocol of most connections."""
+        if not self.protocols:
+            return 'unknown'
+        return max(self.protocols.items(), key=lambda item: item[1])[0]
+
+    @property
+    def multiplexing(self):
+        protocol = self.protocol
+        if protocol in ('h2c', 'TLS h2'):
+            return 'yes'
+        if protocol.startswith('HTTP/') or protocol == 'TLS http/1.1':
+            return 'no'
+        return '?'
+
+    @property
+    def requests_per_connection(self):
+        return self.transactions / self.connections if self.connections else 0.0
+
+    @property
+    def load_time(self):
+        return self.end_time - self.start_time if self.start_time is not None else 0.0
+
+    @property
+    def mean_ttfb(self):
+        return self.ttfb_total / self.ttfb_count if self.ttfb_count else None
+
+    def add_transaction(self, txn):
+        if txn.res_start is None:
+            return
+        self.end_time = txn.res_end if self.end_time is None else max(self.end_time, txn.res_end)
+        if txn.ttfb is not None:
+            self.ttfb_total += txn.ttfb
+            self.ttfb_count += 1
+
+    def add_connection(self, conn):
+        protocol = conn.protocol or 'unknown'
+        self.protocols[protocol] = self.protocols.get(protocol, 0) + 1
+        self.connections += 1
+        self.transactions += conn.transactions
+        self.reused += conn.transactions > 1
+        self.max_per_connection = max(self.max_per_connection, conn.transactions)
+        if not conn.opaque:
+            self.max_pipelining = max(self.max_pipelining or 0, conn.max_outstanding)
+        self.packets += conn.packets
+        self.bytes += conn.bytes
+        self.start_time = conn.start_time if self.start_time is None else min(self.start_time, conn.start_time)
+        self._intervals.append((conn.start_time, conn.end_time))
+
+    def finish(self):
+        """Count the connections open at once, once every connection was added."""
+        events = sorted([(start, 1) for start, _ in self._intervals] + [(end, -1) for _, end in self._intervals],
+                        key=lambda event: (event[0], event[1]))  # an end before a start at the same time
+        open_connections = 0
+        for _, delta in events:
+            open_connections += delta
+            self.max_parallel = max(self.max_parallel, open_connections)
+        self._intervals = []
+        if self.end_time is None:
+            self.end_time = self.start_time
+
+
+class CaptureHTTP(object):
+    """
+    One pass over a capture: profiles ([PortProfile] by port), transactions ({(client port, server port):
+    [Transaction]} in order of completion, None if not kept), and the records / IP bytes of the capture.
+    """
+    __slots__ = ('capture', 'port', 'profiles', 'transactions', 'packet_total', 'ip_bytes')
+
+    def __init__(self, capture, port, profiles, transactions, packet_total, ip_bytes):
+        self.capture = capture
+        self.port = port
+        self.profiles = profiles
+        self.transactions = transactions
+        self.packet_total = packet_total
+        self.ip_bytes = ip_bytes
+
+
+def analyze_capture(pcap_path, port=None, keep_transactions=True):
+    """CaptureHTTP of the connections of pcap_path to port (every server port if None)."""
+    profiles = {}
+    transactions = {} if keep_transactions else None
+
+    def profile_of(conn):
+        if conn.server_port not in profiles:
+            profiles[conn.server_port] = PortProfile(pcap_path, conn.server_port)
+        return profiles[conn.server_port]
+
+    def on_transaction(conn, txn):
+        profile_of(conn).add_transaction(txn)
+        if transactions is not None:
+            transactions.setdefault((conn.client_port, conn.server_port), []).append(txn)
+
+    tracker = HTTPTracker(on_transaction, port, lambda conn: profile_of(conn).add_connection(conn))
+    ts = None
+    for segment, payload in iter_payloads(pcap_path, port):
+        ts = segment.time
+        tracker.feed(ts, segment.src_ip, segment.dst_ip, segment, payload, segment.wire_len)
+    tracker.flush(ts)
+    for profile in profiles.values():
+        profile.finish()
+    index = load_index(pcap_path)
+    return CaptureHTTP(pcap_path, port, [profiles[p] for p in sorted(profiles)], transactions, index.packet_total,
+                       index.ip_bytes)
+
+
+def profile_capture(pcap_path, port=None):
+    """[PortProfile] of the connections of pcap_path to port (every server port if None), by port."""
+    return analyze_capture(pcap_path, port, keep_transactions=False).profiles
+
+
+def parse_capture(arg):
+    """'path[:port]' -> (path, port or None)."""
+    path, sep, port = arg.rpartition(':')
+    if sep and port.isdigit() and path:
+        return path, int(port)
+    return arg, None
+
+
+def analyze_captures(captures, workers=None, keep_transactions=True):
+    """[CaptureHTTP] of every (pcap path, port or None) of captures, in order, one capture per process."""
+    if not captures:
+        return []
+    workers = min(workers or os.cpu_count(), len(captures))
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(analyze_capture, [path for path, _ in captures], [port for _, port in captures],
+                             [keep_transactions] * len(captures)))
+
+
+def profile_captures(captures, workers=None):
+    """[PortProfile] of every (pcap path, port or None) of captures, in order, one capture per process."""
+    return [profile for result in analyze_captures(captures, workers, False) for profile in result.profiles]
+
+
+def format_table(profiles):
+    """The profiles as an aligned comparison table, one row per capture and port."""
+    header = ['capture', 'port', 'protocol', 'multiplexing', 'conns', 'max parallel', 'requests', 'req/conn',
+              'reused conns', 'max pipelined', 'packets', 'bytes', 'load time (s)', 'mean TTFB (s)']
+    rows = [header]
+    for p in profiles:
+        rows.append([os.path.basename(p.capture), str(p.port), p.protocol, p.multiplexing, str(p.connections),
+                     str(p.max_parallel), str(p.transactions), "{:.2f}".format(p.requests_per_connection),
+                     str(p.reused), '-' if p.max_pipelining is None else str(p.max_pipelining),
+                     str(p.packets), str(p.bytes),
+                     "{:.3f}".format(p.load_time),
+                     "{:.6f}".format(p.mean_ttfb) if p.mean_ttfb is not None else '-'])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = ['  '.join(cell.ljust(width) if i < 4 else cell.rjust(width)
+                       for i, (cell, width) in enumerate(zip(row, widths))) for row in rows]
+    lines.insert(1, '  '.join('-' * width for width in widths))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the HTTP behavior of the servers in several captures')
+    parser.add_argument('captures', nargs='+', metavar='PCAP[:PORT]', help='capture, and the server port to keep')
+    parser.add_argument('--workers', type=int, help='processes (default: one per core)')
+    args = parser.parse_args()
+    print(format_table(profile_captures([parse_capture(c) for c in args.captures], args.workers)))
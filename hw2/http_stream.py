@@ -0,0 +1,520 @@
+# -*- coding:utf-8 -*-
+
+"""
+Streaming HTTP/1.x transaction reconstruction. Each direction of a TCP connection is reassembled into its in-order
+byte stream (out-of-order segments wait in a bounded buffer, retransmitted bytes are dropped), and the stream is
+parsed incrementally into messages framed by Content-Length, chunked transfer coding or the end of the connection.
+Only the message heads and the framing state are kept, bodies are counted and dropped, so memory depends on the
+number of open connections, not on the size of the capture.
+
+Requests and responses are paired in order (pipelining included) into Transactions:
+  - TTFB: from the last byte of the request to the first byte of the response;
+  - transfer time: from the first to the last byte of the response.
+Streams that are not HTTP/1.x (TLS, HTTP/2) are split into exchanges instead: the bytes the client sends after the
+server spoke open a new request, the server bytes that follow are its response.
+"""
+import re
+from collections import OrderedDict, deque
+
+from Packet import TH_ACK, TH_FIN, TH_SYN
+from flow_engine import TH_RST, flow_key
+from rtt_estimator import SEQ_MOD
+
+TLS_HANDSHAKE = 22  # TLS record content type
+TLS_SERVER_HELLO = 2  # handshake message type
+TLS_EXT_ALPN = 16
+MAX_HEAD = 1 << 16  # longest message head (start line + headers) before the stream is deemed not HTTP
+MAX_PENDING = 1 << 20  # out-of-order bytes buffered per direction before skipping the gap
+PREFIX_BYTES = 1024  # first bytes of each direction kept, to identify the protocol of opaque streams
+MAX_CLOSED = 4096  # closed connections remembered, so that their late segments do not open new ones
+_request_line = re.compile(rb'([A-Z]+) (\S+) HTTP/(\d\.\d)\r\n')
+_status_line = re.compile(rb'HTTP/(\d\.\d) (\d{3})[^\r\n]*\r\n')
+
+
+def _seq_offset(seq, ref):
+    """Signed distance from ref to seq in the 32 bit sequence space."""
+    d = (seq - ref) % SEQ_MOD
+    return d - SEQ_MOD if d >= SEQ_MOD // 2 else d
+
+
+class ByteStream(object):
+    """
+    In-order reconstruction of one direction: feed segments in capture order, data reaches on_data(ts, bytes) in
+    stream order exactly once; on_gap(ts, n) reports n bytes never captured, skipped to go on.
+    """
+    __slots__ = ('next_seq', 'fin_seq', 'pending', 'pending_bytes', 'max_pending', 'on_data', 'on_gap', 'gap_bytes')
+
+    def __init__(self, on_data, on_gap, max_pending=MAX_PENDING):
+        self.next_seq = None
+        self.fin_seq = None  # sequence number of the FIN, once seen
+        self.pending = {}  # {seq: bytes} received ahead of next_seq
+        self.pending_bytes = 0
+        self.max_pending = max_pending
+        self.on_data = on_data
+        self.on_gap = on_gap
+        self.gap_bytes = 0
+
+    def syn(self, seq):
+        self.next_seq = (seq + 1) % SEQ_MOD
+
+    @property
+    def finished(self):
+        """Every byte up to the FIN went through."""
+        return self.fin_seq is not None and self.next_seq == self.fin_seq
+
+    def feed(self, ts, seq, data):
+        if not len(data):
+            return
+        if self.next_seq is None:  # the SYN was not captured
+            self.next_seq = seq
+        offset = _seq_offset(seq, self.next_seq)
+        if offset > 0:
+            if len(data) > len(self.pending.get(seq, b'')):
+                self.pending_bytes += len(data) - len(self.pending.get(seq, b''))
+                self.pending[seq] = bytes(data)  # the capture buffer is not ours to keep
+            if self.pending_bytes > self.max_pending:
+                self.skip_gap(ts)
+            return
+        if -offset < len(data):
+            self._deliver(ts, data[-offset:])
+            self._drain(ts)
+
+    def skip_gap(self, ts):
+        """Give up on the missing bytes before the first buffered segment."""
+        if not self.pending:
+            return
+        seq = min(self.pending, key=lambda s: _seq_offset(s, self.next_seq))
+        n = _seq_offset(seq, self.next_seq)
+        self.gap_bytes += n
+        self.on_gap(ts, n)
+        self.next_seq = seq
+        self._drain(ts)
+
+    def _deliver(self, ts, data):
+        self.next_seq = (self.next_seq + len(data)) % SEQ_MOD
+        self.on_data(ts, data)
+
+    def _drain(self, ts):
+        while self.pending:
+            ready = [s for s in self.pending if _seq_offset(s, self.next_seq) <= 0]
+            if not ready:
+                return
+            for seq in ready:
+                data = self.pending.pop(seq)
+                self.pending_bytes -= len(data)
+                offset = _seq_offset(seq, self.next_seq)
+                if -offset < len(data):
+                    self._deliver(ts, data[-offset:])
+
+
+class Transaction(object):
+    """One request and its response; response fields stay None until it arrives, complete once both ended."""
+    __slots__ = ('method', 'uri', 'version', 'status', 'res_version', 'req_start', 'req_end', 'res_start', 'res_end',
+                 'req_bytes', 'res_bytes', 'complete')
+
+    def __init__(self, ts, method=None, uri=None, version=None):
+        self.method = method  # None for exchanges of non-HTTP streams
+        self.uri = uri
+        self.version = version
+        self.status = None
+        self.res_version = None
+        self.req_start = ts
+        self.req_end = ts
+        self.res_start = None
+        self.res_end = None
+        self.req_bytes = 0
+        self.res_bytes = 0
+        self.complete = False
+
+    @property
+    def ttfb(self):
+        return None if self.res_start is None or self.req_end is None else self.res_start - self.req_end
+
+    @property
+    def transfer_time(self):
+        return None if self.res_start is None else self.res_end - self.res_start
+
+
+class MessageParser(object):
+    """
+    Incremental parser of the HTTP/1.x messages of one direction. Calls conn.message_data(parser, ts, n) for every
+    n bytes of a message, head included, conn.message_start(parser, ts, start line match) once its head is complete
+    (returning whether it may have a body), and conn.message_end(parser, ts, complete) once it is framed out.
+    """
+    __slots__ = ('conn', 'is_request', 'state', 'line', 'remaining', 'in_message')
+
+    def __init__(self, conn, is_request):
+        self.conn = conn
+        self.is_request = is_request
+        self.state = 'start'  # start, head, body, chunk_size, chunk_data, trailer, until_close, opaque, lost
+        self.line = bytearray()  # head or chunk size / trailer line being accumulated
+        self.remaining = 0
+        self.in_message = False
+
+    def feed(self, ts, data):
+        data = memoryview(data)
+        while len(data):
+            state = self.state
+            if state == 'opaque':
+                self.conn.opaque_data(self, ts, len(data))
+                return
+            if state == 'lost':
+                return
+            if state == 'start':
+                first = data[0]
+                if first == 0x0d or first == 0x0a:  # stray CRLF between messages
+                    data = data[1:]
+                    continue
+                if not (ord('A') <= first <= ord('Z') if self.is_request else first == ord('H')):
+                    self.state = 'opaque'
+                    self.conn.stream_opaque(self)
+                    continue
+                self.state = 'head'
+                self.in_message = True
+            elif state == 'head':
+                start = max(0, len(self.line) - 3)
+                self.line += data
+                end = self.line.find(b'\r\n\r\n', start)
+                if end < 0:
+                    self.conn.message_data(self, ts, len(data))
+                    if len(self.line) > MAX_HEAD:
+                        self._lose()
+                    return
+                used = end + 4 - (len(self.line) - len(data))
+                head = bytes(self.line[:end + 4])
+                self.line.clear()
+                self.conn.message_data(self, ts, used)
+                data = data[used:]
+                if not self._head(ts, head):
+                    return
+            elif state == 'body' or state == 'chunk_data':
+                n = min(self.remaining, len(data))
+                self.remaining -= n
+                self.conn.message_data(self, ts, n)
+                data = data[n:]
+                if self.remaining == 0:
+                    if state == 'body':
+                        self._end(ts)
+                    else:
+                        self.state = 'chunk_size'
+            elif state == 'chunk_size' or state == 'trailer':
+                end = bytes(data).find(b'\n')
+                used = len(data) if end < 0 else end + 1
+                self.line += data[:used]
+                self.conn.message_data(self, ts, used)
+                data = data[used:]
+                if end < 0:
+                    if len(self.line) > MAX_HEAD:
+                        self._lose()
+                    continue
+                line = bytes(self.line).strip()
+                self.line.clear()
+                if state == 'trailer':
+                    if not line:
+                        self._end(ts)
+                    continue
+                if not line:
+                    continue  # CRLF closing the previous chunk
+                try:
+                    size = int(line.split(b';')[0], 16)
+                except ValueError:
+                    self._lose()
+                    return
+                if size == 0:
+                    self.state = 'trailer'
+                else:
+                    self.state = 'chunk_data'
+                    self.remaining = size
+            elif state == 'until_close':
+                self.conn.message_data(self, ts, len(data))
+                return
+
+    def gap(self, ts, n):
+        """n bytes of the stream were not captured."""
+        if self.state in ('body', 'chunk_data') and n <= self.remaining:
+            self.feed(ts, bytes(n))  # only counted, their content does not matter
+        elif self.state == 'until_close':
+            self.conn.message_data(self, ts, n)
+        elif self.state == 'opaque':
+            self.conn.opaque_data(self, ts, n)
+        elif self.state != 'start' or n:
+            self._lose()
+
+    def close(self, ts):
+        """End of the stream (FIN, RST or end of capture)."""
+        if self.state == 'until_close':
+            self._end(ts)
+        elif self.in_message:
+            self.in_message = False
+            self.conn.message_end(self, ts, False)
+        self.state = 'lost'
+
+    def _head(self, ts, head):
+        line_end = head.find(b'\r\n') + 2
+        match = (_request_line if self.is_request else _status_line).match(head[:line_end])
+        if match is None:
+            self._lose()
+            return False
+        headers = {}
+        for line in head[line_end:].split(b'\r\n'):
+            name, sep, value = line.partition(b':')
+            if sep:
+                headers[name.strip().lower().decode('latin-1')] = value.strip().decode('latin-1')
+        if not self.conn.message_start(self, ts, match):
+            self._end(ts)
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            self.state = 'chunk_size'
+        elif headers.get('content-length', '').isdigit():
+            self.remaining = int(headers['content-length'])
+            self.state = 'body'
+            if self.remaining == 0:
+                self._end(ts)
+        elif not self.is_request:
+            self.state = 'until_close'  # RFC 7230 3.3.3: a response without framing ends with the connection
+        else:
+            self._end(ts)  # a request without framing has no body
+        return True
+
+    def _end(self, ts):
+        self.state = 'start'
+        self.in_message = False
+        self.conn.message_end(self, ts, True)
+
+    def _lose(self):
+        """The stream cannot be followed anymore (malformed, or a gap in a message head)."""
+        if self.in_message:
+            self.in_message = False
+            self.conn.message_end(self, None, False)
+        self.state = 'lost'
+
+
+def tls_alpn(data):
+    """Protocol selected by ALPN in a TLS ServerHello record at the start of data, None if absent or not TLS."""
+    if len(data) < 5 + 4 + 38 or data[0] != TLS_HANDSHAKE or data[5] != TLS_SERVER_HELLO:
+        return None
+    pos = 5 + 4 + 34  # record header, handshake header, version, random
+    pos += 1 + data[pos]  # session id
+    pos += 3  # cipher suite, compression method
+    if pos + 2 > len(data):
+        return None
+    end = min(len(data), pos + 2 + int.from_bytes(data[pos:pos + 2], 'big'))
+    pos += 2
+    while pos + 4 <= end:
+        ext_type = int.from_bytes(data[pos:pos + 2], 'big')
+        ext_len = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        if ext_type == TLS_EXT_ALPN and ext_len >= 3 and pos + 4 + ext_len <= end:
+            proto_len = data[pos + 6]
+            return bytes(data[pos + 7:pos + 7 + proto_len]).decode('latin-1')
+        pos += 4 + ext_len
+    return None
+
+
+class HTTPConnection(object):
+    """Both directions of one TCP connection, finished transactions go to on_transaction(conn, transaction)."""
+
+    def __init__(self, client, client_port, server, server_port, on_transaction):
+        self.client = client
+        self.client_port = client_port
+        self.server = server
+        self.server_port = server_port
+        self.on_transaction = on_transaction
+        self.requests = MessageParser(self, True)
+        self.responses = MessageParser(self, False)
+        self.streams = [ByteStream(lambda ts, data: self._data(0, ts, data), self.requests.gap),
+                        ByteStream(lambda ts, data: self._data(1, ts, data), self.responses.gap)]
+        self.closed = [False, False]
+        self.opaque = False
+        self.start_time = None
+        self.end_time = None
+        self.packets = 0
+        self.bytes = 0
+        self.transactions = 0
+        self.max_outstanding = 0  # most requests sent and not answered yet, the pipelining depth
+        self.prefix = [bytearray(), bytearray()]  # first PREFIX_BYTES of each direction
+        self._waiting = deque()  # transactions whose response has not started, oldest first
+        self._current = [None, None]  # transaction of the request / response being parsed
+        self._version = None
+
+    @property
+    def protocol(self):
+        """HTTP version answered by the server, 'h2c', 'TLS <ALPN protocol>', 'TLS' or None if unknown."""
+        if self.prefix[0].startswith(b'PRI * HTTP/2.0'):
+            return 'h2c'
+        if self.opaque:
+            if self.prefix[1][:1] == bytes([TLS_HANDSHAKE]):
+                alpn = tls_alpn(self.prefix[1])
+                return f'TLS {alpn}' if alpn else 'TLS'
+            return None
+        return None if self._version is None else f'HTTP/{self._version}'
+
+    def feed(self, ts, direction, tcp, payload, wire_len=0):
+        if self.start_time is None:
+            self.start_time = ts
+        self.end_time = ts
+        self.packets += 1
+        self.bytes += wire_len
+        stream = self.streams[direction]
+        if tcp.flags & TH_SYN:
+            stream.syn(tcp.seq)
+        if tcp.flags & TH_FIN:
+            stream.fin_seq = (tcp.seq + len(payload) + (1 if tcp.flags & TH_SYN else 0)) % SEQ_MOD
+        stream.feed(ts, tcp.seq, payload)
+        if stream.finished and not self.closed[direction]:  # FIN reached in stream order
+            self.closed[direction] = True
+            (self.requests if direction == 0 else self.responses).close(ts)
+
+    def close(self, ts):
+        """End of the connection: skip what is still missing and report what was not reported yet."""
+        for stream, parser in zip(self.streams, (self.requests, self.responses)):
+            stream.skip_gap(ts)
+            parser.close(ts)
+        for txn in self._current + list(self._waiting):
+            if txn is not None and not txn.complete:
+                txn.complete = self.opaque and txn.res_start is not None
+                self._report(txn)
+        self._current = [None, None]
+        self._waiting.clear()
+
+    @property
+    def done(self):
+        return self.closed[0] and self.closed[1]
+
+    def _data(self, direction, ts, data):
+        prefix = self.prefix[direction]
+        if len(prefix) < PREFIX_BYTES:
+            prefix += data[:PREFIX_BYTES - len(prefix)]
+        (self.requests if direction == 0 else self.responses).feed(ts, data)
+
+    def _report(self, txn):
+        self.transactions += 1
+        self.on_transaction(self, txn)
+
+    # parser callbacks
+    def message_start(self, parser, ts, match):
+        """Return whether the message may have a body."""
+        if parser.is_request:
+            txn = self._current[0]
+            txn.method, txn.uri, txn.version = (x.decode('latin-1') for x in match.groups())
+            return True
+        txn = self._current[1]
+        txn.res_version = self._version = match.group(1).decode('latin-1')
+        txn.status = int(match.group(2))
+        return not (100 <= txn.status < 200 or txn.status in (204, 304) or txn.method == 'HEAD')
+
+    def message_data(self, parser, ts, n):
+        direction = 0 if parser.is_request else 1
+        txn = self._current[direction]
+        if txn is None:
+            if parser.is_request:
+                txn = Transaction(ts)
+                self._waiting.append(txn)
+                outstanding = len(self._waiting) + (self._current[1] is not None)
+                self.max_outstanding = max(self.max_outstanding, outstanding)
+            elif self._waiting:
+                txn = self._waiting.popleft()
+            else:
+                txn = Transaction(None)
+            self._current[direction] = txn
+        if parser.is_request:
+            txn.req_bytes += n
+            txn.req_end = ts
+        else:
+            if txn.res_start is None:
+                txn.res_start = ts
+            txn.res_bytes += n
+            txn.res_end = ts
+
+    def message_end(self, parser, ts, complete):
+        if parser.is_request:
+            self._current[0] = None
+            return
+        txn = self._current[1]
+        self._current[1] = None
+        if txn is None:
+            return
+        if complete and txn.status is not None and 100 <= txn.status < 200:  # interim, the final response follows
+            txn.res_start = None
+            self._waiting.appendleft(txn)
+            return
+        txn.complete = complete and txn.req_end is not None
+        self._report(txn)
+
+    def stream_opaque(self, parser):
+        self.opaque = True
+        for other in (self.requests, self.responses):  # both directions speak the same protocol
+            if other.state == 'start':
+                other.state = 'opaque'
+
+    def opaque_data(self, parser, ts, n):
+        """Not HTTP: a client turn after the server spoke starts a new exchange."""
+        if parser.is_request:
+            txn = self._current[0]
+            if txn is None or txn.res_start is not None:
+                if txn is not None:
+                    txn.complete = True
+                    self._report(txn)
+                txn = self._current[0] = Transaction(ts)
+            txn.req_bytes += n
+            txn.req_end = ts
+        else:
+            txn = self._current[0]
+            if txn is None:
+                return  # server bytes before any request
+            if txn.res_start is None:
+                txn.res_start = ts
+            txn.res_bytes += n
+            txn.res_end = ts
+
+
+class HTTPTracker(object):
+    """
+    Feed TCP segments in capture order with feed(ts, src, dst, tcp, payload, wire_len); transactions of the
+    connections to server_port (any port if None) go to on_transaction(conn, transaction) as they finish, and the
+    connections themselves to on_close(conn) once closed. flush() at the end.
+    """
+
+    def __init__(self, on_transaction, server_port=None, on_close=None):
+        self.on_transaction = on_transaction
+        self.server_port = server_port
+        self.on_close = on_close
+        self.connections = {}  # {flow_key: HTTPConnection}
+        self._closed = OrderedDict()  # {flow_key: None}, like TIME_WAIT: ignored until a new SYN
+
+    def feed(self, ts, src, dst, tcp, payload, wire_len=0):
+        key = flow_key(src, tcp.src_port, dst, tcp.dst_port)
+        conn = self.connections.get(key)
+        if conn is None:
+            if self.server_port is not None and self.server_port not in (tcp.src_port, tcp.dst_port):
+                return
+            if key in self._closed:
+                if tcp.flags & (TH_SYN | TH_ACK) != TH_SYN:
+                    return  # retransmission or last ACK of a closed connection
+                del self._closed[key]
+            if tcp.flags & TH_SYN:  # the SYN sender is the client, either way in the SYN-ACK
+                client_side = not tcp.flags & TH_ACK
+            elif self.server_port is not None:
+                client_side = tcp.dst_port == self.server_port
+            else:
+                client_side = tcp.src_port > tcp.dst_port  # mid-stream: guess the ephemeral port is the client's
+            if client_side:
+                conn = HTTPConnection(src, tcp.src_port, dst, tcp.dst_port, self.on_transaction)
+            else:
+                conn = HTTPConnection(dst, tcp.dst_port, src, tcp.src_port, self.on_transaction)
+            self.connections[key] = conn
+        direction = 0 if tcp.src_port == conn.client_port and src == conn.client else 1
+        conn.feed(ts, direction, tcp, payload, wire_len)
+        if tcp.flags & TH_RST or conn.done:
+            self._close(key, ts)
+
+    def _close(self, key, ts):
+        conn = self.connections.pop(key)
+        conn.close(ts)
+        if self.on_close is not None:
+            self.on_close(conn)
+        self._closed[key] = None
+        if len(self._closed) > MAX_CLOSED:
+            self._closed.popitem(last=False)
+
+    def flush(self, ts=None):
+        for key in list(self.connections):
+            self._close(key, ts)
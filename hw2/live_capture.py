@@ -0,0 +1,237 @@
+# -*- coding:utf-8 -*-
+
+"""
+Live analysis: frames read from a network interface (AF_PACKET socket, optionally through a TPACKET_V3 ring) or
+from a stream of pcap data (a named pipe, stdin) go through Packet.FrameDecoder into the flow engine, and the
+throughput, loss and RTT of every flow are printed every interval seconds.
+
+    python live_capture.py eth0 [--ring] [--interval 1]      (needs CAP_NET_RAW)
+    tcpdump -i eth0 -w - | python live_capture.py -
+    mkfifo cap.pipe; python live_capture.py cap.pipe &; tcpreplay / tcpdump -w cap.pipe ...
+"""
+import argparse
+import mmap
+import os
+import select
+import socket
+import stat
+import struct
+import sys
+import time
+
+from Packet import LINKTYPE_ETHERNET, LINKTYPE_RAW, PCAP_MAGIC, PCAP_MAGIC_NS, SUPPORTED_LINKTYPES
+from flow_engine import CLIENT_TO_SERVER, SERVER_TO_CLIENT, FlowEngine, flow_key
+
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+PACKET_OUTGOING = 4
+ARPHRD_LOOPBACK = 772
+ARPHRD_RAWIP = 519
+ARPHRD_NONE = 0xfffe  # tun devices: raw IP, no link header
+
+_tpacket_req3 = struct.Struct('=7I')  # block size, block count, frame size, frame count, block timeout (ms), ...
+_block_hdr = struct.Struct('=III')  # tpacket_hdr_v1 at offset 8: block_status, num_pkts, offset_to_first_pkt
+_tpacket3_hdr = struct.Struct('=IIIIIIHH')  # next offset, sec, nsec, snaplen, len, status, mac offset, net offset
+_sll_type = struct.Struct('=HB')  # sll_hatype, sll_pkttype of the sockaddr_ll following the tpacket3_hdr
+TPACKET3_HDRLEN = 48  # TPACKET_ALIGN(sizeof(struct tpacket3_hdr))
+
+
+def read_pcap_stream(f):
+    """
+    Yield (ts, frame, link type, wire length) from a pcap stream read sequentially (a pipe cannot be mapped like a
+    file).
+    """
+    header = f.read(24)
+    if len(header) < 24:
+        return
+    magic = struct.unpack('<I', header[:4])[0]
+    endian = '<' if magic in (PCAP_MAGIC, PCAP_MAGIC_NS) else '>'
+    magic = struct.unpack(endian + 'I', header[:4])[0]
+    if magic not in (PCAP_MAGIC, PCAP_MAGIC_NS):
+        raise ValueError('not a pcap stream (pcapng is not supported on pipes)')
+    linktype = struct.unpack(endian + 'I', header[20:24])[0] & 0xffff
+    if linktype not in SUPPORTED_LINKTYPES:
+        raise ValueError(f'link type {linktype} is not supported')
+    rec_struct = struct.Struct(endian + 'IIII')
+    ts_unit = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+    while True:
+        rec = f.read(16)
+        if len(rec) < 16:
+            return
+        sec, frac, caplen, wire_len = rec_struct.unpack(rec)
+        frame = f.read(caplen)
+        if len(frame) < caplen:  # writer went away mid-record
+            return
+        yield sec + frac * ts_unit, frame, linktype, wire_len
+
+
+def open_packet_socket(ifname):
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+    sock.bind((ifname, 0))
+    return sock
+
+
+def linktype_of(hatype):
+    """Link type of the frames of an interface from its ARPHRD type: raw IP for tun devices, else Ethernet."""
+    return LINKTYPE_RAW if hatype in (ARPHRD_NONE, ARPHRD_RAWIP) else LINKTYPE_ETHERNET
+
+
+def read_socket(ifname, poll_interval=0.5, rcvbuf=1 << 24):
+    """
+    Yield (ts, frame, link type, wire length) received on ifname, one recv per frame; (ts, None, None, None) when
+    nothing came for poll_interval.
+    The kernel drops what does not fit in rcvbuf while a burst is processed, the ring holds more.
+    """
+    sock = open_packet_socket(ifname)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.settimeout(poll_interval)
+    buf = bytearray(1 << 18)  # loopback frames go up to 64 KiB and beyond with offloads
+    try:
+        while True:
+            try:
+                n, (_, _, pkttype, hatype, _) = sock.recvfrom_into(buf, 0, socket.MSG_TRUNC)  # n: length on the wire
+            except socket.timeout:
+                yield time.time(), None, None, None
+                continue
+            if pkttype == PACKET_OUTGOING and hatype == ARPHRD_LOOPBACK:
+                continue  # seen again coming in, as libpcap does
+            yield time.time(), memoryview(buf)[:min(n, len(buf))], linktype_of(hatype), n
+    finally:
+        sock.close()
+
+
+def read_ring(ifname, block_size=1 << 20, block_nr=64, block_timeout=100, poll_interval=0.5):
+    """
+    Yield (ts, frame, link type, wire length) from a TPACKET_V3 ring: the kernel fills whole blocks of frames in
+    shared memory and hands them over at once, no copy nor system call per frame. Frames are views into the ring,
+    only valid until the next one is requested. (ts, None, None, None) when nothing came for poll_interval.
+    """
+    sock = open_packet_socket(ifname)
+    sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+    frame_size = 1 << 11
+    sock.setsockopt(SOL_PACKET, PACKET_RX_RING, _tpacket_req3.pack(
+        block_size, block_nr, frame_size, block_size // frame_size * block_nr, block_timeout, 0, 0))
+    ring = mmap.mmap(sock.fileno(), block_size * block_nr, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+    view = memoryview(ring)
+    poller = select.poll()
+    poller.register(sock, select.POLLIN | select.POLLERR)
+    block = 0
+    try:
+        while True:
+            base = block * block_size
+            status, num_pkts, pos = _block_hdr.unpack_from(view, base + 8)
+            if not status & TP_STATUS_USER:
+                if not poller.poll(poll_interval * 1000):
+                    yield time.time(), None, None, None
+                continue
+            pos += base
+            for _ in range(num_pkts):
+                next_offset, sec, nsec, snaplen, tp_len, _, mac, _ = _tpacket3_hdr.unpack_from(view, pos)
+                hatype, pkttype = _sll_type.unpack_from(view, pos + TPACKET3_HDRLEN + 8)
+                if pkttype != PACKET_OUTGOING or hatype != ARPHRD_LOOPBACK:
+                    yield sec + nsec * 1e-9, view[pos + mac:pos + mac + snaplen], linktype_of(hatype), tp_len
+                pos += next_offset
+            struct.pack_into('=I', view, base + 8, TP_STATUS_KERNEL)  # hand the block back
+            block = (block + 1) % block_nr
+    finally:
+        try:
+            view.release()
+            ring.close()
+        except BufferError:  # a frame view is still referenced, the ring goes away with it
+            pass
+        sock.close()
+
+
+class LiveMonitor(object):
+    """
+    Flow engine fed with live frames, reporting every interval seconds (of frame time) the flows active in it:
+    throughput and loss rate (needed retransmissions per data segment) over the interval, and the current smoothed
+    RTT.
+    """
+
+    def __init__(self, interval=1.0, idle_timeout=120.0, out=sys.stdout):
+        self.interval = interval
+        self.out = out
+        self.finished = []  # flows that ended during the current interval
+        self.engine = FlowEngine(self.finished.append, idle_timeout)
+        self.other = 0  # frames that are not TCP over IP, or cut short
+        self._last = {}  # {flow key: (bytes, needed retransmissions, data segments) at the previous report}
+        self._next_report = None
+
+    def feed(self, ts, frame, linktype=LINKTYPE_ETHERNET, wire_len=None):
+        """Process a frame (None: no frame, only lets reports and idle expiry happen on time)."""
+        if self._next_report is None:
+            self._next_report = ts + self.interval
+        while ts >= self._next_report:
+            self.report(self._next_report)
+            self._next_report += self.interval
+        if frame is None:
+            self.engine.expire(ts)
+            return
+        if not self.engine.feed(ts, frame, linktype, wire_len):
+            self.other += 1
+
+    def report(self, now):
+        flows = [(flow_key(f.client, f.client_port, f.server, f.server_port), f) for f in self.finished]
+        flows += list(self.engine.flows.items())
+        flows.sort(key=lambda item: item[1].start_time)
+        self.finished.clear()
+        print(f'======== {time.strftime("%H:%M:%S", time.localtime(now))}, flows: {len(self.engine.flows)}, '
+              f'skipped packets: {self.engine.skipped}, other frames: {self.other} ========', file=self.out)
+        last, self._last = self._last, {}
+        for key, f in flows:
+            boards = f.scoreboard
+            counters = (sum(f.bytes), sum(b.retransmissions - b.spurious for b in boards),
+                        sum(b.data_segments for b in boards))
+            prev = last.get(key, (0, 0, 0))
+            if f.close_reason is None:
+                self._last[key] = counters
+            if counters == prev:
+                continue  # nothing new in this interval
+            delta = [x - y for x, y in zip(counters, prev)]
+            lost = max(delta[1], 0)  # below 0 when earlier retransmissions turn out spurious
+            srtt = f.rtt_estimator[CLIENT_TO_SERVER].srtt
+            if srtt is None:
+                srtt = f.rtt_estimator[SERVER_TO_CLIENT].srtt
+            print(f'{f.client}:{f.client_port} -> {f.server}:{f.server_port}, '
+                  f'throughput: {"{:.3f}".format(delta[0] * 8 / self.interval / 1000000)} Mbps, '
+                  f'loss rate: {"{:.4f}".format(lost / delta[2] if delta[2] else 0.0)} ({lost}/{delta[2]}), '
+                  f'srtt: {"{:.6f}".format(srtt) + " s" if srtt is not None else "-"}'
+                  f'{", closed by: " + f.close_reason if f.close_reason else ""}', file=self.out)
+        self.out.flush()
+
+    def close(self):
+        """End of input: every open flow finishes, and goes in a last report."""
+        self.engine.flush()
+        self.report(self._next_report if self._next_report is not None else time.time())
+
+
+def frames_of(source, ring=False):
+    """Frames of source: '-' for stdin, a pcap file or named pipe, else a network interface."""
+    if source == '-':
+        return read_pcap_stream(sys.stdin.buffer)
+    if os.path.exists(source) and (stat.S_ISFIFO(os.stat(source).st_mode) or os.path.isfile(source)):
+        return read_pcap_stream(open(source, 'rb'))
+    return read_ring(source) if ring else read_socket(source)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Live per-flow TCP statistics')
+    parser.add_argument('source', help="network interface, named pipe or pcap file of pcap data, '-' for stdin")
+    parser.add_argument('--ring', action='store_true', help='read the interface through a TPACKET_V3 ring')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between reports')
+    parser.add_argument('--idle-timeout', type=float, default=120.0)
+    args = parser.parse_args()
+
+    monitor = LiveMonitor(args.interval, args.idle_timeout)
+    try:
+        for frame_ts, frame_buf, frame_linktype, frame_len in frames_of(args.source, args.ring):
+            monitor.feed(frame_ts, frame_buf, frame_linktype, frame_len)
+    except KeyboardInterrupt:
+        pass
+    monitor.close()
@@ -0,0 +1,127 @@
+# -*- coding:utf-8 -*-
+
+"""
+Sidecar index of a capture, written next to it as <pcap>.flowidx.npz: the columnar TCP table (pcap_table), the
+per-flow summary and packet offsets, and the capture counters. It is keyed by the file size, mtime and a hash of
+its first and last MiB, and rebuilt when any of them changes, so repeated analyses of the same capture (another
+port, sender or metric) skip decoding it.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+from Packet import PcapReader
+from pcap_table import CaptureCounters, flow_ids, flow_summary, iter_segments, iter_tcp_tables
+
+INDEX_VERSION = 4  # bump when the content of the index changes
+SIDECAR_SUFFIX = '.flowidx.npz'
+HASH_BLOCK = 1 << 20
+
+_indexes = {}  # {pcap path: PcapIndex} already loaded by this process
+
+
+def file_key(pcap_path):
+    st = os.stat(pcap_path)
+    h = hashlib.blake2b(digest_size=16)
+    with open(pcap_path, 'rb') as f:
+        h.update(f.read(HASH_BLOCK))
+        if st.st_size > HASH_BLOCK:
+            f.seek(max(HASH_BLOCK, st.st_size - HASH_BLOCK))
+            h.update(f.read())
+    return f'v{INDEX_VERSION}:{st.st_size}:{st.st_mtime_ns}:{h.hexdigest()}'
+
+
+class PcapIndex(object):
+    """
+    table: TCP table of every TCP segment; flows: FLOW_SUMMARY_DTYPE per directional 4-tuple;
+    packet_total / ip_packets / ip_bytes: records, IP frames and their captured bytes in the whole capture;
+    skipped: frames that could not be decoded (see pcap_table.CaptureCounters).
+    """
+
+    def __init__(self, key, table, flows, flow_order, flow_bounds, counters):
+        self.key = key
+        self.table = table
+        self.flows = flows
+        self._flow_order = flow_order  # table rows grouped by flow
+        self._flow_bounds = flow_bounds  # flow i is _flow_order[_flow_bounds[i]:_flow_bounds[i + 1]]
+        self.packet_total, self.ip_packets, self.ip_bytes, self.skipped = (int(x) for x in counters)
+
+    def flow_rows(self, i):
+        """Table rows of flow i, in capture order."""
+        return self.table[self._flow_order[self._flow_bounds[i]:self._flow_bounds[i + 1]]]
+
+    def flow_offsets(self, i):
+        """Record offsets of the packets of flow i, for PcapReader.read_at."""
+        return self.flow_rows(i)['offset']
+
+    def segments(self):
+        return iter_segments(self.table)
+
+    def save(self, path):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, key=np.array(self.key), table=self.table, flows=self.flows, flow_order=self._flow_order,
+                     flow_bounds=self._flow_bounds,
+                     counters=np.array([self.packet_total, self.ip_packets, self.ip_bytes, self.skipped],
+                                                dtype=np.int64))
+        os.replace(tmp_path, path)  # readers never see a partial index
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(str(data['key']), data['table'], data['flows'], data['flow_order'], data['flow_bounds'],
+                       data['counters'])
+
+
+def build_index(pcap_path, key=None, chunk_packets=1000000):
+    """Decode pcap_path chunk by chunk (at most chunk_packets records held at once) into its PcapIndex."""
+    counters = CaptureCounters()
+    table = np.concatenate(list(iter_tcp_tables(pcap_path, chunk_packets, counters)))
+    flow_keys, flow_id = flow_ids(table)
+    flow_order = np.argsort(flow_id, kind='stable')
+    flow_bounds = np.searchsorted(flow_id[flow_order], np.arange(len(flow_keys) + 1))
+    return PcapIndex(key or file_key(pcap_path), table, flow_summary(table, flow_keys, flow_id), flow_order,
+                     flow_bounds, (counters.packets, counters.ip_packets, counters.ip_bytes, counters.skipped))
+
+
+def load_index(pcap_path, rebuild=False):
+    """
+    Index of pcap_path: from memory, else from its sidecar file if still valid, else built and saved next to it
+    (when the directory is not writable the index is only kept in memory).
+    """
+    key = file_key(pcap_path)
+    index = _indexes.get(pcap_path)
+    if index is not None and index.key == key and not rebuild:
+        return index
+    sidecar_path = pcap_path + SIDECAR_SUFFIX
+    index = None
+    if not rebuild and os.path.exists(sidecar_path):
+        try:
+            index = PcapIndex.load(sidecar_path)
+        except (OSError, ValueError, KeyError):  # corrupt or from another version, rebuild it
+            index = None
+        if index is not None and index.key != key:
+            index = None
+    if index is None:
+        index = build_index(pcap_path, key)
+        try:
+            index.save(sidecar_path)
+        except OSError:
+            pass
+    _indexes[pcap_path] = index
+    return index
+
+
+def iter_payloads(pcap_path, port=None):
+    """
+    Yield (Segment, TCP payload) of the segments of pcap_path (to or from port only, if given) from its index: the
+    payloads are views of the capture at their file offsets (no frame is decoded again), valid while iterating.
+    """
+    table = load_index(pcap_path).table
+    if port is not None:
+        table = table[(table['src_port'] == port) | (table['dst_port'] == port)]
+    with PcapReader(pcap_path) as pcap:
+        buf = pcap.buf
+        for segment in iter_segments(table):
+            yield segment, buf[segment.data_offset:segment.data_offset + segment.payload_len]
@@ -0,0 +1,474 @@
+# -*- coding:utf-8 -*-
+
+"""
+Vectorized pcap decoder: a whole capture (or a chunk of it) is decoded into one NumPy structured array with a row
+per TCP segment, every header field being computed with offset arithmetic over the raw bytes at once, so flow
+statistics become group-bys instead of Python loops over Packet objects.
+Link types are those of Packet.link_payload (Ethernet with VLAN tags, Linux cooked captures, raw IP), over IPv4 or
+IPv6; the rare IPv6 packets with extension headers are decoded one by one with FrameDecoder.
+"""
+import socket
+import sys
+
+import numpy as np
+
+from Packet import (ETH_TYPE_8021AD, ETH_TYPE_8021Q, ETH_TYPE_IP, ETH_TYPE_IP6, ETH_TYPE_QINQ, IP_PROTO_AH,
+                    IP_PROTO_DSTOPTS, IP_PROTO_FRAGMENT, IP_PROTO_HOPOPTS, IP_PROTO_MH, IP_PROTO_ROUTING, IP_PROTO_TCP,
+                    LINKTYPE_ETHERNET, LINKTYPE_IPV4, LINKTYPE_IPV6, LINKTYPE_LINUX_SLL, LINKTYPE_LINUX_SLL2,
+                    LINKTYPE_RAW, SLL2_HDR_LEN, SLL_HDR_LEN, TCP_OPT_MSS, TCP_OPT_SACK, TCP_OPT_TIMESTAMP,
+                    TCP_OPT_WSCALE, FrameDecoder, PcapReader)
+
+MAX_SACK_BLOCKS = 4  # 40 bytes of options hold at most 4 SACK blocks
+
+TCP_TABLE_DTYPE = np.dtype([
+    ('offset', 'i8'),  # file offset of the pcap record header
+    ('ts', 'f8'),  # capture time in seconds
+    ('caplen', 'u4'),  # captured length of the frame
+    ('wire_len', 'u4'),  # original length of the frame on the wire
+    ('src', 'V16'),  # IPv6 addresses, IPv4 ones mapped (::ffff:a.b.c.d), see ip_to_str
+    ('dst', 'V16'),
+    ('src_port', 'u2'),
+    ('dst_port', 'u2'),
+    ('seq', 'u4'),
+    ('ack', 'u4'),
+    ('flags', 'u1'),
+    ('win_size', 'u2'),
+    ('ip_hdr_len', 'u2'),  # IPv6 extension headers included
+    ('tcp_hdr_len', 'u1'),
+    ('payload_len', 'u4'),
+    ('data_offset', 'i8'),  # file offset of the TCP payload
+    ('mss', 'u2'),  # 0 if the option is absent
+    ('win_scale', 'i1'),  # -1 if the option is absent
+    ('tsval', 'u4'),  # tsval / tsecr are only valid where has_ts is set
+    ('tsecr', 'u4'),
+    ('has_ts', '?'),
+    ('sack_blocks', 'u1'),  # number of valid rows of sack
+    ('sack', 'u4', (MAX_SACK_BLOCKS, 2)),  # (left edge, right edge) of the SACK blocks
+])
+
+FLOW_SUMMARY_DTYPE = np.dtype([
+    ('src', 'V16'), ('dst', 'V16'), ('src_port', 'u2'), ('dst_port', 'u2'),
+    ('packets', 'i8'), ('bytes', 'i8'), ('payload_bytes', 'i8'),
+    ('syn', 'i8'), ('fin', 'i8'), ('start_time', 'f8'), ('end_time', 'f8'), ('throughput', 'f8'),
+])
+
+_MAX_TCP_OPT_STEPS = 40  # TCP options are at most 40 bytes, so at most 40 options
+_VLAN_TYPES = (ETH_TYPE_8021Q, ETH_TYPE_8021AD, ETH_TYPE_QINQ)
+_RAW_LINKTYPES = (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6)
+_IP6_EXT_HEADERS = (IP_PROTO_HOPOPTS, IP_PROTO_ROUTING, IP_PROTO_FRAGMENT, IP_PROTO_DSTOPTS, IP_PROTO_AH, IP_PROTO_MH)
+_V4_MAPPED = bytes(10) + b'\xff\xff'
+
+
+def ip_to_str(ip):
+    """Text form of a table address, dotted for IPv4 ones."""
+    ip = bytes(ip)
+    if ip[:12] == _V4_MAPPED:
+        return socket.inet_ntoa(ip[12:])
+    return socket.inet_ntop(socket.AF_INET6, ip)
+
+
+class CaptureCounters(object):
+    """
+    Records read, IP frames among them and their captured bytes, and the frames skipped (link type not supported,
+    headers malformed or cut short, TCP fragments after the first one), summed over the chunks decoded with it.
+    """
+    __slots__ = ('packets', 'ip_packets', 'ip_bytes', 'skipped')
+
+    def __init__(self):
+        self.packets = 0
+        self.ip_packets = 0
+        self.ip_bytes = 0
+        self.skipped = 0
+
+    def add(self, other):
+        self.packets += other.packets
+        self.ip_packets += other.ip_packets
+        self.ip_bytes += other.ip_bytes
+        self.skipped += other.skipped
+
+
+class Segment(object):
+    """
+    A TCP table row with the attribute names of Packet.TCP, for code written against TCP packets.
+    Options absent from the segment are None, as with TCP.
+    """
+    __slots__ = ('time', 'src_ip', 'dst_ip', 'src_port', 'dst_port', 'seq', 'ack', 'flags', 'win_size', 'MSS',
+                 'win_scale', 'tsval', 'tsecr', 'sack', 'payload_len', 'caplen', 'wire_len', 'data_offset')
+
+    def __init__(self, time, src_ip, dst_ip, src_port, dst_port, seq, ack, flags, win_size, mss, win_scale, tsval,
+                 tsecr, has_ts, sack_blocks, sack, payload_len, caplen, wire_len, data_offset):
+        self.time = time
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.seq = seq
+        self.ack = ack
+        self.flags = flags
+        self.win_size = win_size
+        self.MSS = mss or None
+        self.win_scale = None if win_scale < 0 else win_scale
+        self.tsval = tsval if has_ts else None
+        self.tsecr = tsecr if has_ts else None
+        self.sack = [tuple(block) for block in sack[:sack_blocks]] if sack_blocks else None
+        self.payload_len = payload_len
+        self.caplen = caplen
+        self.wire_len = wire_len
+        self.data_offset = data_offset
+
+
+def iter_segments(table, ip_str=True):
+    """Yield a Segment per row of a TCP table, addresses as dotted strings unless ip_str is False."""
+    names = {}  # few distinct addresses, convert each once
+    fields = ('ts', 'src', 'dst', 'src_port', 'dst_port', 'seq', 'ack', 'flags', 'win_size', 'mss', 'win_scale',
+              'tsval', 'tsecr', 'has_ts', 'sack_blocks', 'sack', 'payload_len', 'caplen', 'wire_len', 'data_offset')
+    for row in zip(*[table[field].tolist() for field in fields]):
+        segment = Segment(*row)
+        if ip_str:
+            for attr in ('src_ip', 'dst_ip'):
+                ip = getattr(segment, attr)
+                if ip not in names:
+                    names[ip] = ip_to_str(ip)
+                setattr(segment, attr, names[ip])
+        yield segment
+
+
+def _be16(raw, idx):
+    return (raw[idx].astype(np.uint32) << 8) | raw[idx + 1]
+
+
+def _be32(raw, idx):
+    return ((raw[idx].astype(np.uint32) << 24) | (raw[idx + 1].astype(np.uint32) << 16) |
+            (raw[idx + 2].astype(np.uint32) << 8) | raw[idx + 3])
+
+
+def record_index(reader, start=None, max_packets=None, end=None, counters=None, context=None):
+    """
+    Walk the record headers of an open PcapReader from record offset start (to the records starting before end);
+    context is the pcapng section state at start (PcapReader.boundaries), counters (a CaptureCounters) counts the
+    records read.
+    Return (record offsets, frame offsets, ts, caplen, wire_len, link types, offset of the first record not read or
+    None).
+    """
+    offsets, frames, ts, caplen, wire_len, linktypes = [], [], [], [], [], []
+    next_offset = None
+    for offset, data_offset, incl, orig, t, linktype in reader.records(start, end, context):
+        if max_packets is not None and len(offsets) >= max_packets:
+            next_offset = offset
+            break
+        offsets.append(offset)
+        frames.append(data_offset)
+        ts.append(t)
+        caplen.append(incl)
+        wire_len.append(orig)
+        linktypes.append(linktype)
+    if counters is not None:
+        counters.packets += len(offsets)
+    return (np.array(offsets, dtype=np.int64), np.array(frames, dtype=np.int64), np.array(ts, dtype=np.float64),
+            np.array(caplen, dtype=np.int64), np.array(wire_len, dtype=np.int64), np.array(linktypes, dtype=np.int64),
+            next_offset)
+
+
+def link_offsets(raw, frame, caplen, linktype):
+    """
+    Packet.link_payload of every frame at once: (EtherType, file offset of the network layer). The EtherType is -1
+    where the link type is not supported or the frame is cut short; raw IP frames get the EtherType of their version.
+    """
+    eth_type = np.full(len(frame), -1, dtype=np.int64)
+    hdr_len = np.zeros(len(frame), dtype=np.int64)
+    for link, type_at, length in ((LINKTYPE_ETHERNET, 12, 14), (LINKTYPE_LINUX_SLL, 14, SLL_HDR_LEN),
+                                  (LINKTYPE_LINUX_SLL2, 0, SLL2_HDR_LEN)):
+        rows = np.flatnonzero((linktype == link) & (caplen >= length))
+        eth_type[rows] = _be16(raw, frame[rows] + type_at)
+        hdr_len[rows] = length
+    rows = np.flatnonzero(np.isin(linktype, _RAW_LINKTYPES) & (caplen >= 1))
+    version = raw[frame[rows]] >> 4
+    eth_type[rows] = np.select([version == 4, version == 6], [ETH_TYPE_IP, ETH_TYPE_IP6], -1)
+    while True:  # 802.1Q, QinQ: 2 bytes of tag control, then the next type
+        rows = np.flatnonzero(np.isin(eth_type, _VLAN_TYPES))
+        if len(rows) == 0:
+            break
+        short = caplen[rows] < hdr_len[rows] + 4
+        eth_type[rows[short]] = -1
+        rows = rows[~short]
+        eth_type[rows] = _be16(raw, frame[rows] + hdr_len[rows] + 2)
+        hdr_len[rows] += 4
+    return eth_type, frame + hdr_len
+
+
+def _addresses(raw, at, length):
+    """Table addresses from the length (4 or 16) bytes at the offsets at, IPv4 ones mapped."""
+    out = np.zeros((len(at), 16), dtype=np.uint8)
+    if length == 4:
+        out[:, 10:12] = 0xff
+    out[:, 16 - length:] = raw[at[:, None] + np.arange(length)]
+    return out.view('V16').ravel()
+
+
+def _parse_tcp_options(raw, opt_start, opt_end, table):
+    """Scan the options of every row at once, one option per step, rows drop out when their options end."""
+    rows = np.arange(len(opt_start))
+    pos = opt_start.copy()
+    for _ in range(_MAX_TCP_OPT_STEPS):
+        active = pos < opt_end[rows]
+        rows, pos = rows[active], pos[active]
+        if len(rows) == 0:
+            break
+        kind = raw[pos]
+        single = kind == 1  # NOP
+        # EOL ends the options, so does a length running out of the header or below 2 (malformed)
+        has_len = (kind > 1) & (pos + 1 < opt_end[rows])
+        length = np.zeros(len(rows), dtype=np.int64)
+        length[has_len] = raw[pos[has_len] + 1]
+        valid = has_len & (length >= 2) & (pos + length <= opt_end[rows])
+
+        mss = valid & (kind == TCP_OPT_MSS) & (length == 4)
+        table['mss'][rows[mss]] = _be16(raw, pos[mss] + 2)
+        wscale = valid & (kind == TCP_OPT_WSCALE) & (length == 3)
+        table['win_scale'][rows[wscale]] = raw[pos[wscale] + 2]
+        ts_opt = valid & (kind == TCP_OPT_TIMESTAMP) & (length == 10)
+        table['tsval'][rows[ts_opt]] = _be32(raw, pos[ts_opt] + 2)
+        table['tsecr'][rows[ts_opt]] = _be32(raw, pos[ts_opt] + 6)
+        table['has_ts'][rows[ts_opt]] = True
+        sack = valid & (kind == TCP_OPT_SACK) & (length >= 10) & ((length - 2) % 8 == 0)
+        table['sack_blocks'][rows[sack]] = (length[sack] - 2) // 8
+        for i in range(MAX_SACK_BLOCKS):
+            block = sack & (length >= 10 + 8 * i)
+            table['sack'][rows[block], i, 0] = _be32(raw, pos[block] + 2 + 8 * i)
+            table['sack'][rows[block], i, 1] = _be32(raw, pos[block] + 6 + 8 * i)
+
+        keep = single | valid
+        pos = np.where(single, pos + 1, pos + length)[keep]
+        rows = rows[keep]
+
+
+def decode_tcp(raw, offsets, frame, ts, caplen, wire_len, linktype, counters=None):
+    """
+    Decode the TCP segments among the given records (raw: uint8 view of the file) into a table, in record order,
+    counting the IP frames, their bytes and the frames skipped in counters if given.
+    """
+    eth_type, net_off = link_offsets(raw, frame, caplen, linktype)
+    net_len = caplen - (net_off - frame)  # captured bytes from the network header on
+    skipped = eth_type < 0
+    # IPv4
+    rows = np.flatnonzero((eth_type == ETH_TYPE_IP) & (net_len >= 20))
+    skipped[(eth_type == ETH_TYPE_IP) & (net_len < 20)] = True
+    ip_off = net_off[rows]
+    hdr_len = (raw[ip_off] & 0xf).astype(np.int64) << 2
+    bad = (raw[ip_off] >> 4 != 4) | (hdr_len < 20) | (hdr_len > net_len[rows])
+    skipped[rows[bad]] = True
+    is_tcp = ~bad & (raw[ip_off + 9] == IP_PROTO_TCP)
+    rows, ip_off, hdr_len = rows[is_tcp], ip_off[is_tcp], hdr_len[is_tcp]
+    fragment = (_be16(raw, ip_off + 6) & 0x1fff) != 0  # not the first one, no TCP header
+    skipped[rows[fragment]] = True
+    rows4, ip4_off, ip4_hdr_len = rows[~fragment], ip_off[~fragment], hdr_len[~fragment]
+    total = _be16(raw, ip4_off + 2).astype(np.int64)
+    ip4_end = np.where(total > 0, np.minimum(total, net_len[rows4]), net_len[rows4])  # 0: segmentation offload
+    # IPv6, without extension headers
+    rows = np.flatnonzero((eth_type == ETH_TYPE_IP6) & (net_len >= 40))
+    skipped[(eth_type == ETH_TYPE_IP6) & (net_len < 40)] = True
+    ip_off = net_off[rows]
+    bad = raw[ip_off] >> 4 != 6
+    skipped[rows[bad]] = True
+    rows, ip_off = rows[~bad], ip_off[~bad]
+    next_header = raw[ip_off + 6]
+    slow_rows = rows[np.isin(next_header, _IP6_EXT_HEADERS)]
+    is_tcp = next_header == IP_PROTO_TCP
+    rows6, ip6_off = rows[is_tcp], ip_off[is_tcp]
+    payload = _be16(raw, ip6_off + 4).astype(np.int64)
+    ip6_end = np.where(payload > 0, np.minimum(40 + payload, net_len[rows6]), net_len[rows6])
+    if counters is not None:
+        is_ip = (eth_type == ETH_TYPE_IP) | (eth_type == ETH_TYPE_IP6)
+        counters.ip_packets += int(is_ip.sum())
+        counters.ip_bytes += int(caplen[is_ip].sum())
+
+    # IP -> TCP, both versions in record order
+    order = np.argsort(np.concatenate([rows4, rows6]), kind='stable')
+    sel = np.concatenate([rows4, rows6])[order]
+    ip_off = np.concatenate([ip4_off, ip6_off])[order]
+    ip_hdr_len = np.concatenate([ip4_hdr_len, np.full(len(rows6), 40, dtype=np.int64)])[order]
+    ip_end = np.concatenate([ip4_end, ip6_end])[order]  # from the IP header
+    is_v4 = np.concatenate([np.ones(len(rows4), dtype=bool), np.zeros(len(rows6), dtype=bool)])[order]
+    tcp_off = ip_off + ip_hdr_len
+    has_hdr = ip_hdr_len + 20 <= ip_end
+    tcp_hdr_len = np.zeros(len(sel), dtype=np.int64)
+    tcp_hdr_len[has_hdr] = (raw[tcp_off[has_hdr] + 12] >> 4).astype(np.int64) << 2
+    ok = has_hdr & (tcp_hdr_len >= 20) & (ip_hdr_len + tcp_hdr_len <= ip_end)
+    skipped[sel[~ok]] = True
+    sel, ip_off, tcp_off, is_v4 = sel[ok], ip_off[ok], tcp_off[ok], is_v4[ok]
+    ip_hdr_len, tcp_hdr_len, ip_end = ip_hdr_len[ok], tcp_hdr_len[ok], ip_end[ok]
+
+    table = np.zeros(len(sel), dtype=TCP_TABLE_DTYPE)
+    table['offset'] = offsets[sel]
+    table['ts'] = ts[sel]
+    table['caplen'] = caplen[sel]
+    table['wire_len'] = wire_len[sel]
+    table['src'][is_v4] = _addresses(raw, ip_off[is_v4] + 12, 4)
+    table['dst'][is_v4] = _addresses(raw, ip_off[is_v4] + 16, 4)
+    table['src'][~is_v4] = _addresses(raw, ip_off[~is_v4] + 8, 16)
+    table['dst'][~is_v4] = _addresses(raw, ip_off[~is_v4] + 24, 16)
+    table['src_port'] = _be16(raw, tcp_off)
+    table['dst_port'] = _be16(raw, tcp_off + 2)
+    table['seq'] = _be32(raw, tcp_off + 4)
+    table['ack'] = _be32(raw, tcp_off + 8)
+    table['flags'] = raw[tcp_off + 13]
+    table['win_size'] = _be16(raw, tcp_off + 14)
+    table['ip_hdr_len'] = ip_hdr_len
+    table['tcp_hdr_len'] = tcp_hdr_len
+    table['payload_len'] = ip_end - ip_hdr_len - tcp_hdr_len
+    table['data_offset'] = tcp_off + tcp_hdr_len
+    table['win_scale'] = -1
+    has_opts = np.flatnonzero(tcp_hdr_len > 20)
+    opt_start = tcp_off[has_opts] + 20
+    sub = np.zeros(len(has_opts), dtype=TCP_TABLE_DTYPE)
+    sub['win_scale'] = -1
+    _parse_tcp_options(raw, opt_start, tcp_off[has_opts] + tcp_hdr_len[has_opts], sub)
+    for field in ('mss', 'win_scale', 'tsval', 'tsecr', 'has_ts', 'sack_blocks', 'sack'):
+        table[field][has_opts] = sub[field]
+
+    if len(slow_rows):
+        slow_table, slow_rows = _decode_frames(raw, slow_rows, offsets, frame, ts, caplen, wire_len, linktype,
+                                               skipped)
+        order = np.argsort(np.concatenate([sel, slow_rows]), kind='stable')
+        table = np.concatenate([table, slow_table])[order]
+    if counters is not None:
+        counters.skipped += int(skipped.sum())
+    return table
+
+
+def _decode_frames(raw, rows, offsets, frame, ts, caplen, wire_len, linktype, skipped):
+    """
+    Decode the given records one by one with FrameDecoder, marking in skipped the ones that are IP but could not be
+    decoded or hold a TCP fragment. Return (table, records decoded).
+    """
+    table = np.zeros(len(rows), dtype=TCP_TABLE_DTYPE)
+    table['win_scale'] = -1
+    decoded = np.zeros(len(rows), dtype=bool)
+    decoder = FrameDecoder()
+    for i, row in enumerate(rows.tolist()):
+        start = int(frame[row])
+        buf = raw[start:start + int(caplen[row])].tobytes()
+        if not decoder.decode(buf, int(linktype[row])):
+            skipped[row] = decoder.protocol in (None, IP_PROTO_TCP)
+            continue
+        decoded[i] = True
+        ip = decoder.ip_offset
+        segment = table[i]
+        if decoder.version == 4:
+            segment['src'], segment['dst'] = _V4_MAPPED + buf[ip + 12:ip + 16], _V4_MAPPED + buf[ip + 16:ip + 20]
+        else:
+            segment['src'], segment['dst'] = buf[ip + 8:ip + 24], buf[ip + 24:ip + 40]
+        for field in ('src_port', 'dst_port', 'seq', 'ack', 'flags', 'win_size', 'payload_len'):
+            segment[field] = getattr(decoder, field)
+        segment['ip_hdr_len'] = decoder.l4_offset - ip
+        segment['tcp_hdr_len'] = decoder.hdr_len
+        segment['data_offset'] = start + decoder.l4_offset + decoder.hdr_len
+        segment['mss'] = decoder.MSS or 0
+        if decoder.win_scale is not None:
+            segment['win_scale'] = decoder.win_scale
+        if decoder.tsval is not None:
+            segment['tsval'], segment['tsecr'], segment['has_ts'] = decoder.tsval, decoder.tsecr, True
+        sack = (decoder.sack or [])[:MAX_SACK_BLOCKS]
+        segment['sack_blocks'] = len(sack)
+        for j, block in enumerate(sack):
+            segment['sack'][j] = block
+    table['offset'] = offsets[rows]
+    table['ts'] = ts[rows]
+    table['caplen'] = caplen[rows]
+    table['wire_len'] = wire_len[rows]
+    return table[decoded], rows[decoded]
+
+
+def read_tcp_table(pcap_path, start=None, max_packets=None, end=None, counters=None, context=None):
+    """
+    Decode the TCP segments of pcap_path into a TCP_TABLE_DTYPE array, from the record at offset start (None for
+    the first one, context: see record_index) up to the ones starting before end, reading at most max_packets
+    records.
+    Return (table, offset of the next record or None when the range is done).
+    """
+    with PcapReader(pcap_path) as reader:
+        table, next_offset = _read_chunk(reader, start, max_packets, end, counters, context)
+    return table, next_offset
+
+
+def _read_chunk(reader, start, max_packets, end, counters, context=None):
+    offsets, frames, ts, caplen, wire_len, linktype, next_offset = record_index(reader, start, max_packets, end,
+                                                                               counters, context)
+    raw = np.frombuffer(reader.buf, dtype=np.uint8)
+    return decode_tcp(raw, offsets, frames, ts, caplen, wire_len, linktype, counters), next_offset
+
+
+def iter_tcp_tables(pcap_path, chunk_packets=1000000, counters=None):
+    """
+    Yield the TCP table of pcap_path chunk by chunk, to keep memory bounded on huge captures. The capture stays
+    open between chunks, so pcapng chunks start from the section table built once.
+    """
+    with PcapReader(pcap_path) as reader:
+        start = None
+        while True:
+            table, start = _read_chunk(reader, start, chunk_packets, None, counters)
+            yield table
+            if start is None:
+                return
+
+
+def _endpoint_hash(addresses, ports):
+    """64-bit hash of (address, port) pairs, FNV-1a over the four 32-bit words of the address and the port."""
+    words = np.ascontiguousarray(addresses).view('>u4').reshape(-1, 4).astype(np.uint64)
+    h = np.full(len(words), 0xcbf29ce484222325, dtype=np.uint64)
+    for column in (words[:, 0], words[:, 1], words[:, 2], words[:, 3], ports.astype(np.uint64)):
+        h = (h ^ column) * np.uint64(0x100000001b3)  # wraps around, as intended
+    return h
+
+
+def flow_shard(table, n_shards):
+    """
+    Shard number of every row, from a hash of its normalized (direction independent) 5-tuple, so both directions
+    of a connection land in the same shard.
+    """
+    a = _endpoint_hash(table['src'], table['src_port'])
+    b = _endpoint_hash(table['dst'], table['dst_port'])
+    lo, hi = np.minimum(a, b), np.maximum(a, b)
+    h = lo * np.uint64(0x9e3779b97f4a7c15) ^ hi * np.uint64(0xc2b2ae3d27d4eb4f)  # wraps around, as intended
+    h ^= h >> np.uint64(29)
+    return (h % np.uint64(n_shards)).astype(np.int64)
+
+
+def flow_ids(table):
+    """(distinct directional 4-tuples of the table, index of every row's 4-tuple in them)."""
+    keys = np.empty(len(table), dtype=[('src', 'V16'), ('dst', 'V16'), ('src_port', 'u2'), ('dst_port', 'u2')])
+    for field in keys.dtype.names:
+        keys[field] = table[field]
+    flow_keys, flow_id = np.unique(keys, return_inverse=True)
+    return flow_keys, flow_id.ravel()
+
+
+def flow_summary(table, flow_keys=None, flow_id=None):
+    """Group the rows of a TCP table by directional 4-tuple (see flow_ids) into a FLOW_SUMMARY_DTYPE array."""
+    if flow_id is None:
+        flow_keys, flow_id = flow_ids(table)
+    n = len(flow_keys)
+
+    summary = np.zeros(n, dtype=FLOW_SUMMARY_DTYPE)
+    for field in flow_keys.dtype.names:
+        summary[field] = flow_keys[field]
+    summary['packets'] = np.bincount(flow_id, minlength=n)
+    summary['bytes'] = np.bincount(flow_id, weights=table['wire_len'], minlength=n)
+    summary['payload_bytes'] = np.bincount(flow_id, weights=table['payload_len'], minlength=n)
+    summary['syn'] = np.bincount(flow_id, weights=(table['flags'] & 0x02) > 0, minlength=n)
+    summary['fin'] = np.bincount(flow_id, weights=(table['flags'] & 0x01) > 0, minlength=n)
+    summary['start_time'] = np.inf
+    summary['end_time'] = -np.inf
+    np.minimum.at(summary['start_time'], flow_id, table['ts'])
+    np.maximum.at(summary['end_time'], flow_id, table['ts'])
+    duration = summary['end_time'] - summary['start_time']
+    summary['throughput'] = np.divide(summary['bytes'] * 8, duration, out=np.zeros(n), where=duration > 0)
+    return summary
+
+
+if __name__ == '__main__':
+    tcp_table, _ = read_tcp_table(sys.argv[1])
+    for flow in flow_summary(tcp_table):
+        print(f'{ip_to_str(flow["src"])}:{flow["src_port"]} -> {ip_to_str(flow["dst"])}:{flow["dst_port"]}, '
+              f'packets: {flow["packets"]}, bytes: {flow["bytes"]}, payload: {flow["payload_bytes"]}, '
+              f'throughput: {"{:.3f}".format(flow["throughput"] / 1000000)} Mbps')
@@ -0,0 +1,120 @@
+# -*- coding:utf-8 -*-
+
+"""
+Per-flow RTT estimation from a capture, for the segments sent in one direction of a TCP connection:
+  - with TCP timestamps (RFC 7323) an ACK of new data is matched to the first segment sent with the tsval it echoes,
+    which stays unambiguous across retransmissions;
+  - without them the ACK is matched to the segment it exactly acknowledges, and Karn's rule drops the samples of
+    retransmitted segments;
+  - samples are smoothed into SRTT / RTTVAR / RTO as in RFC 6298.
+"""
+SEQ_MOD = 1 << 32
+
+
+def seq_before(a, b):
+    """a < b in the 32 bit wrapping sequence (or timestamp) space."""
+    return 0 < (b - a) % SEQ_MOD < SEQ_MOD // 2
+
+
+class RTTEstimator(object):
+    """
+    Feed the segments of one direction with on_send and the ACKs coming back with on_ack.
+    series, when kept, is [(ack time, sample, srtt, rttvar)] in seconds.
+    """
+    __slots__ = ('srtt', 'rttvar', 'rto', 'count', 'total', 'min', 'series', 'snd_nxt', 'snd_una', 'uses_ts',
+                 '_pending', '_ts_sent', '_max_pending', '_granularity')
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+    MIN_RTO = 1.0
+
+    def __init__(self, keep_series=False, max_pending=1024, granularity=0.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = 1.0  # before any sample, RFC 6298 2.1
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.series = [] if keep_series else None
+        self.snd_nxt = None  # highest sequence number sent + 1
+        self.snd_una = None  # highest sequence number acknowledged
+        self.uses_ts = False
+        self._pending = {}  # {expected ack: send time, None once retransmitted (Karn)}
+        self._ts_sent = {}  # {tsval: time of the first segment sent with it}
+        self._max_pending = max_pending  # both tables are capped, for ACKs the capture missed
+        self._granularity = granularity  # clock granularity G of RFC 6298
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def on_send(self, ts, seq, seq_len, tsval=None):
+        """A segment taking seq_len of sequence space (payload, SYN, FIN) was sent, return True if retransmitted."""
+        end = (seq + seq_len) % SEQ_MOD
+        retransmitted = self.snd_nxt is not None and not seq_before(self.snd_nxt, end)
+        if retransmitted:
+            self._retransmitted(seq, end)
+        else:
+            self.snd_nxt = end
+            self._pending[end] = ts
+            if len(self._pending) > self._max_pending:
+                del self._pending[next(iter(self._pending))]
+        if tsval is not None:
+            self.uses_ts = True
+            if tsval not in self._ts_sent:
+                self._ts_sent[tsval] = ts
+                if len(self._ts_sent) > self._max_pending:
+                    del self._ts_sent[next(iter(self._ts_sent))]
+        return retransmitted
+
+    def _retransmitted(self, start, end):
+        """
+        Karn: every pending segment sharing sequence space with the retransmitted [start, end) is ambiguous, not
+        only the one ending at end, since a retransmission may coalesce segments or resend part of one.
+        """
+        seg_start = self.snd_una  # pending segments follow each other from snd_una on
+        for seg_end in self._pending:
+            if seq_before(start, seg_end) and (seg_start is None or seq_before(seg_start, end)):
+                self._pending[seg_end] = None
+            seg_start = seg_end
+
+    def on_ack(self, ts, ack, tsecr=None):
+        """An ACK came back, return the RTT sample it gave, None if it gave none (duplicate, old or ambiguous)."""
+        if self.snd_una is not None and not seq_before(self.snd_una, ack):
+            return None  # acknowledges no new data
+        self.snd_una = ack
+
+        if self.uses_ts and tsecr is not None:
+            send_time = self._ts_sent.get(tsecr)
+            while self._ts_sent:  # tsvals up to the echoed one will not be echoed for new data anymore
+                oldest = next(iter(self._ts_sent))
+                if seq_before(tsecr, oldest):
+                    break
+                del self._ts_sent[oldest]
+        else:
+            send_time = self._pending.get(ack)
+        while self._pending:  # drop what this cumulative ACK covers
+            oldest = next(iter(self._pending))
+            if seq_before(ack, oldest):
+                break
+            del self._pending[oldest]
+
+        if send_time is None:
+            return None
+        sample = ts - send_time
+        self._update(ts, sample)
+        return sample
+
+    def _update(self, ts, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - sample)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * sample
+        self.rto = max(self.MIN_RTO, self.srtt + max(self._granularity, self.K * self.rttvar))
+        self.count += 1
+        self.total += sample
+        self.min = sample if self.min is None else min(self.min, sample)
+        if self.series is not None:
+            self.series.append((ts, sample, self.srtt, self.rttvar))
@@ -0,0 +1,174 @@
+# -*- coding:utf-8 -*-
+
+"""
+Sequence-space scoreboard of one direction of a TCP connection, classifying what the sender retransmits:
+  - RTO retransmit: sent after at least min_rto without ACK progress (the retransmission timer expired, nothing
+    else makes a sender wait that long), and the retransmissions of the same recovery;
+  - fast retransmit: any other retransmission, i.e. driven by the ACKs: the third duplicate ACK (RFC 5681),
+    SACK blocks above it (RFC 6675), or earlier loss detection (RACK, early retransmit), and the retransmissions
+    of the same recovery;
+  - spurious: data the receiver already had, known when it is resent (below snd_una or SACKed), from a D-SACK
+    block (RFC 2883), or from the ACK covering it echoing a timestamp older than the retransmission (Eifel,
+    RFC 3522).
+Sequence numbers are unwrapped to offsets from the first data byte. SACKed ranges and pending retransmissions are
+sorted arrays trimmed at snd_una, so a packet costs O(log n) searches over what is in flight.
+"""
+from bisect import bisect_left, bisect_right
+
+from rtt_estimator import SEQ_MOD, seq_before
+
+DUP_ACK_THRESHOLD = 3
+MIN_RTO = 0.2  # smallest retransmission timeout of common stacks (Linux), RFC 6298 says 1 s
+
+
+class IntervalSet(object):
+    """Disjoint half-open integer ranges [start, end), kept merged and sorted in two parallel lists."""
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, start, end):
+        """Add [start, end), return how many of its units were not in the set yet."""
+        if start >= end:
+            return 0
+        new = end - start - self.covered(start, end)
+        lo = bisect_left(self.ends, start)  # ranges from lo to hi - 1 overlap or touch [start, end)
+        hi = bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+        return new
+
+    def covered(self, start, end):
+        """How many units of [start, end) are in the set."""
+        lo = bisect_right(self.ends, start)
+        hi = bisect_left(self.starts, end)
+        return sum(min(e, end) - max(s, start) for s, e in zip(self.starts[lo:hi], self.ends[lo:hi]))
+
+    def trim(self, below):
+        """Drop everything before below."""
+        lo = bisect_right(self.ends, below)
+        del self.starts[:lo]
+        del self.ends[:lo]
+        if self.starts and self.starts[0] < below:
+            self.starts[0] = below
+
+
+class Scoreboard(object):
+    """
+    Feed the data segments of one direction with on_send and the ACKs coming back with on_ack.
+    fast_retransmits + rto_retransmits is every retransmission, spurious counts the ones among them that were
+    not needed; sacked_bytes is the data SACKed above snd_una.
+    Times are capture times in seconds.
+    """
+    __slots__ = ('base', 'snd_una', 'snd_nxt', 'dup_acks', 'data_segments', 'fast_retransmits', 'rto_retransmits',
+                 'spurious', 'retransmitted_bytes', 'sacked_bytes', 'sacked', 'min_rto', '_recovery', '_timer',
+                 '_last_win', '_pending_ends', '_pending_tsvals')
+
+    def __init__(self, min_rto=MIN_RTO):
+        self.base = None  # sequence number of the first data byte seen
+        self.snd_una = 0  # offsets from base
+        self.snd_nxt = 0
+        self.dup_acks = 0
+        self.data_segments = 0
+        self.fast_retransmits = 0
+        self.rto_retransmits = 0
+        self.spurious = 0
+        self.retransmitted_bytes = 0
+        self.sacked_bytes = 0
+        self.sacked = IntervalSet()
+        self.min_rto = min_rto
+        self._recovery = None  # ('fast' or 'rto', recovery point) until snd_una reaches it
+        self._timer = None  # when the retransmission timer was last (re)started
+        self._last_win = None
+        self._pending_ends = []  # end offsets of the retransmissions not yet acknowledged, sorted
+        self._pending_tsvals = []  # their tsval, None without timestamps
+
+    @property
+    def retransmissions(self):
+        return self.fast_retransmits + self.rto_retransmits
+
+    def _unwrap(self, seq):
+        d = (seq - self.base - self.snd_nxt) % SEQ_MOD
+        return self.snd_nxt + (d - SEQ_MOD if d >= SEQ_MOD // 2 else d)
+
+    def on_send(self, ts, seq, payload_len, tsval=None):
+        """A data segment was sent, return None for new data, else 'fast' or 'rto'."""
+        if self.base is None:
+            self.base = seq
+        start = self._unwrap(seq)
+        end = start + payload_len
+        self.data_segments += 1
+        if start >= self.snd_nxt:
+            if self.snd_nxt == self.snd_una:
+                self._timer = ts  # nothing was in flight
+            self.snd_nxt = end
+            return None
+
+        if self._recovery is not None and self.snd_una < self._recovery[1]:
+            kind = self._recovery[0]
+        else:
+            lost = self.sacked.covered(end, self.snd_nxt) > (DUP_ACK_THRESHOLD - 1) * payload_len
+            timed_out = self._timer is not None and ts - self._timer >= self.min_rto
+            kind = 'rto' if timed_out and self.dup_acks < DUP_ACK_THRESHOLD and not lost else 'fast'
+            self._recovery = (kind, self.snd_nxt)
+        if kind == 'fast':
+            self.fast_retransmits += 1
+        else:
+            self.rto_retransmits += 1
+        self.retransmitted_bytes += min(end, self.snd_nxt) - start
+        delivered = max(0, min(end, self.snd_una) - start) + self.sacked.covered(max(start, self.snd_una), end)
+        if delivered >= payload_len:
+            self.spurious += 1
+        else:
+            i = bisect_right(self._pending_ends, end)
+            self._pending_ends.insert(i, end)
+            self._pending_tsvals.insert(i, tsval)
+        self.snd_nxt = max(self.snd_nxt, end)
+        self._timer = ts
+        return kind
+
+    def on_ack(self, ts, ack, sack=None, tsecr=None, payload_len=0, win_size=None, flags=0):
+        """An ACK came back (flags: the TH_SYN / TH_FIN bits it carries, duplicate ACKs carry none)."""
+        if self.base is None:
+            return
+        ack = self._unwrap(ack)
+        blocks = [(self._unwrap(left), self._unwrap(right)) for left, right in sack or ()]
+        if blocks:
+            left, right = blocks[0]
+            if right <= ack or (len(blocks) > 1 and blocks[1][0] <= left and right <= blocks[1][1]):
+                self._dsack(left, right)  # D-SACK: the first block reports data received twice
+                blocks = blocks[1:]
+            for left, right in blocks:
+                self.sacked_bytes += self.sacked.add(max(left, ack), right)
+
+        if ack > self.snd_una:
+            self.snd_una = min(ack, self.snd_nxt)
+            self.dup_acks = 0
+            self._timer = ts
+            self.sacked.trim(self.snd_una)
+            covered = bisect_right(self._pending_ends, self.snd_una)
+            for tsval in self._pending_tsvals[:covered]:
+                if tsval is not None and tsecr is not None and seq_before(tsecr, tsval):
+                    self.spurious += 1  # the ACK answers the original transmission
+            del self._pending_ends[:covered]
+            del self._pending_tsvals[:covered]
+        elif ack == self.snd_una and self.snd_nxt > self.snd_una and payload_len == 0 and not flags and \
+                win_size == self._last_win:
+            self.dup_acks += 1
+        self._last_win = win_size
+
+    def _dsack(self, left, right):
+        lo = bisect_right(self._pending_ends, left)
+        hi = bisect_right(self._pending_ends, right)
+        if lo < hi:
+            self.spurious += hi - lo
+            del self._pending_ends[lo:hi]
+            del self._pending_tsvals[lo:hi]
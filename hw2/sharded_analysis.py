@@ -0,0 +1,102 @@
+# -*- coding:utf-8 -*-
+
+"""
+Multi-process flow analysis of large captures, in two parallel phases:
+  1. the capture is split in byte ranges cut on record boundaries, each range is decoded into a TCP table
+     (pcap_table) and its rows are split by a hash of their normalized 5-tuple, one .npy file per shard in a
+     temporary directory (TMPDIR), so the parent process only passes file paths around;
+  2. each shard loads its files from every range, in capture order, and runs the flow engine on them.
+Both directions of a connection hash to the same shard, so per-flow counters are the same as in a serial run.
+
+    python sharded_analysis.py capture.pcap [workers]
+"""
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from Packet import PcapReader
+from flow_engine import FlowEngine, print_flow
+from pcap_table import CaptureCounters, flow_shard, ip_to_str, iter_segments, read_tcp_table
+
+CHUNKS_PER_WORKER = 4  # smaller ranges even out the load between workers
+
+
+def split_capture(pcap_path, n_chunks):
+    """
+    [(start, end, context)] byte ranges of pcap_path starting on record boundaries, end None for the last one,
+    context the pcapng section state at start (None for classic pcap). pcapng blocks are walked once for all the
+    boundaries, and every range is then decoded from its start directly.
+    """
+    with PcapReader(pcap_path) as reader:
+        size = len(reader.buf)
+        bounds = []
+        for offset, context in reader.boundaries([size * i // n_chunks for i in range(n_chunks)]):
+            if offset is not None and (not bounds or offset > bounds[-1][0]):
+                bounds.append((offset, context))
+    ends = [offset for offset, _ in bounds[1:]] + [None]
+    return [(start, end, context) for (start, context), end in zip(bounds, ends)]
+
+
+def decode_range(pcap_path, start, end, n_shards, out_prefix, context=None):
+    """
+    Phase 1: decode one byte range (context: see split_capture) and save its rows of shard i to out_prefix-i.npy.
+    Return ([file of every shard], CaptureCounters of the range).
+    """
+    counters = CaptureCounters()
+    table, _ = read_tcp_table(pcap_path, start, end=end, counters=counters, context=context)
+    shard = flow_shard(table, n_shards)
+    paths = []
+    for i in range(n_shards):
+        paths.append(f'{out_prefix}-{i}.npy')
+        np.save(paths[-1], table[shard == i])
+    return paths, counters
+
+
+def analyze_shard(paths, idle_timeout):
+    """Phase 2: run the flow engine over the rows of one shard (its files, in capture order), return its flows."""
+    table = np.concatenate([np.load(path) for path in paths])
+    flows = []
+    engine = FlowEngine(flows.append, idle_timeout)
+    for segment in iter_segments(table, ip_str=False):
+        engine.process(segment.time, segment.src_ip, segment.dst_ip, segment, segment.payload_len, segment.caplen)
+    engine.flush()
+    for flow in flows:
+        flow.client = ip_to_str(flow.client)
+        flow.server = ip_to_str(flow.server)
+    return flows
+
+
+def analyze_parallel(pcap_path, workers=None, idle_timeout=120.0, counters=None):
+    """
+    Per-flow results (flow_engine.FlowRecord) of pcap_path computed by workers processes, by start time.
+    The capture counters are added to counters if given.
+    """
+    workers = workers or os.cpu_count()
+    ranges = split_capture(pcap_path, workers * CHUNKS_PER_WORKER)
+    if not ranges:
+        return []
+    with ProcessPoolExecutor(workers) as pool, tempfile.TemporaryDirectory(prefix='shards-') as tmp_dir:
+        parts = list(pool.map(decode_range, [pcap_path] * len(ranges), [start for start, _, _ in ranges],
+                              [end for _, end, _ in ranges], [workers] * len(ranges),
+                              [os.path.join(tmp_dir, str(i)) for i in range(len(ranges))],
+                              [context for _, _, context in ranges]))
+        shards = [[paths[i] for paths, _ in parts] for i in range(workers)]
+        if counters is not None:
+            for _, part_counters in parts:
+                counters.add(part_counters)
+        flows = [flow for shard_flows in pool.map(analyze_shard, shards, [idle_timeout] * workers)
+                 for flow in shard_flows]
+    flows.sort(key=lambda flow: flow.start_time)
+    return flows
+
+
+if __name__ == '__main__':
+    n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    capture_counters = CaptureCounters()
+    for f in analyze_parallel(sys.argv[1], n_workers, counters=capture_counters):
+        print_flow(f)
+    if capture_counters.skipped:
+        print(f'frames skipped (not decodable): {capture_counters.skipped}')
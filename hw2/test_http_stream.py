@@ -0,0 +1,145 @@
+# -*- coding:utf-8 -*-
+
+"""TCP reassembly and HTTP transaction pairing of http_stream, on hand-made segments."""
+import pytest
+
+from Packet import TH_ACK, TH_FIN, TH_SYN
+from http_stream import ByteStream, HTTPTracker
+from rtt_estimator import SEQ_MOD
+
+CLIENT, SERVER = '10.0.0.1', '10.0.0.2'
+CLIENT_PORT, SERVER_PORT = 40000, 80
+CLIENT_ISN, SERVER_ISN = 1000, 5000
+
+
+class Seg(object):
+    """The TCP fields http_stream reads."""
+
+    def __init__(self, src_port, dst_port, seq, flags=TH_ACK):
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.seq = seq
+        self.ack = 0
+        self.flags = flags
+
+
+def stream():
+    out = []
+    gaps = []
+    s = ByteStream(lambda ts, data: out.append(bytes(data)), lambda ts, n: gaps.append(n), max_pending=64)
+    s.syn(99)  # data starts at 100
+    return s, out, gaps
+
+
+def test_in_order_segments_are_delivered_as_they_come():
+    s, out, _ = stream()
+    s.feed(0, 100, b'abc')
+    s.feed(1, 103, b'def')
+    assert out == [b'abc', b'def']
+
+
+def test_out_of_order_segments_wait_for_the_hole():
+    s, out, _ = stream()
+    s.feed(0, 106, b'ghi')
+    s.feed(1, 103, b'def')
+    assert out == []
+    s.feed(2, 100, b'abc')
+    assert b''.join(out) == b'abcdefghi'
+    assert s.pending_bytes == 0
+
+
+def test_overlapping_retransmission_delivers_only_new_bytes():
+    s, out, _ = stream()
+    s.feed(0, 100, b'abcdef')
+    s.feed(1, 103, b'defghi')  # repacketized: half old, half new
+    s.feed(2, 100, b'abc')  # plain duplicate
+    assert out == [b'abcdef', b'ghi']
+
+
+def test_overlapping_out_of_order_segments_are_delivered_once():
+    s, out, _ = stream()
+    s.feed(0, 106, b'ghij')
+    s.feed(1, 104, b'efghijkl')  # overlaps the buffered segment on both sides
+    s.feed(2, 106, b'gh')  # shorter than what is buffered at the same seq
+    s.feed(3, 100, b'abcd')
+    assert b''.join(out) == b'abcdefghijkl'
+
+
+def test_gap_is_skipped_once_the_buffer_is_full():
+    s, out, gaps = stream()
+    s.feed(0, 110, b'x' * 40)
+    s.feed(1, 150, b'y' * 40)  # 80 bytes pending, above max_pending
+    assert gaps == [10]
+    assert b''.join(out) == b'x' * 40 + b'y' * 40
+    assert s.gap_bytes == 10
+
+
+def test_sequence_numbers_wrap_around():
+    s, out, _ = stream()
+    s.syn(SEQ_MOD - 4)  # data starts 3 bytes before the wrap
+    s.feed(0, 0, b'def')
+    s.feed(1, SEQ_MOD - 3, b'abc')
+    assert b''.join(out) == b'abcdef'
+
+
+def tracker():
+    transactions = []
+    t = HTTPTracker(lambda conn, txn: transactions.append(txn), SERVER_PORT)
+    return t, transactions
+
+
+def client(t, ts, offset, data, flags=TH_ACK):
+    t.feed(ts, CLIENT, SERVER, Seg(CLIENT_PORT, SERVER_PORT, CLIENT_ISN + 1 + offset, flags), data)
+
+
+def server(t, ts, offset, data, flags=TH_ACK):
+    t.feed(ts, SERVER, CLIENT, Seg(SERVER_PORT, CLIENT_PORT, SERVER_ISN + 1 + offset, flags), data)
+
+
+def handshake(t):
+    t.feed(0.0, CLIENT, SERVER, Seg(CLIENT_PORT, SERVER_PORT, CLIENT_ISN, TH_SYN), b'')
+    t.feed(0.01, SERVER, CLIENT, Seg(SERVER_PORT, CLIENT_PORT, SERVER_ISN, TH_SYN | TH_ACK), b'')
+
+
+REQUEST = b'GET /a HTTP/1.1\r\nHost: x\r\n\r\n'
+BODY = b'0123456789' * 3
+RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Length: 30\r\n\r\n' + BODY
+
+
+def test_response_reassembled_from_out_of_order_and_overlapping_segments():
+    t, transactions = tracker()
+    handshake(t)
+    client(t, 0.02, 0, REQUEST)
+    head = len(RESPONSE) - len(BODY)
+    server(t, 0.05, head + 10, RESPONSE[head + 10:])  # end of the body first
+    server(t, 0.06, 0, RESPONSE[:head + 5])
+    server(t, 0.07, head, RESPONSE[head:head + 15])  # retransmission overlapping both
+    assert len(transactions) == 1
+    txn = transactions[0]
+    assert (txn.method, txn.uri, txn.status) == ('GET', '/a', 200)
+    assert txn.res_bytes == len(RESPONSE)
+    assert txn.complete
+    assert txn.res_start == 0.06 and txn.res_end == 0.07
+
+
+def test_pipelined_requests_pair_with_responses_in_order():
+    t, transactions = tracker()
+    handshake(t)
+    second = b'GET /b HTTP/1.1\r\nHost: x\r\n\r\n'
+    client(t, 0.02, 0, REQUEST + second)
+    server(t, 0.05, 0, RESPONSE)
+    server(t, 0.06, len(RESPONSE), b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+    assert [(txn.uri, txn.status) for txn in transactions] == [('/a', 200), ('/b', 404)]
+    assert transactions[0].ttfb == pytest.approx(0.03)
+    assert transactions[1].ttfb == pytest.approx(0.04)  # both requests ended at 0.02
+
+
+def test_response_framed_by_the_end_of_the_connection():
+    t, transactions = tracker()
+    handshake(t)
+    client(t, 0.02, 0, b'GET / HTTP/1.0\r\n\r\n')
+    server(t, 0.05, 0, b'HTTP/1.0 200 OK\r\n\r\n' + BODY)
+    assert transactions == []
+    server(t, 0.06, len(b'HTTP/1.0 200 OK\r\n\r\n' + BODY), b'', TH_ACK | TH_FIN)
+    assert len(transactions) == 1
+    assert transactions[0].res_bytes == len(b'HTTP/1.0 200 OK\r\n\r\n' + BODY)
@@ -0,0 +1,121 @@
+# -*- coding:utf-8 -*-
+
+"""read_pcap_stream and LiveMonitor interval reports, on hand-made pcap streams."""
+import io
+import struct
+import time
+
+import pytest
+
+from Packet import PCAP_MAGIC, PCAPNG_SHB, TH_ACK, TH_FIN, TH_SYN
+from live_capture import LiveMonitor, read_pcap_stream
+
+START = 1700000000.0
+CLIENT, SERVER = b'\x0a\x00\x00\x01', b'\x0a\x00\x00\x02'
+CLIENT_ISN, SERVER_ISN = 1000, 5000
+MSS = 1000
+
+
+def frame(from_client, seq, ack, flags=TH_ACK, data=b''):
+    src, dst, ports = (CLIENT, SERVER, (40000, 80)) if from_client else (SERVER, CLIENT, (80, 40000))
+    tcp = struct.pack('>HHIIBBHHH', ports[0], ports[1], seq, ack, 5 << 4, flags, 65535, 0, 0) + data
+    ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp), 0, 0, 64, 6, 0, src, dst) + tcp
+    return bytes(12) + b'\x08\x00' + ip
+
+
+def pcap_stream(frames, snaplen=65535):
+    """Classic pcap bytes of [(ts, frame)], microsecond timestamps."""
+    out = io.BytesIO()
+    out.write(struct.pack('<IHHiIII', PCAP_MAGIC, 2, 4, 0, 0, snaplen, 1))
+    for ts, buf in frames:
+        sec = int(ts)
+        out.write(struct.pack('<IIII', sec, round((ts - sec) * 1000000), min(len(buf), snaplen), len(buf)) +
+                  buf[:snaplen])
+    return out.getvalue()
+
+
+def server_data(ts, n):
+    """Segment n (from 0) of MSS bytes sent by the server."""
+    return START + ts, frame(False, SERVER_ISN + 1 + n * MSS, CLIENT_ISN + 1, data=b'x' * MSS)
+
+
+def client_ack(ts, n):
+    """ACK of the first n server segments."""
+    return START + ts, frame(True, CLIENT_ISN + 1, SERVER_ISN + 1 + n * MSS)
+
+
+CONNECTION = [
+    (START, frame(True, CLIENT_ISN, 0, TH_SYN)),
+    (START + 0.01, frame(False, SERVER_ISN, CLIENT_ISN + 1, TH_SYN | TH_ACK)),
+    client_ack(0.02, 0),
+    # second interval: two segments, the second one lost and resent on timeout
+    server_data(1.1, 0), client_ack(1.15, 1), server_data(1.2, 1), server_data(1.8, 1), client_ack(1.85, 2),
+    # third interval: the end of the connection
+    (START + 2.5, frame(False, SERVER_ISN + 1 + 2 * MSS, CLIENT_ISN + 1, TH_FIN | TH_ACK)),
+    (START + 2.51, frame(True, CLIENT_ISN + 1, SERVER_ISN + 2 + 2 * MSS, TH_FIN | TH_ACK)),
+    (START + 2.52, frame(False, SERVER_ISN + 2 + 2 * MSS, CLIENT_ISN + 2)),
+]
+
+
+def test_stream_yields_every_record():
+    frames = list(read_pcap_stream(io.BytesIO(pcap_stream(CONNECTION))))
+    assert [ts for ts, _, _, _ in frames] == [pytest.approx(ts) for ts, _ in CONNECTION]
+    assert [bytes(buf) for _, buf, _, _ in frames] == [buf for _, buf in CONNECTION]
+    assert {linktype for _, _, linktype, _ in frames} == {1}
+
+
+def test_truncated_record_ends_the_stream():
+    data = pcap_stream(CONNECTION[:3])
+    assert len(list(read_pcap_stream(io.BytesIO(data[:-10])))) == 2  # cut in the last frame
+    assert len(list(read_pcap_stream(io.BytesIO(data[:-len(CONNECTION[2][1]) - 6])))) == 2  # in its header
+    assert list(read_pcap_stream(io.BytesIO(data[:20]))) == []  # in the file header
+
+
+def test_pcapng_stream_is_rejected():
+    shb = struct.pack('<IIIHHqI', PCAPNG_SHB, 28, 0x1a2b3c4d, 1, 0, -1, 28)
+    with pytest.raises(ValueError):
+        list(read_pcap_stream(io.BytesIO(shb)))
+
+
+def monitor_report(frames, snaplen=65535):
+    out = io.StringIO()
+    monitor = LiveMonitor(interval=1.0, out=out)
+    for ts, buf, linktype, wire_len in read_pcap_stream(io.BytesIO(pcap_stream(frames, snaplen))):
+        monitor.feed(ts, buf, linktype, wire_len)
+    monitor.close()
+    return out.getvalue().splitlines()
+
+
+def header_time(ts):
+    return f'======== {time.strftime("%H:%M:%S", time.localtime(ts))}, '
+
+
+def test_report_every_interval_of_frame_time():
+    lines = monitor_report(CONNECTION)
+    headers = [line for line in lines if line.startswith('========')]
+    assert [header[:len(header_time(START))] for header in headers] == \
+           [header_time(START + i) for i in (1, 2, 3)]
+    assert headers[-1].startswith(header_time(START + 3) + 'flows: 0, ')  # the closing report
+
+
+def test_report_throughput_and_loss_of_the_interval():
+    lines = monitor_report(CONNECTION)
+    flow_lines = [line for line in lines if not line.startswith('========')]
+    assert len(flow_lines) == 3  # one per interval with traffic
+    handshake, data, close = flow_lines
+    assert handshake.startswith('10.0.0.1:40000 -> 10.0.0.2:80, ')
+    assert f'throughput: {"{:.3f}".format(3 * 54 * 8 / 1000000)} Mbps, loss rate: 0.0000 (0/0)' in handshake
+    data_bytes = 3 * (54 + MSS) + 2 * 54
+    assert f'throughput: {"{:.3f}".format(data_bytes * 8 / 1000000)} Mbps, loss rate: 0.3333 (1/3)' in data
+    assert close.endswith('closed by: fin')
+
+
+def test_throughput_counts_the_wire_length_of_cut_frames():
+    data = [line for line in monitor_report(CONNECTION, snaplen=54) if not line.startswith('========')][1]
+    assert f'throughput: {"{:.3f}".format((3 * (54 + MSS) + 2 * 54) * 8 / 1000000)} Mbps' in data
+
+
+def test_spurious_retransmission_is_not_loss():
+    frames = CONNECTION[:5] + [server_data(1.8, 0), client_ack(1.85, 1), server_data(1.9, 1), client_ack(1.95, 2)]
+    data = [line for line in monitor_report(frames) if not line.startswith('========')][1]
+    assert 'loss rate: 0.0000 (0/3)' in data  # segment 0 resent after its ACK
@@ -0,0 +1,132 @@
+# -*- coding:utf-8 -*-
+
+"""TCP option parsing and header decoding (Packet, pcap_table) on hand-made frames."""
+import struct
+
+from Packet import (ETH_TYPE_8021Q, ETH_TYPE_IP, ETH_TYPE_IP6, IP_PROTO_HOPOPTS, IP_PROTO_TCP, IP_PROTO_UDP,
+                    LINKTYPE_ETHERNET, LINKTYPE_LINUX_SLL, LINKTYPE_LINUX_SLL2, LINKTYPE_RAW, TCP_OPT_MSS,
+                    TCP_OPT_SACK, TCP_OPT_TIMESTAMP, TCP_OPT_WSCALE, FrameDecoder, link_payload, parse_opts)
+from pcap_table import CaptureCounters, ip_to_str, iter_segments, read_tcp_table
+
+MSS_OPT = bytes([TCP_OPT_MSS, 4, 0x05, 0xb4])
+TS_OPT = bytes([TCP_OPT_TIMESTAMP, 10]) + struct.pack('>II', 7, 9)
+SACK_OPT = bytes([TCP_OPT_SACK, 18]) + struct.pack('>IIII', 100, 200, 300, 400)
+
+
+def test_parse_opts_reads_every_option():
+    opts = parse_opts(MSS_OPT + bytes([1, 1]) + TS_OPT + bytes([TCP_OPT_WSCALE, 3, 7]))
+    assert bytes(opts[TCP_OPT_MSS]) == b'\x05\xb4'
+    assert bytes(opts[TCP_OPT_TIMESTAMP]) == struct.pack('>II', 7, 9)
+    assert bytes(opts[TCP_OPT_WSCALE]) == b'\x07'
+
+
+def test_parse_opts_stops_at_eol():
+    assert set(parse_opts(MSS_OPT + b'\x00' + TS_OPT)) == {TCP_OPT_MSS}
+
+
+def test_parse_opts_stops_at_a_truncated_option():
+    assert parse_opts(bytes([TCP_OPT_TIMESTAMP, 10, 0, 0])) == {}  # length past the end
+    assert set(parse_opts(MSS_OPT + bytes([TCP_OPT_MSS]))) == {TCP_OPT_MSS}  # kind without its length byte
+
+
+def test_parse_opts_stops_at_a_length_below_two():
+    assert parse_opts(bytes([TCP_OPT_MSS, 0]) + MSS_OPT) == {}  # would loop forever
+    assert parse_opts(bytes([TCP_OPT_MSS, 1]) + MSS_OPT) == {}
+
+
+def test_parse_opts_of_only_padding():
+    assert parse_opts(b'') == {}
+    assert parse_opts(b'\x01\x01\x01\x01') == {}
+
+
+def ipv4(payload, proto=IP_PROTO_TCP, src=b'\x0a\x00\x00\x01', dst=b'\x0a\x00\x00\x02', frag=0):
+    return struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 0, frag, 64, proto, 0, src, dst) + payload
+
+
+def ipv6(payload, next_header=IP_PROTO_TCP):
+    return struct.pack('>IHBB', 6 << 28, len(payload), next_header, 64) + bytes(15) + b'\x01' + bytes(15) + \
+        b'\x02' + payload
+
+
+def tcp(opts=b'', data=b'', seq=1000, flags=0x18):
+    opts += bytes(-len(opts) % 4)
+    return struct.pack('>HHIIBBHHH', 40000, 80, seq, 1, (20 + len(opts)) << 2, flags, 512, 0, 0) + opts + data
+
+
+def ethernet(payload, eth_type=ETH_TYPE_IP):
+    return bytes(12) + struct.pack('>H', eth_type) + payload
+
+
+def test_decoder_ignores_truncated_options():
+    decoder = FrameDecoder()
+    assert decoder.decode(ethernet(ipv4(tcp(MSS_OPT + bytes([TCP_OPT_TIMESTAMP, 10, 0, 0])))))
+    assert decoder.MSS == 1460
+    assert decoder.tsval is None
+
+
+def test_decoder_rejects_header_length_past_the_packet():
+    segment = bytearray(tcp(data=b'abc'))
+    segment[12] = 15 << 4  # 60 bytes of header, 23 bytes captured
+    assert not FrameDecoder().decode(ethernet(ipv4(bytes(segment))))
+
+
+def test_link_payload_of_every_link_type():
+    ip = ipv4(tcp())
+    assert link_payload(ethernet(ip), LINKTYPE_ETHERNET) == (ETH_TYPE_IP, 14)
+    vlan = bytes(12) + struct.pack('>HHH', ETH_TYPE_8021Q, 5, ETH_TYPE_IP) + ip
+    assert link_payload(vlan, LINKTYPE_ETHERNET) == (ETH_TYPE_IP, 18)
+    assert link_payload(vlan[:16], LINKTYPE_ETHERNET) is None  # cut in the tag
+    assert link_payload(bytes(14) + struct.pack('>H', ETH_TYPE_IP6), LINKTYPE_LINUX_SLL) == (ETH_TYPE_IP6, 16)
+    assert link_payload(struct.pack('>H', ETH_TYPE_IP) + bytes(18), LINKTYPE_LINUX_SLL2) == (ETH_TYPE_IP, 20)
+    assert link_payload(ip, LINKTYPE_RAW) == (ETH_TYPE_IP, 0)
+
+
+def write_pcap(path, frames, linktype=LINKTYPE_ETHERNET):
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, linktype))
+        for i, frame in enumerate(frames):
+            f.write(struct.pack('<IIII', i, 0, len(frame), len(frame)) + frame)
+    return str(path)
+
+
+def test_table_matches_the_decoder_options(tmp_path):
+    frames = [ethernet(ipv4(tcp(opts))) for opts in (MSS_OPT + bytes([TCP_OPT_WSCALE, 3, 7]), TS_OPT,
+                                                      bytes([1, 1]) + SACK_OPT, bytes([TCP_OPT_TIMESTAMP, 10]),
+                                                      bytes([TCP_OPT_MSS, 0]) + MSS_OPT)]
+    table, _ = read_tcp_table(write_pcap(tmp_path / 'opts.pcap', frames))
+    decoder = FrameDecoder()
+    for segment, frame in zip(iter_segments(table), frames):
+        assert decoder.decode(frame)
+        assert (segment.MSS, segment.win_scale, segment.tsval, segment.tsecr, segment.sack) == \
+               (decoder.MSS, decoder.win_scale, decoder.tsval, decoder.tsecr, decoder.sack)
+
+
+def test_table_decodes_ipv6_with_and_without_extension_headers(tmp_path):
+    hop_by_hop = bytes([IP_PROTO_TCP, 0, 1, 4, 0, 0, 0, 0])
+    frames = [ethernet(ipv6(tcp(TS_OPT, b'hello')), ETH_TYPE_IP6),
+              ethernet(ipv6(hop_by_hop + tcp(TS_OPT, b'world', seq=1005), IP_PROTO_HOPOPTS), ETH_TYPE_IP6)]
+    path = write_pcap(tmp_path / 'v6.pcap', frames)
+    table, _ = read_tcp_table(path)
+    assert table['seq'].tolist() == [1000, 1005]
+    assert table['payload_len'].tolist() == [5, 5]
+    assert table['ip_hdr_len'].tolist() == [40, 48]
+    assert table['tsval'].tolist() == [7, 7]
+    assert ip_to_str(table['src'][0]) == '::1'
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert [data[offset:offset + 5] for offset in table['data_offset'].tolist()] == [b'hello', b'world']
+
+
+def test_table_counts_the_frames_it_skips(tmp_path):
+    frames = [ethernet(ipv4(tcp())),
+              ethernet(ipv4(tcp())[:30]),  # cut in the TCP header
+              ethernet(ipv4(tcp(), frag=1)),  # second fragment, no TCP header
+              ethernet(ipv4(b'\x00' * 8, IP_PROTO_UDP)),  # not TCP, not skipped
+              ethernet(b'\x00' * 28, 0x0806)]  # ARP, not skipped
+    counters = CaptureCounters()
+    table, _ = read_tcp_table(write_pcap(tmp_path / 'mixed.pcap', frames), counters=counters)
+    assert len(table) == 1
+    assert (counters.packets, counters.ip_packets, counters.skipped) == (5, 4, 2)
+    counters = CaptureCounters()
+    read_tcp_table(write_pcap(tmp_path / 'other.pcap', frames, linktype=105), counters=counters)  # 802.11
+    assert counters.skipped == 5
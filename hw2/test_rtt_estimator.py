@@ -0,0 +1,87 @@
+# -*- coding:utf-8 -*-
+
+"""RTTEstimator on hand-made segments: Karn's rule, re-segmented retransmissions, timestamp echo, smoothing."""
+import pytest
+
+from rtt_estimator import SEQ_MOD, RTTEstimator, seq_before
+
+
+def test_seq_before_wraps_around():
+    assert seq_before(SEQ_MOD - 10, 5)
+    assert not seq_before(5, SEQ_MOD - 10)
+    assert not seq_before(7, 7)
+
+
+def test_first_sample_sets_srtt_and_rttvar():
+    rtt = RTTEstimator(keep_series=True)
+    rtt.on_send(0.0, 1000, 100)
+    assert rtt.on_ack(0.2, 1100) == pytest.approx(0.2)
+    assert rtt.srtt == pytest.approx(0.2)
+    assert rtt.rttvar == pytest.approx(0.1)
+    assert rtt.rto == 1.0  # srtt + 4 * rttvar = 0.6, below the minimum
+    assert rtt.series == [(0.2, pytest.approx(0.2), pytest.approx(0.2), pytest.approx(0.1))]
+
+
+def test_duplicate_and_old_acks_give_no_sample():
+    rtt = RTTEstimator()
+    rtt.on_send(0.0, 1000, 100)
+    rtt.on_send(0.0, 1100, 100)
+    assert rtt.on_ack(0.1, 1100) == pytest.approx(0.1)
+    assert rtt.on_ack(0.2, 1100) is None
+    assert rtt.on_ack(0.3, 1000) is None
+    assert rtt.count == 1
+
+
+def test_karn_drops_the_sample_of_a_retransmitted_segment():
+    rtt = RTTEstimator()
+    rtt.on_send(0.0, 1000, 100)
+    assert rtt.on_send(1.0, 1000, 100)
+    assert rtt.on_ack(1.05, 1100) is None
+    assert rtt.count == 0
+    rtt.on_send(1.1, 1100, 100)
+    assert rtt.on_ack(1.15, 1200) == pytest.approx(0.05)
+
+
+def test_coalesced_retransmission_makes_every_segment_ambiguous():
+    rtt = RTTEstimator()
+    rtt.on_send(0.0, 1000, 1000)
+    rtt.on_send(0.0, 2000, 1000)
+    rtt.on_send(1.0, 1000, 2000)  # both segments resent as one
+    assert rtt.on_ack(1.1, 2000) is None
+    assert rtt.on_ack(1.2, 3000) is None
+    assert rtt.count == 0
+
+
+def test_partial_retransmission_makes_the_segment_ambiguous():
+    rtt = RTTEstimator()
+    rtt.on_send(0.0, 1000, 2000)
+    rtt.on_send(1.0, 1000, 1000)  # first half of the segment resent
+    assert rtt.on_ack(1.1, 3000) is None
+    assert rtt.count == 0
+
+
+def test_segments_outside_the_retransmission_keep_their_samples():
+    rtt = RTTEstimator()
+    for seq in (1000, 2000, 3000):
+        rtt.on_send(0.0, seq, 1000)
+    assert rtt.on_ack(0.1, 2000) == pytest.approx(0.1)
+    rtt.on_send(1.0, 2000, 1000)
+    assert rtt.on_ack(1.1, 3000) is None
+    assert rtt.on_ack(1.2, 4000) == pytest.approx(1.2)
+
+
+def test_timestamp_echo_disambiguates_retransmissions():
+    rtt = RTTEstimator()
+    rtt.on_send(0.0, 1000, 100, tsval=10)
+    rtt.on_send(1.0, 1000, 100, tsval=20)
+    assert rtt.on_ack(1.05, 1100, tsecr=20) == pytest.approx(0.05)
+    assert rtt.uses_ts
+
+
+def test_sequence_numbers_wrap_around():
+    rtt = RTTEstimator()
+    seq = SEQ_MOD - 50
+    rtt.on_send(0.0, seq, 100)
+    assert rtt.snd_nxt == 50
+    assert rtt.on_ack(0.1, 50) == pytest.approx(0.1)
+    assert rtt.on_send(0.5, seq, 100)  # below snd_nxt across the wrap: a retransmission
@@ -0,0 +1,155 @@
+# -*- coding:utf-8 -*-
+
+"""IntervalSet merging and Scoreboard classification of retransmissions, on hand-made segments."""
+from rtt_estimator import SEQ_MOD
+from seq_scoreboard import IntervalSet, Scoreboard
+
+MSS = 1000
+
+
+def ranges(s):
+    return list(zip(s.starts, s.ends))
+
+
+def test_add_keeps_disjoint_ranges_sorted():
+    s = IntervalSet()
+    assert s.add(50, 60) == 10
+    assert s.add(10, 20) == 10
+    assert s.add(30, 40) == 10
+    assert ranges(s) == [(10, 20), (30, 40), (50, 60)]
+
+
+def test_add_merges_overlapping_and_touching_ranges():
+    s = IntervalSet()
+    s.add(10, 20)
+    s.add(30, 40)
+    assert s.add(20, 30) == 10  # touches both sides
+    assert ranges(s) == [(10, 40)]
+    assert s.add(35, 45) == 5  # overlaps the end
+    assert s.add(5, 12) == 5  # overlaps the start
+    assert ranges(s) == [(5, 45)]
+
+
+def test_add_spanning_several_ranges_counts_only_the_holes():
+    s = IntervalSet()
+    for start in (10, 30, 50):
+        s.add(start, start + 10)
+    assert s.add(0, 100) == 100 - 30
+    assert ranges(s) == [(0, 100)]
+
+
+def test_add_inside_or_empty_adds_nothing():
+    s = IntervalSet()
+    s.add(10, 40)
+    assert s.add(15, 25) == 0
+    assert s.add(30, 30) == 0
+    assert ranges(s) == [(10, 40)]
+
+
+def test_covered_and_trim():
+    s = IntervalSet()
+    s.add(10, 20)
+    s.add(30, 40)
+    assert s.covered(0, 100) == 20
+    assert s.covered(15, 35) == 10
+    assert s.covered(20, 30) == 0
+    s.trim(15)
+    assert ranges(s) == [(15, 20), (30, 40)]
+    s.trim(25)
+    assert ranges(s) == [(30, 40)]
+    s.trim(40)
+    assert len(s) == 0
+
+
+def send(board, ts, n, base=1, tsval=None):
+    """Segment n (from 0) of MSS bytes."""
+    return board.on_send(ts, base + n * MSS, MSS, tsval)
+
+
+def ack(board, ts, n, base=1, sack=None, tsecr=None):
+    """ACK of the first n segments."""
+    board.on_ack(ts, base + n * MSS, sack, tsecr, win_size=100)
+
+
+def test_new_data_is_not_a_retransmission():
+    board = Scoreboard()
+    for n in range(4):
+        assert send(board, 0.0, n) is None
+    ack(board, 0.1, 4)
+    assert board.retransmissions == 0
+    assert board.data_segments == 4
+
+
+def test_retransmission_after_three_duplicate_acks_is_fast():
+    board = Scoreboard()
+    for n in range(5):
+        send(board, 0.0, n)
+    for ts in (0.10, 0.11, 0.12, 0.13):  # the first ACK, then three duplicates
+        ack(board, ts, 1)
+    assert board.dup_acks == 3
+    assert send(board, 0.14, 1) == 'fast'
+    ack(board, 0.2, 5)
+    assert (board.fast_retransmits, board.rto_retransmits, board.spurious) == (1, 0, 0)
+    assert board.retransmitted_bytes == MSS
+
+
+def test_retransmission_after_a_silent_timeout_is_rto():
+    board = Scoreboard()
+    send(board, 0.0, 0)
+    send(board, 0.0, 1)
+    assert send(board, 1.0, 0) == 'rto'
+    assert send(board, 1.0, 1) == 'rto'  # same recovery
+    ack(board, 1.1, 2)
+    assert (board.fast_retransmits, board.rto_retransmits) == (0, 2)
+
+
+def test_sack_blocks_above_a_hole_make_it_fast():
+    board = Scoreboard()
+    for n in range(5):
+        send(board, 0.0, n)
+    ack(board, 0.1, 0, sack=[(1 + MSS, 1 + 4 * MSS)])
+    assert board.sacked_bytes == 3 * MSS
+    assert send(board, 0.3, 0) == 'fast'
+
+
+def test_resending_acknowledged_data_is_spurious():
+    board = Scoreboard()
+    send(board, 0.0, 0)
+    send(board, 0.0, 1)
+    ack(board, 0.1, 1)
+    send(board, 0.5, 0)
+    assert board.spurious == 1
+
+
+def test_dsack_marks_the_retransmission_spurious():
+    board = Scoreboard()
+    send(board, 0.0, 0)
+    send(board, 0.0, 1)
+    send(board, 1.0, 0)
+    ack(board, 1.1, 2, sack=[(1, 1 + MSS)])  # D-SACK: segment 0 arrived twice
+    assert board.retransmissions == 1
+    assert board.spurious == 1
+
+
+def test_ack_echoing_the_original_timestamp_marks_it_spurious():
+    board = Scoreboard()
+    send(board, 0.0, 0, tsval=100)
+    send(board, 1.0, 0, tsval=200)
+    ack(board, 1.05, 1, tsecr=100)  # Eifel: answers the first transmission
+    assert board.spurious == 1
+    board = Scoreboard()
+    send(board, 0.0, 0, tsval=100)
+    send(board, 1.0, 0, tsval=200)
+    ack(board, 1.05, 1, tsecr=200)
+    assert board.spurious == 0
+
+
+def test_sequence_numbers_wrap_around():
+    board = Scoreboard()
+    base = SEQ_MOD - MSS
+    send(board, 0.0, 0, base)
+    send(board, 0.0, 1, base)  # starts at sequence number 0
+    assert board.snd_nxt == 2 * MSS
+    ack(board, 0.1, 1, base)
+    assert board.snd_una == MSS
+    assert send(board, 1.0, 1, base) == 'rto'